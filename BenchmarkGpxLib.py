@@ -0,0 +1,283 @@
+# (c) 2018 Phillip Myburgh
+# Distributed under the MIT Licence
+
+
+import sys
+import os
+import gc
+import json
+import math
+import platform
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import timeit
+# To parse command line arguments
+import argparse
+
+import numpy as np
+
+from GpxLib import *
+
+
+# The stages of the gpx to tcx conversion, in the order they are run
+STAGES = ["ParseGpxFile", "InterpolateToGivenResolution", "PruneDistance", "CreateEquidistantProfile",
+          "CreateSlopeCourse", "Compress", "GenerateTcxSlopeWorkout", "GenerateFitSlopeWorkout"]
+
+DEFAULT_SYNTHETIC_SIZES = [10000, 100000, 1000000]
+
+# The average distance between two points of a synthetic course in meters
+SYNTHETIC_POINT_SPACING = 3.0
+
+# Finer than the spacing of the synthetic points, so the interpolation actually adds points to every course
+DEFAULT_INTERPOLATION_RESOLUTION = 1.0
+
+# Anything faster than this is not flagged as a regression, because the timing is mostly noise
+MINIMUM_REGRESSION_SECONDS = 0.005
+
+
+def GetResidentMemory():
+    '''The current resident memory of the process in bytes'''
+    try:
+        with open("/proc/self/statm") as statmFile:
+            return int(statmFile.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # No procfs, use the peak so far instead. Linux reports it in kilobytes, macOS in bytes
+        maxResidentMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxResidentMemory if sys.platform == "darwin" else maxResidentMemory * 1024
+
+
+class PeakMemoryMonitor:
+    '''
+        Samples the resident memory in a background thread while the with block runs.
+        peakIncrease is the highest memory use above the memory at the start of the block, in bytes
+    '''
+    def __init__(self, sampleInterval=0.001):
+        self.sampleInterval = sampleInterval
+        self.peakIncrease = 0
+        self.__stopEvent = threading.Event()
+
+
+    def __Sample(self):
+        self.__peak = max(self.__peak, GetResidentMemory())
+
+
+    def __Run(self):
+        while not self.__stopEvent.wait(self.sampleInterval):
+            self.__Sample()
+
+
+    def __enter__(self):
+        self.__start = GetResidentMemory()
+        self.__peak = self.__start
+        self.__thread = threading.Thread(target=self.__Run)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+
+    def __exit__(self, exceptionType, exceptionValue, traceback):
+        self.__stopEvent.set()
+        self.__thread.join()
+        self.__Sample()
+        self.peakIncrease = self.__peak - self.__start
+        return False
+
+
+def WriteSyntheticGpxFile(filename, numberOfPoints, seed=0, chunkSize=100000):
+    '''
+        Write a gpx file with a random, winding course of the given number of points, roughly SYNTHETIC_POINT_SPACING
+        meters apart, with rolling hills. The file is written in chunks, so any size can be created
+    '''
+    randomState = np.random.RandomState(seed)
+    metersPerDegree = RADIUS_OF_EARTH * math.pi / 180.0
+    latitude, longitude, heading = -26.0, 28.0, 0.0
+
+    with open(filename, "w") as gpxFile:
+        gpxFile.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                      '<gpx version="1.1" creator="BenchmarkGpxLib" xmlns="http://www.topografix.com/GPX/1/1">\n'
+                      '<trk><name>Synthetic ' + str(numberOfPoints) + '</name><trkseg>\n')
+        for start in range(0, numberOfPoints, chunkSize):
+            count = min(chunkSize, numberOfPoints - start)
+            # The heading slowly wanders around, which gives a winding road
+            headings = heading + np.cumsum(randomState.normal(0, 0.05, count))
+            heading = headings[-1]
+            steps = SYNTHETIC_POINT_SPACING * randomState.uniform(0.5, 1.5, count) / metersPerDegree
+            latitudes = latitude + np.cumsum(steps * np.sin(headings))
+            longitudes = longitude + np.cumsum(steps * np.cos(headings) / math.cos(math.radians(latitude)))
+            latitude, longitude = latitudes[-1], longitudes[-1]
+            latitudes = np.clip(latitudes, -89.0, 89.0)
+            longitudes = (longitudes + 180.0) % 360.0 - 180.0
+
+            distances = (start + np.arange(count)) * SYNTHETIC_POINT_SPACING
+            elevations = 1500.0 + 150.0 * np.sin(distances / 5000.0) + 20.0 * np.sin(distances / 300.0)
+
+            gpxFile.write("".join('<trkpt lat="%.7f" lon="%.7f"><ele>%.1f</ele></trkpt>\n' % point for point in
+                                  zip(latitudes.tolist(), longitudes.tolist(), elevations.tolist())))
+        gpxFile.write('</trkseg></trk>\n</gpx>\n')
+
+
+def RunStages(inputFilename, outputName, interpolationResolution, repeat):
+    '''
+        Run the conversion stages on the given gpx file. Every stage is timed on its own, with the output of the
+        previous stage as input. Returns the number of gps points and a dictionary of
+        stage name -> (best seconds, peak memory increase in bytes)
+    '''
+    def PruneDistance(gpxCourse):
+        # Trim 10% off both ends
+        totalDistance = gpxCourse.GetTotalDistance()
+        return gpxCourse.PruneDistance(totalDistance * 0.9, totalDistance * 0.1)
+
+    stageFunctions = {
+        "ParseGpxFile": lambda _: ParseGpxFile(inputFilename),
+        "InterpolateToGivenResolution": lambda gpxCourse: gpxCourse.InterpolateToGivenResolution(interpolationResolution),
+        "PruneDistance": PruneDistance,
+        "CreateEquidistantProfile": lambda gpxCourse: gpxCourse.CreateEquidistantProfile(interpolationResolution),
+        "CreateSlopeCourse": lambda profile: profile.CreateSlopeCourse(),
+        "Compress": lambda slopeCourse: slopeCourse.Compress(),
+        "GenerateTcxSlopeWorkout": lambda slopeCourse: GenerateTcxSlopeWorkout(slopeCourse, outputName),
+        "GenerateFitSlopeWorkout": lambda slopeCourse: GenerateFitSlopeWorkout(slopeCourse, outputName),
+    }
+
+    stageResults = {}
+    stageInput = None
+    for stage in STAGES:
+        bestSeconds = None
+        peakIncrease = 0
+        for _ in range(0, repeat):
+            stageOutput = None
+            gc.collect()
+            with PeakMemoryMonitor() as memoryMonitor:
+                startTime = timeit.default_timer()
+                stageOutput = stageFunctions[stage](stageInput)
+                seconds = timeit.default_timer() - startTime
+            bestSeconds = seconds if bestSeconds is None else min(bestSeconds, seconds)
+            peakIncrease = max(peakIncrease, memoryMonitor.peakIncrease)
+        stageResults[stage] = (bestSeconds, peakIncrease)
+        if stage == "ParseGpxFile":
+            numberOfPoints = stageOutput.GetNumberOfPoints()
+        # The workout stages only return the filename, so the slope course stays the input of the last stages
+        if stage not in ("GenerateTcxSlopeWorkout", "GenerateFitSlopeWorkout"):
+            stageInput = stageOutput
+
+    return numberOfPoints, stageResults
+
+
+def RunBenchmarks(courses, workDirectory, interpolationResolution, repeat):
+    '''
+        Benchmark the given (course name, gpx filename) pairs.
+        Returns the list of results, one dictionary per course and stage
+    '''
+    results = []
+    for courseName, inputFilename in courses:
+        print "Benchmarking " + courseName + "..."
+        outputName = os.path.join(workDirectory, "benchmark")
+        numberOfPoints, stageResults = RunStages(inputFilename, outputName, interpolationResolution, repeat)
+        for stage in STAGES:
+            seconds, peakIncrease = stageResults[stage]
+            results.append({"course": courseName, "numberOfPoints": numberOfPoints, "stage": stage,
+                            "seconds": seconds, "peakMemoryMB": peakIncrease / (1024.0 * 1024.0)})
+    return results
+
+
+def CompareWithBaseline(results, baselineResults, threshold):
+    '''
+        Add the baseline time and ratio to every result that is in the baseline. A result is flagged as a regression
+        if it is more than threshold (e.g. 0.2 for 20%) slower than the baseline.
+        Returns the list of regressed results
+    '''
+    baselineSeconds = dict(((result["course"], result["stage"]), result["seconds"]) for result in baselineResults)
+    regressions = []
+    for result in results:
+        key = (result["course"], result["stage"])
+        if key not in baselineSeconds:
+            continue
+        result["baselineSeconds"] = baselineSeconds[key]
+        result["ratio"] = result["seconds"] / max(baselineSeconds[key], 1e-9)
+        result["regression"] = (result["ratio"] > 1.0 + threshold and
+                                result["seconds"] - baselineSeconds[key] > MINIMUM_REGRESSION_SECONDS)
+        if result["regression"]:
+            regressions.append(result)
+    return regressions
+
+
+def PrintResults(results):
+    print "%-20s %10s %-30s %10s %12s %10s" % ("Course", "Points", "Stage", "Seconds", "Peak MB", "Baseline")
+    for result in results:
+        line = "%-20s %10d %-30s %10.4f %12.1f" % (result["course"], result["numberOfPoints"], result["stage"],
+                                                   result["seconds"], result["peakMemoryMB"])
+        if "ratio" in result:
+            line += " %9.2fx" % result["ratio"]
+            if result["regression"]:
+                line += "  REGRESSION"
+        print line
+
+
+def GetMetadata(interpolationResolution, repeat):
+    return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"), "interpolationResolution": interpolationResolution,
+            "repeat": repeat}
+
+
+def main():
+    argumentParser = argparse.ArgumentParser(
+                    description='Time every stage of the gpx to tcx conversion on the test race and on synthetic courses')
+    argumentParser.add_argument('--sizes', type=int, nargs='*', default=DEFAULT_SYNTHETIC_SIZES, help='Number of points of the synthetic courses (defaults to 10000 100000 1000000)')
+    argumentParser.add_argument('--inputFilenames', "-i", type=str, nargs='*', help='Gpx files to benchmark (defaults to the test race)')
+    argumentParser.add_argument('--interpolationResolution', "-r", type=float, default=DEFAULT_INTERPOLATION_RESOLUTION, help='Resolution of the interpolation in meter (defaults to 1m)')
+    argumentParser.add_argument('--repeat', "-n", type=int, default=1, help='Run every stage this many times and keep the fastest (defaults to 1)')
+    argumentParser.add_argument('--output', "-o", type=str, help='Save the results to this JSON file')
+    argumentParser.add_argument('--baseline', "-b", type=str, help='Compare the results with this JSON file from a previous run')
+    argumentParser.add_argument('--threshold', "-t", type=float, default=0.2, help='A stage is a regression if it is this much slower than the baseline (defaults to 0.2 = 20%%)')
+    argumentParser.add_argument('--dataDirectory', "-d", type=str, help='Keep the synthetic gpx files in this directory, so they can be reused by the next run')
+
+    commandlineArguments = argumentParser.parse_args()
+
+    inputFilenames = commandlineArguments.inputFilenames
+    if inputFilenames is None:
+        inputFilenames = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "TestData", "94.7Race.gpx")]
+
+    workDirectory = tempfile.mkdtemp()
+    dataDirectory = commandlineArguments.dataDirectory or workDirectory
+    if not os.path.isdir(dataDirectory):
+        os.makedirs(dataDirectory)
+
+    try:
+        courses = [(os.path.splitext(os.path.basename(filename))[0], filename) for filename in inputFilenames]
+        for numberOfPoints in commandlineArguments.sizes:
+            filename = os.path.join(dataDirectory, "Synthetic" + str(numberOfPoints) + ".gpx")
+            if not os.path.isfile(filename):
+                print "Creating a synthetic course of " + str(numberOfPoints) + " points..."
+                WriteSyntheticGpxFile(filename, numberOfPoints)
+            courses.append(("Synthetic" + str(numberOfPoints), filename))
+
+        results = RunBenchmarks(courses, workDirectory, commandlineArguments.interpolationResolution,
+                                commandlineArguments.repeat)
+    finally:
+        shutil.rmtree(workDirectory)
+
+    regressions = []
+    if commandlineArguments.baseline:
+        with open(commandlineArguments.baseline) as baselineFile:
+            regressions = CompareWithBaseline(results, json.load(baselineFile)["results"],
+                                              commandlineArguments.threshold)
+
+    print
+    PrintResults(results)
+
+    if commandlineArguments.output:
+        with open(commandlineArguments.output, "w") as outputFile:
+            json.dump({"metadata": GetMetadata(commandlineArguments.interpolationResolution, commandlineArguments.repeat),
+                       "results": results}, outputFile, indent=2, sort_keys=True, separators=(",", ": "))
+            outputFile.write("\n")
+        print "Saved the results to " + commandlineArguments.output
+
+    if regressions:
+        print str(len(regressions)) + " stages are slower than the baseline!"
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
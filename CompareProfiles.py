@@ -4,66 +4,238 @@
 
 import sys
 import os
+import time
+import json
+import itertools
+import multiprocessing
+from collections import namedtuple
 # To parse command line arguments
 import argparse
 
 from GpxLib import *
-
-
-
-argumentParser = argparse.ArgumentParser(
-                description='Compare the profiles of multiple .gpx files')
-argumentParser.add_argument('inputFilenames', type=str, help='Input Filenames', nargs='*')
-argumentParser.add_argument('--apiKey', "-a", type=str, help='Google Maps API Key')
-argumentParser.add_argument('--interpolationResolution', "-r", type=int, help='Resolution of the interpolation in meter (defaults to 100m)')
-argumentParser.add_argument('--startDistance', "-start", type=int, help='Trims everything before the start distance (default 0m)')
-argumentParser.add_argument('--stopDistance', "-stop", type=int, help='Trims everything after the stop distance')
-
-commandlineArguments = argumentParser.parse_args()
-
-inputFilenames = commandlineArguments.inputFilenames
-apiKey = commandlineArguments.apiKey
-interpolationResolution = commandlineArguments.interpolationResolution
-startDistance = commandlineArguments.startDistance
-stopDistance = commandlineArguments.stopDistance
-
-
-# If the interpolation resolution was left out, set it to 100m
-if interpolationResolution is None:
-    interpolationResolution = 100
-
-if startDistance is None:
-    startDistance = 0
-if stopDistance is None:
-    stopDistance = 0
-
-print "Parsing..."
-
-profiles = []
-for filename in inputFilenames:
-    print "Parsing " + filename + "..."
-    gpxCourse = ParseGpxFile(filename)
-    print "    Interpolating..."
-    gpxCourse = gpxCourse.InterpolateToGivenResolution(interpolationResolution)
-    if startDistance > 0 or stopDistance > 0:
-        print "    Trimming..."
-        if stopDistance == 0:
-            stopDistance = sys.maxint
-        gpxCourse = gpxCourse.PruneDistance(stopDistance, startDistance)
-
-    if apiKey:
-        print "    Getting all the elevation data from google..."
-        gpxCourse = gpxCourse.CorrectElevation(apiKey)
-
-    profile = gpxCourse.CreateEquidistantProfile(interpolationResolution)
-
-    if profile.GetElevationGain() == 0 and apiKey is None:
-        print "Elevation data seems to be missing from " + filename + ". You would need an API key to retrieve this info from the internet."
-
-    profiles.append(profile)
-
-PlotProfiles(profiles, 0)
-
-print "Done!!!"
-
-raw_input("Press Enter to continue...")
\ No newline at end of file
+from GpxPlot import *
+from ConvertGpxToTcx import FindGpxFiles
+
+
+# The outcome of loading the profile of a single file. The profile is None and the error is set if the loading failed
+# The cache statistics are (hits, misses) tuples, or None without the cache
+# The instrumentation is the GetInstrumentation().ToDict() of the loading, if the instrumentation is enabled
+ProfileResult = namedtuple("ProfileResult", ["inputFilename", "profile", "seconds", "error", "courseCacheStatistics",
+                                             "elevationCacheStatistics", "instrumentation"])
+
+
+def _LoadProfile(job):
+    '''Load the profile of one file for LoadProfiles. Never raises, the error is returned in the result instead'''
+    inputFilename, elevationCacheFilename, courseCacheDirectory, profileOptions, _ = job
+    startTime = time.time()
+    courseCache = CourseCache(courseCacheDirectory) if courseCacheDirectory else None
+    statistics = {}
+    try:
+        _, profile = ProcessGpxFile(inputFilename, elevationCacheFilename=elevationCacheFilename,
+                                    courseCache=courseCache, withGpxCourse=False, statistics=statistics,
+                                    **profileOptions)
+        error = None
+    except Exception as exception:
+        profile = None
+        error = exception.__class__.__name__ + ": " + str(exception)
+    return ProfileResult(inputFilename, profile, time.time() - startTime, error,
+                         None if courseCache is None else (courseCache.hits, courseCache.misses),
+                         statistics.get("elevationCache"), None)
+
+
+def _LoadProfileInWorker(job):
+    '''Worker of LoadProfiles, which also sends back the instrumentation of the job'''
+    _, _, _, _, instrumentationEnabled = job
+    instrumentation = StartJobInstrumentation(instrumentationEnabled)
+    result = _LoadProfile(job)
+    return result._replace(instrumentation=instrumentation.ToDict() if instrumentation.enabled else None)
+
+
+def LoadProfiles(inputFilenames, numberOfProcesses=None, elevationCacheFilename=None, courseCacheDirectory=None,
+                 **profileOptions):
+    '''
+        Load the profiles of all the files over a pool of worker processes (in this process for a single file or
+        process). One file failing does not stop the others. The profile options are the keyword arguments of
+        ProcessGpxFile. Returns a list of ProfileResults in the same order as the input filenames
+    '''
+    instrumentationEnabled = GetInstrumentation().enabled
+    jobs = [(inputFilename, elevationCacheFilename, courseCacheDirectory, profileOptions, instrumentationEnabled)
+            for inputFilename in inputFilenames]
+
+    numberOfProcesses = min(numberOfProcesses or multiprocessing.cpu_count(), len(jobs))
+    pool = multiprocessing.Pool(numberOfProcesses) if numberOfProcesses > 1 else None
+    results = []
+    try:
+        for result in pool.imap(_LoadProfileInWorker, jobs) if pool is not None else itertools.imap(_LoadProfile, jobs):
+            if result.error is None:
+                print "Loaded %s (%d profile points, %.2fs)" % (result.inputFilename,
+                                                                result.profile.GetNumberOfPoints(), result.seconds)
+            else:
+                print "FAILED %s: %s" % (result.inputFilename, result.error)
+            if result.instrumentation is not None:
+                GetInstrumentation().Merge(result.instrumentation)
+            results.append(result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return results
+
+
+def _SumCacheStatistics(statistics):
+    '''Add up the (hits, misses) of the results, or None if none of them used the cache'''
+    statistics = [statistic for statistic in statistics if statistic is not None]
+    if not statistics:
+        return None
+    return sum(hits for hits, _ in statistics), sum(misses for _, misses in statistics)
+
+
+def PrintProfileDifferences(inputFilenames, differences):
+    '''Print the gain of every profile and a table with the differences between every pair of profiles'''
+    names = [os.path.basename(inputFilename) for inputFilename in inputFilenames]
+    nameWidth = max(len(name) for name in names + ["Profile"])
+
+    print
+    # The mean RMSE to all the other profiles shows which recording is the odd one out
+    meanRmse = differences["rmse"].sum(axis=1) / max(len(names) - 1, 1)
+    print "%-*s  %8s  %14s" % (nameWidth, "Profile", "Gain (m)", "Mean RMSE (m)")
+    for name, gain, rmse in zip(names, differences["gains"], meanRmse):
+        print "%-*s  %8.1f  %14.2f" % (nameWidth, name, gain, rmse)
+
+    print
+    print "%-*s  %-*s  %8s  %8s  %8s  %8s" % (nameWidth, "Profile", nameWidth, "Other", "RMSE (m)", "Max (m)",
+                                              "Gain (m)", "Grad (%)")
+    for row in range(len(names)):
+        for column in range(row + 1, len(names)):
+            print "%-*s  %-*s  %8.2f  %8.2f  %8.1f  %8.2f" % (
+                nameWidth, names[row], nameWidth, names[column], differences["rmse"][row, column],
+                differences["maxDeviation"][row, column], differences["gainDifference"][row, column],
+                differences["gradientDifference"][row, column])
+
+
+def SaveProfileDifferences(filename, inputFilenames, distances, differences, gradientDistance):
+    '''Save the differences between the profiles (see GetProfileDifferences) to a JSON file'''
+    data = {"profiles": inputFilenames, "comparedDistance": float(distances[-1]),
+            "gradientDistance": gradientDistance}
+    data.update((name, values.tolist()) for name, values in differences.items())
+    with open(filename, "w") as jsonFile:
+        json.dump(data, jsonFile, indent=2, sort_keys=True)
+    return filename
+
+
+def main():
+    argumentParser = argparse.ArgumentParser(
+                    description='Compare the profiles of multiple .gpx files')
+    argumentParser.add_argument('inputFilenames', type=str, help='Input Filenames, directories or glob patterns', nargs='*')
+    argumentParser.add_argument('--apiKey', "-a", type=str, help='Google Maps API Key')
+    argumentParser.add_argument('--interpolationResolution', "-r", type=float, help='Resolution of the interpolation in meter (defaults to 100m)')
+    argumentParser.add_argument('--smoothing', type=str, choices=SMOOTHING_METHODS, help='Smooth the elevations of the profile to get rid of gps jitter')
+    argumentParser.add_argument('--smoothingWindow', type=int, default=5, help='Number of profile points in the smoothing window, odd except for lowPass (defaults to 5)')
+    argumentParser.add_argument('--simplify', type=float, metavar='TOLERANCE', help='Remove the gps points that are not needed to keep the shape of the course within this many meters, before interpolating')
+    argumentParser.add_argument('--simplifyMethod', type=str, choices=SIMPLIFICATION_METHODS, default="douglasPeucker", help='Algorithm used to simplify the course (defaults to douglasPeucker)')
+    argumentParser.add_argument('--simplifyWithElevation', action='store_true', help='Flag without a value to also keep the shape of the elevation when simplifying')
+    argumentParser.add_argument('--startDistance', "-start", type=int, help='Trims everything before the start distance (default 0m)')
+    argumentParser.add_argument('--stopDistance', "-stop", type=int, help='Trims everything after the stop distance')
+    argumentParser.add_argument('--jobs', "-j", type=int, help='Number of worker processes that load the files (defaults to the number of CPUs)')
+    argumentParser.add_argument('--elevationCache', "-c", type=str, default=DEFAULT_ELEVATION_CACHE_FILENAME, help='File in which the elevations from google are cached (defaults to ~/.GpxElevationCache.sqlite)')
+    argumentParser.add_argument('--noElevationCache', action='store_true', help='Flag without a value to always get all the elevations from google')
+    argumentParser.add_argument('--courseCache', type=str, default=DEFAULT_COURSE_CACHE_DIRECTORY, help='Directory in which the processed courses are cached (defaults to ~/.GpxCourseCache)')
+    argumentParser.add_argument('--noCourseCache', action='store_true', help='Flag without a value to always process the gpx files again')
+    argumentParser.add_argument('--srtmDirectory', "-s", type=str, help='Directory with SRTM .hgt tiles to get the elevations from, instead of google')
+    argumentParser.add_argument('--profile', type=str, nargs='?', const='', metavar='JSONFILE', help='Print the time and number of points of every stage, or save them to the given JSON file')
+    argumentParser.add_argument('--gradientDistance', type=float, default=1000, help='Distance in meter over which the gradients are compared (defaults to 1000m)')
+    argumentParser.add_argument('--json', type=str, metavar='JSONFILE', help='Save the differences between the profiles to the given JSON file')
+    argumentParser.add_argument('--plotFilename', "-f", type=str, help='Save the plot to the given .png or .svg file instead of showing it')
+    argumentParser.add_argument('--noPlot', action='store_true', help='Flag without a value to only print the differences, without plotting the profiles')
+
+    commandlineArguments = argumentParser.parse_args()
+
+    inputFilenames = FindGpxFiles(commandlineArguments.inputFilenames)
+    apiKey = commandlineArguments.apiKey
+    interpolationResolution = commandlineArguments.interpolationResolution
+    startDistance = commandlineArguments.startDistance
+    simplifyTolerance = commandlineArguments.simplify
+    simplifyMethod = commandlineArguments.simplifyMethod
+    simplifyWithElevation = commandlineArguments.simplifyWithElevation
+    smoothing = commandlineArguments.smoothing
+    smoothingWindow = commandlineArguments.smoothingWindow
+    stopDistance = commandlineArguments.stopDistance
+    jobs = commandlineArguments.jobs
+    elevationCacheFilename = None if commandlineArguments.noElevationCache else commandlineArguments.elevationCache
+    srtmDirectory = commandlineArguments.srtmDirectory
+    courseCacheDirectory = None if commandlineArguments.noCourseCache else commandlineArguments.courseCache
+    gradientDistance = commandlineArguments.gradientDistance
+    jsonFilename = commandlineArguments.json
+    plotFilename = commandlineArguments.plotFilename
+    plot = not commandlineArguments.noPlot
+    profileFilename = commandlineArguments.profile
+
+    if profileFilename is not None:
+        GetInstrumentation().Enable()
+
+    # If the interpolation resolution was left out, set it to 100m
+    if interpolationResolution is None:
+        interpolationResolution = 100
+
+    if startDistance is None:
+        startDistance = 0
+    if stopDistance is None:
+        stopDistance = 0
+
+    print "Loading " + str(len(inputFilenames)) + " files..."
+    startTime = time.time()
+    results = LoadProfiles(inputFilenames, jobs, elevationCacheFilename, courseCacheDirectory,
+                           interpolationResolution=interpolationResolution, startDistance=startDistance,
+                           stopDistance=stopDistance, apiKey=apiKey, srtmDirectory=srtmDirectory,
+                           simplifyTolerance=simplifyTolerance, simplifyMethod=simplifyMethod,
+                           simplifyWithElevation=simplifyWithElevation, smoothing=smoothing,
+                           smoothingWindow=smoothingWindow)
+    print "Loaded %d of %d files in %.2fs" % (len([result for result in results if result.error is None]),
+                                              len(results), time.time() - startTime)
+
+    courseCacheStatistics = _SumCacheStatistics(result.courseCacheStatistics for result in results)
+    if courseCacheStatistics is not None:
+        print "Course cache: %d hits, %d misses" % courseCacheStatistics
+    elevationCacheStatistics = _SumCacheStatistics(result.elevationCacheStatistics for result in results)
+    if elevationCacheStatistics is not None:
+        print "Elevation cache: %d hits, %d misses" % elevationCacheStatistics
+
+    results = [result for result in results if result.error is None]
+    profiles = [result.profile for result in results]
+    loadedFilenames = [result.inputFilename for result in results]
+
+    for inputFilename, profile in zip(loadedFilenames, profiles):
+        if profile.GetElevationGain() == 0 and apiKey is None and srtmDirectory is None:
+            print "Elevation data seems to be missing from " + inputFilename + ". You would need an API key to retrieve this info from the internet."
+
+    if len(profiles) > 1:
+        distances, elevations = ResampleProfiles(profiles, interpolationResolution)
+        differences = GetProfileDifferences(distances, elevations, gradientDistance)
+        print "Compared the first %.0fm of %d profiles" % (distances[-1], len(profiles))
+        PrintProfileDifferences(loadedFilenames, differences)
+        if jsonFilename:
+            print "Saved the differences to " + SaveProfileDifferences(jsonFilename, loadedFilenames, distances,
+                                                                       differences, gradientDistance)
+
+    if profileFilename is not None:
+        GetInstrumentation().Report(profileFilename)
+
+    if plot and profiles:
+        if plotFilename:
+            print "Saved the plot to " + SaveProfilesPlot(profiles, plotFilename)
+        else:
+            PlotProfiles(profiles, 0)
+
+    print "Done!!!"
+
+    # Only wait for user input if the plot is shown
+    if plot and profiles and not plotFilename:
+        raw_input("Press Enter to continue...")
+
+    if len(profiles) < len(inputFilenames):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+# (c) 2018 Phillip Myburgh
+# Distributed under the MIT Licence
+
+# A local HTTP service which converts gpx files to tcx workouts with a pool of worker processes that are started
+# (and have GpxLib, numpy and lxml loaded) before the first request comes in.
+#
+#   POST /convert?<options>   The body is the gpx file. Returns the tcx file, or with summary=1 a JSON object with
+#                             the tcx and a summary of the course
+#   GET  /metrics             JSON with the number of requests, the queue and the latencies
+#   GET  /health              Returns OK
+
+
+import os
+import json
+import math
+import shutil
+import tempfile
+import threading
+import time
+import urlparse
+import collections
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+# To parse command line arguments
+import argparse
+
+from GpxLib import *
+from ConvertGpxToTcx import ConvertGpxFile
+
+
+# The request options, with the type they are converted to. Everything else is set when the server is started
+REQUEST_OPTIONS = {"interpolationResolution": float, "startDistance": float, "stopDistance": float,
+                   "smoothing": str, "smoothingWindow": int, "simplifyTolerance": float, "simplifyMethod": str,
+                   "simplifyWithElevation": bool, "maxElevationError": float, "slopeStep": float, "compact": bool}
+
+DEFAULT_PORT = 8947
+
+# The number of latencies the percentiles in the metrics are calculated over
+LATENCY_WINDOW = 1000
+
+
+class RequestError(Exception):
+    '''Raised when a request cannot be handled, with the HTTP status code to answer with'''
+    def __init__(self, statusCode, message):
+        Exception.__init__(self, message)
+        self.statusCode = statusCode
+
+
+def ParseRequestOptions(query):
+    '''
+        Convert the query string of a convert request to the keyword arguments of ConvertGpxFile.
+        Raises a RequestError for unknown options and invalid values
+    '''
+    options = {"interpolationResolution": 100.0, "startDistance": 0, "stopDistance": 0}
+    for option, values in urlparse.parse_qs(query).items():
+        if option in ("summary", "name"):
+            continue
+        if option not in REQUEST_OPTIONS:
+            raise RequestError(400, "Unknown option " + option)
+        optionType = REQUEST_OPTIONS[option]
+        try:
+            if optionType is bool:
+                options[option] = values[-1].lower() in ("1", "true", "yes")
+            else:
+                options[option] = optionType(values[-1])
+        except ValueError:
+            raise RequestError(400, "Invalid value for " + option + ": " + values[-1])
+        if optionType is float and (math.isnan(options[option]) or options[option] < 0):
+            raise RequestError(400, option + " cannot be negative")
+
+    if options["interpolationResolution"] <= 0:
+        raise RequestError(400, "interpolationResolution has to be larger than 0")
+    if options.get("smoothing") is not None and options["smoothing"] not in SMOOTHING_METHODS:
+        raise RequestError(400, "smoothing has to be one of " + ", ".join(SMOOTHING_METHODS))
+    if options.get("simplifyMethod") is not None and options["simplifyMethod"] not in SIMPLIFICATION_METHODS:
+        raise RequestError(400, "simplifyMethod has to be one of " + ", ".join(SIMPLIFICATION_METHODS))
+    return options
+
+
+def _WarmUpWorker():
+    '''Run a tiny conversion in every new worker, so the first real request does not pay for the first use'''
+    directory = tempfile.mkdtemp()
+    try:
+        gpxCourse = GpxCourse.FromArrays([-26.0, -26.001, -26.002], [28.0, 28.0, 28.0], [1500.0, 1501.0, 1499.0])
+        gpxFilename = WriteGpxFile(gpxCourse, os.path.join(directory, "warmup.gpx"))
+        ConvertGpxFile(gpxFilename, os.path.join(directory, "warmup"), None, 10, 0, 0, verbose=False)
+    finally:
+        shutil.rmtree(directory)
+
+
+def _ConvertInWorker(job):
+    '''
+        Convert the gpx data in a worker process. Returns a (tcx data, summary, error) tuple, never raises so the
+        error can be reported to the client
+    '''
+    gpxData, workoutName, conversionOptions = job
+    directory = tempfile.mkdtemp()
+    try:
+        gpxFilename = os.path.join(directory, "upload.gpx")
+        with open(gpxFilename, "wb") as gpxFile:
+            gpxFile.write(gpxData)
+        summary = {}
+        conversionOptions.setdefault("apiKey", None)
+        ConvertGpxFile(gpxFilename, os.path.join(directory, "workout"), workoutName=workoutName, verbose=False,
+                       summary=summary, **conversionOptions)
+        with open(os.path.join(directory, "workout.tcx"), "rb") as tcxFile:
+            return tcxFile.read(), summary, None
+    except Exception as exception:
+        return None, None, exception.__class__.__name__ + ": " + str(exception)
+    finally:
+        shutil.rmtree(directory)
+
+
+class ServerMetrics:
+    '''Thread safe request counters and latencies of the conversion server'''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.startTime = time.time()
+        self.counters = collections.Counter()
+        self.inProgress = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+
+    def Count(self, name, count=1):
+        with self.__lock:
+            self.counters[name] += count
+
+
+    def Start(self):
+        with self.__lock:
+            self.counters["requests"] += 1
+            self.inProgress += 1
+
+
+    def Stop(self, seconds, numberOfPoints=0, succeeded=True):
+        with self.__lock:
+            self.inProgress -= 1
+            self.counters["succeeded" if succeeded else "failed"] += 1
+            self.counters["points"] += numberOfPoints
+            self.latencies.append(seconds)
+
+
+    def ToDict(self, numberOfWorkers):
+        with self.__lock:
+            uptime = time.time() - self.startTime
+            latencies = sorted(self.latencies)
+            metrics = dict(self.counters)
+            metrics.update(uptime=uptime, inProgress=self.inProgress,
+                           queued=max(0, self.inProgress - numberOfWorkers), workers=numberOfWorkers,
+                           throughput=self.counters["succeeded"] / max(uptime, 1e-9),
+                           pointsPerSecond=self.counters["points"] / max(uptime, 1e-9))
+
+        if latencies:
+            def Percentile(percentile):
+                return latencies[min(len(latencies) - 1, int(percentile / 100.0 * len(latencies)))]
+            metrics["latency"] = {"mean": sum(latencies) / len(latencies), "p50": Percentile(50),
+                                  "p95": Percentile(95), "p99": Percentile(99), "max": latencies[-1]}
+        return metrics
+
+
+class ConversionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+        HTTP server which hands the conversions to a pool of numberOfWorkers worker processes. At most maxQueueLength
+        requests wait for a worker, the rest are turned away straight away with 503.
+        The conversion options (e.g. apiKey, srtmDirectory and courseCacheDirectory) are used for every request, on
+        top of the options of the request itself
+    '''
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", DEFAULT_PORT), numberOfWorkers=None, maxQueueLength=16,
+                 maxUploadBytes=64 * 1024 * 1024, requestTimeout=300, **conversionOptions):
+        self.numberOfWorkers = numberOfWorkers or multiprocessing.cpu_count()
+        self.maxUploadBytes = maxUploadBytes
+        self.requestTimeout = requestTimeout
+        self.conversionOptions = conversionOptions
+        self.verbose = False
+        self.metrics = ServerMetrics()
+        # A slot for every worker and every place in the queue
+        self.slots = threading.BoundedSemaphore(self.numberOfWorkers + maxQueueLength)
+        # Start the workers before the server starts listening, so they are warm before the first request
+        self.pool = multiprocessing.Pool(self.numberOfWorkers, _WarmUpWorker)
+        BaseHTTPServer.HTTPServer.__init__(self, address, ConversionRequestHandler)
+        self.url = "http://%s:%d" % self.server_address[:2]
+
+
+    def Convert(self, gpxData, workoutName, requestOptions):
+        '''
+            Convert the gpx data on one of the workers. Returns the (tcx data, summary) tuple.
+            Raises a RequestError if the queue is full or the conversion fails
+        '''
+        if not self.slots.acquire(False):
+            self.metrics.Count("rejected")
+            raise RequestError(503, "The conversion queue is full, try again later")
+        # The slot is given back when the worker is done, not when the request is, so a request that timed out keeps
+        # its slot until its conversion has finished and the pool is never given more than the slots allow.
+        # _ConvertInWorker never raises, so the callback is always called
+        try:
+            conversionOptions = dict(self.conversionOptions, **requestOptions)
+            asyncResult = self.pool.apply_async(_ConvertInWorker, [(gpxData, workoutName, conversionOptions)],
+                                                callback=lambda _: self.slots.release())
+        except:
+            self.slots.release()
+            raise
+        try:
+            tcxData, summary, error = asyncResult.get(self.requestTimeout)
+        except multiprocessing.TimeoutError:
+            self.metrics.Count("timedOut")
+            raise RequestError(504, "The conversion took longer than " + str(self.requestTimeout) + " seconds")
+        if error is not None:
+            raise RequestError(422, error)
+        return tcxData, summary
+
+
+    def Close(self):
+        '''Stop serving and stop the workers'''
+        self.shutdown()
+        self.server_close()
+        self.pool.close()
+        self.pool.join()
+
+
+class ConversionRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def __SendResponse(self, statusCode, data, contentType):
+        self.send_response(statusCode)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data)))
+        if statusCode == 503:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def __SendJson(self, statusCode, value):
+        self.__SendResponse(statusCode, json.dumps(value, sort_keys=True), "application/json")
+
+
+    def do_GET(self):
+        path = urlparse.urlsplit(self.path).path
+        if path == "/metrics":
+            self.__SendJson(200, self.server.metrics.ToDict(self.server.numberOfWorkers))
+        elif path == "/health":
+            self.__SendResponse(200, "OK", "text/plain")
+        else:
+            self.__SendJson(404, {"error": "Unknown path " + path})
+
+
+    def do_POST(self):
+        startTime = time.time()
+        path, query = urlparse.urlsplit(self.path)[2:4]
+        self.server.metrics.Start()
+        numberOfPoints = 0
+        succeeded = False
+        try:
+            if path != "/convert":
+                raise RequestError(404, "Unknown path " + path)
+            try:
+                contentLength = int(self.headers["Content-Length"])
+            except (KeyError, ValueError):
+                # Without a valid length the body cannot be told apart from the next request
+                self.close_connection = 1
+                raise RequestError(400, "The request needs a valid Content-Length header")
+            if contentLength < 0:
+                self.close_connection = 1
+                raise RequestError(400, "The request needs a valid Content-Length header")
+            if contentLength > self.server.maxUploadBytes:
+                # Do not read the upload, and close the connection so the rest of it is not read as the next request
+                self.close_connection = 1
+                raise RequestError(413, "The gpx file is larger than " + str(self.server.maxUploadBytes) + " bytes")
+            gpxData = self.rfile.read(contentLength)
+            if not gpxData:
+                raise RequestError(400, "The body of the request has to be the gpx file")
+
+            parameters = urlparse.parse_qs(query)
+            requestOptions = ParseRequestOptions(query)
+            workoutName = parameters.get("name", ["Workout"])[-1]
+            tcxData, summary = self.server.Convert(gpxData, workoutName, requestOptions)
+            numberOfPoints = summary["numberOfPoints"]
+
+            if parameters.get("summary", ["0"])[-1].lower() in ("1", "true", "yes"):
+                self.__SendJson(200, {"summary": summary, "tcx": tcxData})
+            else:
+                self.__SendResponse(200, tcxData, "application/vnd.garmin.tcx+xml")
+            succeeded = True
+        except RequestError as error:
+            self.__SendJson(error.statusCode, {"error": str(error)})
+        except Exception as exception:
+            # Always logged, also without verbose
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, "Unexpected error: %s: %s",
+                                                              exception.__class__.__name__, exception)
+            self.close_connection = 1
+            self.__SendJson(500, {"error": exception.__class__.__name__ + ": " + str(exception)})
+        finally:
+            self.server.metrics.Stop(time.time() - startTime, numberOfPoints, succeeded)
+
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def main():
+    argumentParser = argparse.ArgumentParser(
+                    description='Run a local HTTP service which converts .gpx files to slope workout files (.tcx)')
+    argumentParser.add_argument('--host', type=str, default="127.0.0.1", help='Address to listen on (defaults to 127.0.0.1, only this computer)')
+    argumentParser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on (defaults to %d)' % DEFAULT_PORT)
+    argumentParser.add_argument('--jobs', "-j", type=int, help='Number of worker processes (defaults to the number of CPUs)')
+    argumentParser.add_argument('--maxQueueLength', type=int, default=16, help='Number of requests that can wait for a worker, the rest are turned away (defaults to 16)')
+    argumentParser.add_argument('--apiKey', "-a", type=str, help='Google Maps API Key')
+    argumentParser.add_argument('--elevationCache', "-c", type=str, default=DEFAULT_ELEVATION_CACHE_FILENAME, help='File in which the elevations from google are cached (defaults to ~/.GpxElevationCache.sqlite)')
+    argumentParser.add_argument('--noElevationCache', action='store_true', help='Flag without a value to always get all the elevations from google')
+    argumentParser.add_argument('--courseCache', type=str, default=DEFAULT_COURSE_CACHE_DIRECTORY, help='Directory in which the processed courses are cached (defaults to ~/.GpxCourseCache)')
+    argumentParser.add_argument('--noCourseCache', action='store_true', help='Flag without a value to always process the uploads again')
+    argumentParser.add_argument('--srtmDirectory', "-s", type=str, help='Directory with SRTM .hgt tiles to get the elevations from, instead of google')
+    argumentParser.add_argument('--verbose', "-v", action='store_true', help='Flag without a value to log every request')
+
+    commandlineArguments = argumentParser.parse_args()
+
+    server = ConversionServer((commandlineArguments.host, commandlineArguments.port), commandlineArguments.jobs,
+                              commandlineArguments.maxQueueLength, apiKey=commandlineArguments.apiKey,
+                              elevationCacheFilename=None if commandlineArguments.noElevationCache else
+                                                     commandlineArguments.elevationCache,
+                              courseCacheDirectory=None if commandlineArguments.noCourseCache else
+                                                   commandlineArguments.courseCache,
+                              srtmDirectory=commandlineArguments.srtmDirectory)
+    server.verbose = commandlineArguments.verbose
+    print "Converting gpx files on " + server.url + "/convert with " + str(server.numberOfWorkers) + " workers..."
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.terminate()
+        server.pool.join()
+    print "Done!!!"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# (c) 2018 Phillip Myburgh
+# Distributed under the MIT Licence
+
+
+import os
+import time
+# To parse command line arguments
+import argparse
+
+from GpxLib import *
+
+
+def ConvertCourseFile(inputFilename, outputFilename=None):
+    '''
+        Convert a gpx file to a binary course file, or a binary course file back to a gpx file.
+        The output defaults to the input filename with the other extension. Returns the output filename
+    '''
+    toGpx = IsCourseFile(inputFilename)
+    if outputFilename is None:
+        outputFilename = os.path.splitext(inputFilename)[0] + (".gpx" if toGpx else COURSE_FILE_EXTENSION)
+
+    gpxCourse = LoadCourse(inputFilename)
+    if toGpx:
+        return WriteGpxFile(gpxCourse, outputFilename)
+    return SaveCourse(gpxCourse, outputFilename)
+
+
+def main():
+    argumentParser = argparse.ArgumentParser(
+                    description='Convert .gpx files to binary ' + COURSE_FILE_EXTENSION + ' files which load a lot '
+                                'faster in all the scripts, or convert ' + COURSE_FILE_EXTENSION + ' files back to .gpx')
+    argumentParser.add_argument('inputFilenames', type=str, nargs='+', help='Input Filenames')
+    argumentParser.add_argument('--outputFilename', "-o", type=str, help='Output Filename, only for a single input file (defaults to <inputFilename> with the other extension)')
+
+    commandlineArguments = argumentParser.parse_args()
+
+    inputFilenames = commandlineArguments.inputFilenames
+    outputFilename = commandlineArguments.outputFilename
+
+    if outputFilename is not None and len(inputFilenames) > 1:
+        print "The output filename can only be used with a single input file."
+        exit(2)
+
+    for inputFilename in inputFilenames:
+        startTime = time.time()
+        convertedFilename = ConvertCourseFile(inputFilename, outputFilename)
+        print "Converted %s -> %s (%.2fs)" % (inputFilename, convertedFilename, time.time() - startTime)
+
+    print "Done!!!"
+
+
+if __name__ == "__main__":
+    main()
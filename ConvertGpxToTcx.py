@@ -4,92 +4,337 @@
 
 import sys
 import os
+import glob
+import time
+import multiprocessing
+from collections import namedtuple
 # To parse command line arguments
 import argparse
 
 from GpxLib import *
+from GpxPlot import *
 
 
+# The outcome of converting a single file in batch mode. The error is None if the conversion succeeded
+# The instrumentation is the GetInstrumentation().ToDict() of the conversion, if the instrumentation is enabled
+ConversionResult = namedtuple("ConversionResult", ["inputFilename", "outputFilename", "numberOfPoints", "seconds",
+                                                   "error", "instrumentation"])
 
-argumentParser = argparse.ArgumentParser(
-                description='Convert a .gpx file to a slope workout file (.tcx)')
-argumentParser.add_argument('inputFilename', type=str, help='Input Filename')
-argumentParser.add_argument('--apiKey', "-a", type=str, help='Google Maps API Key')
-argumentParser.add_argument('--outputFilename', "-o", type=str, help='Output Filename (defaults to <inputFilename>.tcx')
-argumentParser.add_argument('--interpolationResolution', "-r", type=int, help='Resolution of the interpolation in meter (defaults to 100m)')
-argumentParser.add_argument('--startDistance', "-start", type=int, help='Trims everything before the start distance (default 0m)')
-argumentParser.add_argument('--stopDistance', "-stop", type=int, help='Trims everything after the stop distance')
-argumentParser.add_argument('--plot', "-p", action='store_true', help='Flag without a value to enable plotting')
 
-commandlineArguments = argumentParser.parse_args()
+def ConvertGpxFile(inputFilename, outputName, apiKey, interpolationResolution, startDistance, stopDistance,
+                   plot=False, verbose=True, elevationCacheFilename=None, srtmDirectory=None, compact=False,
+                   compress=False, plotFormat=None, smoothing=None, smoothingWindow=5, simplifyTolerance=None,
+                   simplifyMethod="douglasPeucker", simplifyWithElevation=False, maxElevationError=0, slopeStep=0,
+                   processes=1, courseCacheDirectory=None, workoutName=None, summary=None, outputFormat="tcx"):
+    '''
+        Run the whole conversion of one gpx file and write outputName.tcx (outputName.tcx.gz if compress is set), or
+        outputName.fit if the output format is fit.
+        If a plot format (e.g. png or svg) is given, the profile and slope plots are saved next to the output as
+        outputName_profile.<plotFormat> and outputName_slope.<plotFormat>.
+        smoothing is one of SMOOTHING_METHODS, to smooth the elevations over smoothingWindow profile points.
+        If a simplify tolerance is given, the course is simplified (see GpxCourse.Simplify) before interpolating.
+        maxElevationError and slopeStep are passed on to SlopeCourse.Compress.
+        The segments of the course are simplified and interpolated over this many worker processes.
+        If a course cache directory is given, the processed course and profile are taken from the CourseCache when the
+        same file was converted with the same options before.
+        workoutName is the name of the course in the workout file, which defaults to the outputName.
+        If a summary dictionary is given, the statistics of the course and the workout are stored in it.
+        Returns the number of gps points after interpolation
+    '''
+    courseCache = CourseCache(courseCacheDirectory) if courseCacheDirectory else None
+    gpxCourse, profile = ProcessGpxFile(inputFilename, interpolationResolution, startDistance, stopDistance, apiKey,
+                                        elevationCacheFilename, srtmDirectory, simplifyTolerance, simplifyMethod,
+                                        simplifyWithElevation, smoothing, smoothingWindow, processes, courseCache,
+                                        verbose=verbose)
 
-inputFilename = commandlineArguments.inputFilename
-outputFilename = commandlineArguments.outputFilename
-apiKey = commandlineArguments.apiKey
-interpolationResolution = commandlineArguments.interpolationResolution
-startDistance = commandlineArguments.startDistance
-stopDistance = commandlineArguments.stopDistance
-plot = commandlineArguments.plot
+    if verbose and profile.GetElevationGain() == 0 and apiKey is None and srtmDirectory is None:
+        print "Elevation data seems to be missing from " + inputFilename + ". You would need an API key to retrieve " \
+              "this info from the internet."
 
-inputFilenameNoExtension = os.path.splitext(inputFilename)[0]
+    if plot:
+        PlotProfile(profile, 0, "Course Profile")
+    if plotFormat:
+        SaveProfilePlot(profile, outputName + "_profile." + plotFormat, title="Course Profile")
 
-# if no output filename is given, we use the input filename
-if outputFilename is None:
-    outputFilename = inputFilenameNoExtension
+    slopeCourse = profile.CreateSlopeCourse()
+    if plot:
+        PlotSlope(slopeCourse, 0, "Course Slope")
+    if plotFormat:
+        SaveSlopePlot(slopeCourse, outputName + "_slope." + plotFormat, title="Course Slope")
 
-# Strip the extension of the output filename, we only need the name
-outputName = outputFilename.replace(".tcx", "")
+    # Remove the duplicates etc...
+    compressedSlopeCourse = slopeCourse.Compress(maxElevationError, slopeStep)
+    if verbose or summary is not None:
+        compressionError = GetMaxElevationError(slopeCourse, compressedSlopeCourse)
+    if verbose:
+        print "Compressed " + str(slopeCourse.GetNumberOfPoints()) + " slope points to " + \
+              str(compressedSlopeCourse.GetNumberOfPoints()) + " (max elevation error %.2fm)..." % compressionError
+    slopeCourse = compressedSlopeCourse
 
-# If the interpolation resolution was left out, set it to 100m
-if interpolationResolution is None:
-    interpolationResolution = 100
+    if summary is not None:
+        summary.update(name=profile.GetName(), numberOfPoints=gpxCourse.GetNumberOfPoints(),
+                       totalDistance=profile.GetTotalDistance(), elevationGain=profile.GetElevationGain(),
+                       highestElevation=profile.GetHighestElevation(), lowestElevation=profile.GetLowestElevation(),
+                       numberOfSlopePoints=slopeCourse.GetNumberOfPoints(), maxElevationError=compressionError)
 
-if startDistance is None:
-    startDistance = 0
-if stopDistance is None:
-    stopDistance = 0
+    if verbose:
+        print "Building output..."
+    GenerateSlopeWorkout(slopeCourse, outputName, outputFormat, compact=compact, compress=compress, name=workoutName,
+                         profile=profile)
 
-print "Parsing ", inputFilename, "..."
+    return gpxCourse.GetNumberOfPoints()
 
-gpxCourse = ParseGpxFile(inputFilename)
 
-print "There are " + str(gpxCourse.GetNumberOfPoints()) + " gps points..."
-print "Interpolating..."
+def _ConvertGpxFileInBatch(job):
+    '''Worker for the batch mode. Never raises, the error is returned in the result instead'''
+    inputFilename, outputName, conversionOptions, instrumentationEnabled = job
+    instrumentation = StartJobInstrumentation(instrumentationEnabled)
+    startTime = time.time()
+    try:
+        numberOfPoints = ConvertGpxFile(inputFilename, outputName, verbose=False, **conversionOptions)
+        error = None
+    except Exception as exception:
+        numberOfPoints = 0
+        error = exception.__class__.__name__ + ": " + str(exception)
+    outputFilename = GetWorkoutFilename(outputName, conversionOptions.get("outputFormat", "tcx"),
+                                        conversionOptions.get("compress", False))
+    return ConversionResult(inputFilename, outputFilename, numberOfPoints, time.time() - startTime, error,
+                            instrumentation.ToDict() if instrumentation.enabled else None)
 
-gpxCourse = gpxCourse.InterpolateToGivenResolution(interpolationResolution)
 
-if startDistance > 0 or stopDistance > 0:
-    print "Trimming..."
-    if stopDistance == 0:
-        stopDistance = sys.maxint
-    gpxCourse = gpxCourse.PruneDistance(stopDistance, startDistance)
+def FindGpxFiles(inputPaths):
+    '''Expand the given files, directories and glob patterns to a sorted list of gpx (and binary course) files'''
+    gpxFiles = []
+    for inputPath in inputPaths:
+        if os.path.isdir(inputPath):
+            gpxFiles.extend(os.path.join(inputPath, filename) for filename in os.listdir(inputPath)
+                            if filename.lower().endswith((".gpx", COURSE_FILE_EXTENSION)))
+        elif glob.has_magic(inputPath):
+            gpxFiles.extend(filename for filename in glob.glob(inputPath) if os.path.isfile(filename))
+        else:
+            gpxFiles.append(inputPath)
+    return sorted(set(gpxFiles))
 
-print "There are " + str(gpxCourse.GetNumberOfPoints()) + " gps points after interpolation..."
 
-if apiKey:
-    print "Getting all the elevation data from google..."
-    gpxCourse = gpxCourse.CorrectElevation(apiKey)
+def GetBatchOutputNames(inputFilenames, outputDirectory):
+    '''
+        The outputName of every input file of the batch mode, as a list of (inputFilename, outputName) pairs in the
+        order of the input filenames. A gpx file with a binary course file of the same name next to it (as written by
+        ConvertCourseFile) would be converted to the same workout, so only the course file is converted.
+        Raises a ValueError if any other files would be converted to the same workout, e.g. files with the same name
+        in different directories and one output directory
+    '''
+    outputNames = []
+    outputNameIndexes = {}
+    for inputFilename in inputFilenames:
+        outputName = os.path.splitext(inputFilename)[0]
+        if outputDirectory is not None:
+            outputName = os.path.join(outputDirectory, os.path.basename(outputName))
+        key = os.path.normcase(os.path.abspath(outputName))
+        if key not in outputNameIndexes:
+            outputNameIndexes[key] = len(outputNames)
+            outputNames.append((inputFilename, outputName))
+            continue
 
-profile = gpxCourse.CreateEquidistantProfile(interpolationResolution)
+        otherFilename = outputNames[outputNameIndexes[key]][0]
+        isCourseFile = inputFilename.lower().endswith(COURSE_FILE_EXTENSION)
+        if isCourseFile != otherFilename.lower().endswith(COURSE_FILE_EXTENSION) and \
+                os.path.normcase(os.path.abspath(os.path.splitext(inputFilename)[0])) == \
+                os.path.normcase(os.path.abspath(os.path.splitext(otherFilename)[0])):
+            gpxFilename, courseFilename = (otherFilename, inputFilename) if isCourseFile else (inputFilename,
+                                                                                               otherFilename)
+            print "Skipping %s, %s is converted instead" % (gpxFilename, courseFilename)
+            outputNames[outputNameIndexes[key]] = (courseFilename, outputName)
+        else:
+            raise ValueError("%s and %s would both be converted to %s" % (otherFilename, inputFilename, outputName))
+    return outputNames
 
-if profile.GetElevationGain() == 0 and apiKey is None:
-    print "Elevation data seems to be missing. You would need an API key to retrieve this info from the internet."
 
-if plot:
-    PlotProfile(profile, 0, "Course Profile")
+def ConvertGpxFilesInBatch(inputFilenames, outputDirectory, numberOfProcesses=None, **conversionOptions):
+    '''
+        Convert all the given gpx files over a pool of worker processes. One file failing does not stop the others.
+        The conversion options are the keyword arguments of ConvertGpxFile.
+        Returns a list of ConversionResults in the same order as the input filenames, without the gpx files that are
+        skipped for a course file of the same name (see GetBatchOutputNames)
+    '''
+    instrumentationEnabled = GetInstrumentation().enabled
+    jobs = [(inputFilename, outputName, conversionOptions, instrumentationEnabled)
+            for inputFilename, outputName in GetBatchOutputNames(inputFilenames, outputDirectory)]
 
-slopeCourse = profile.CreateSlopeCourse()
-if plot:
-    PlotSlope(slopeCourse, 0, "Course Slope")
+    print "Converting " + str(len(jobs)) + " files..."
+    results = []
+    pool = multiprocessing.Pool(numberOfProcesses)
+    try:
+        for result in pool.imap(_ConvertGpxFileInBatch, jobs):
+            if result.error is None:
+                print "Converted %s -> %s (%d points, %.2fs)" % (result.inputFilename, result.outputFilename,
+                                                               result.numberOfPoints, result.seconds)
+            else:
+                print "FAILED %s: %s" % (result.inputFilename, result.error)
+            if result.instrumentation is not None:
+                GetInstrumentation().Merge(result.instrumentation)
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
 
-# Remove the duplicates etc...
-slopeCourse = slopeCourse.Compress()
+    return results
 
-print "Building output..."
-GenerateTcxSlopeWorkout(slopeCourse, outputName)
 
-print "Done!!!"
+def PrintBatchSummary(results, seconds):
+    failedResults = [result for result in results if result.error is not None]
+    totalPoints = sum(result.numberOfPoints for result in results)
+    print "Converted %d of %d files in %.2fs (%.2f files/s, %d points/s)" % (
+        len(results) - len(failedResults), len(results), seconds, len(results) / max(seconds, 1e-9),
+        totalPoints / max(seconds, 1e-9))
+    for result in failedResults:
+        print "    Failed: " + result.inputFilename
 
-# Only wait for user input if plots are enabled
-if plot:
-    raw_input("Press Enter to continue...")
\ No newline at end of file
+
+def main():
+    argumentParser = argparse.ArgumentParser(
+                    description='Convert .gpx files to slope workout files (.tcx or .fit)')
+    argumentParser.add_argument('inputFilenames', type=str, nargs='+',
+                                help='Input Filename. Directories and glob patterns (e.g. "races/*.gpx") are '
+                                     'converted in batch mode')
+    argumentParser.add_argument('--apiKey', "-a", type=str, help='Google Maps API Key')
+    argumentParser.add_argument('--outputFilename', "-o", type=str, help='Output Filename (defaults to <inputFilename>.tcx or .fit)')
+    argumentParser.add_argument('--outputDirectory', "-d", type=str, help='Output directory for batch mode (defaults to the directory of each input file)')
+    argumentParser.add_argument('--interpolationResolution', "-r", type=float, help='Resolution of the interpolation in meter (defaults to 100m)')
+    argumentParser.add_argument('--smoothing', type=str, choices=SMOOTHING_METHODS, help='Smooth the elevations of the profile to get rid of gps jitter')
+    argumentParser.add_argument('--smoothingWindow', type=int, default=5, help='Number of profile points in the smoothing window, odd except for lowPass (defaults to 5)')
+    argumentParser.add_argument('--simplify', type=float, metavar='TOLERANCE', help='Remove the gps points that are not needed to keep the shape of the course within this many meters, before interpolating')
+    argumentParser.add_argument('--simplifyMethod', type=str, choices=SIMPLIFICATION_METHODS, default="douglasPeucker", help='Algorithm used to simplify the course (defaults to douglasPeucker)')
+    argumentParser.add_argument('--simplifyWithElevation', action='store_true', help='Flag without a value to also keep the shape of the elevation when simplifying')
+    argumentParser.add_argument('--startDistance', "-start", type=int, help='Trims everything before the start distance (default 0m)')
+    argumentParser.add_argument('--stopDistance', "-stop", type=int, help='Trims everything after the stop distance')
+    argumentParser.add_argument('--plot', "-p", action='store_true', help='Flag without a value to enable plotting (single file only)')
+    argumentParser.add_argument('--savePlots', type=str, choices=["png", "svg"], help='Save the profile and slope plots next to the output files in the given format, also in batch mode')
+    argumentParser.add_argument('--jobs', "-j", type=int, help='Number of worker processes for batch mode, or for the segments of a single file (defaults to the number of CPUs)')
+    argumentParser.add_argument('--elevationCache', "-c", type=str, default=DEFAULT_ELEVATION_CACHE_FILENAME, help='File in which the elevations from google are cached (defaults to ~/.GpxElevationCache.sqlite)')
+    argumentParser.add_argument('--noElevationCache', action='store_true', help='Flag without a value to always get all the elevations from google')
+    argumentParser.add_argument('--courseCache', type=str, default=DEFAULT_COURSE_CACHE_DIRECTORY, help='Directory in which the processed courses are cached (defaults to ~/.GpxCourseCache)')
+    argumentParser.add_argument('--noCourseCache', action='store_true', help='Flag without a value to always process the gpx files again')
+    argumentParser.add_argument('--srtmDirectory', "-s", type=str, help='Directory with SRTM .hgt tiles to get the elevations from, instead of google')
+    argumentParser.add_argument('--profile', type=str, nargs='?', const='', metavar='JSONFILE', help='Print the time and number of points of every stage, or save them to the given JSON file')
+    argumentParser.add_argument('--maxElevationError', "-e", type=float, default=0, help='Merge slopes as long as the elevation of the course stays within this many meters (default 0m, which only merges equal slopes)')
+    argumentParser.add_argument('--slopeStep', type=float, default=0, help='Round the slopes to multiples of this step in %%, e.g. 0.5')
+    argumentParser.add_argument('--compact', action='store_true', help='Flag without a value to write the tcx without any whitespace')
+    argumentParser.add_argument('--gzip', "-z", action='store_true', help='Flag without a value to write a gzipped .tcx.gz (or .fit.gz) file')
+    argumentParser.add_argument('--format', type=str, choices=WORKOUT_FORMATS, default="tcx", help='Format of the workout file, tcx or the much smaller binary fit course (defaults to tcx)')
+
+    commandlineArguments = argumentParser.parse_args()
+
+    inputFilenames = commandlineArguments.inputFilenames
+    outputFilename = commandlineArguments.outputFilename
+    outputDirectory = commandlineArguments.outputDirectory
+    apiKey = commandlineArguments.apiKey
+    interpolationResolution = commandlineArguments.interpolationResolution
+    startDistance = commandlineArguments.startDistance
+    simplifyTolerance = commandlineArguments.simplify
+    simplifyMethod = commandlineArguments.simplifyMethod
+    simplifyWithElevation = commandlineArguments.simplifyWithElevation
+    smoothing = commandlineArguments.smoothing
+    smoothingWindow = commandlineArguments.smoothingWindow
+    stopDistance = commandlineArguments.stopDistance
+    plot = commandlineArguments.plot
+    jobs = commandlineArguments.jobs
+    plotFormat = commandlineArguments.savePlots
+    elevationCacheFilename = None if commandlineArguments.noElevationCache else commandlineArguments.elevationCache
+    srtmDirectory = commandlineArguments.srtmDirectory
+    courseCacheDirectory = None if commandlineArguments.noCourseCache else commandlineArguments.courseCache
+    compact = commandlineArguments.compact
+    maxElevationError = commandlineArguments.maxElevationError
+    slopeStep = commandlineArguments.slopeStep
+    compress = commandlineArguments.gzip
+    outputFormat = commandlineArguments.format
+    profileFilename = commandlineArguments.profile
+
+    if profileFilename is not None:
+        GetInstrumentation().Enable()
+
+    # If the interpolation resolution was left out, set it to 100m
+    if interpolationResolution is None:
+        interpolationResolution = 100
+
+    if startDistance is None:
+        startDistance = 0
+    if stopDistance is None:
+        stopDistance = 0
+
+    gpxFiles = FindGpxFiles(inputFilenames)
+    batchMode = len(inputFilenames) > 1 or gpxFiles != inputFilenames
+
+    if batchMode:
+        if outputFilename is not None:
+            print "The output filename cannot be used in batch mode, use the output directory instead."
+            exit(2)
+        if plot:
+            print "Plotting is not available in batch mode and will be skipped. Use --savePlots instead."
+        if len(gpxFiles) == 0:
+            print "No .gpx files found."
+            exit(2)
+        if outputDirectory is not None and not os.path.isdir(outputDirectory):
+            os.makedirs(outputDirectory)
+
+        startTime = time.time()
+        try:
+            results = ConvertGpxFilesInBatch(gpxFiles, outputDirectory, jobs, apiKey=apiKey,
+                                             interpolationResolution=interpolationResolution,
+                                             startDistance=startDistance, stopDistance=stopDistance,
+                                             elevationCacheFilename=elevationCacheFilename,
+                                             srtmDirectory=srtmDirectory, compact=compact, compress=compress,
+                                             plotFormat=plotFormat, smoothing=smoothing,
+                                             smoothingWindow=smoothingWindow, simplifyTolerance=simplifyTolerance,
+                                             simplifyMethod=simplifyMethod, simplifyWithElevation=simplifyWithElevation,
+                                             maxElevationError=maxElevationError, slopeStep=slopeStep,
+                                             courseCacheDirectory=courseCacheDirectory, outputFormat=outputFormat)
+        except ValueError as error:
+            print error
+            exit(2)
+        PrintBatchSummary(results, time.time() - startTime)
+        if profileFilename is not None:
+            GetInstrumentation().Report(profileFilename)
+
+        print "Done!!!"
+        if any(result.error is not None for result in results):
+            exit(1)
+        return
+
+    inputFilename = inputFilenames[0]
+    inputFilenameNoExtension = os.path.splitext(inputFilename)[0]
+
+    # if no output filename is given, we use the input filename
+    if outputFilename is None:
+        outputFilename = inputFilenameNoExtension
+        if outputDirectory is not None:
+            outputFilename = os.path.join(outputDirectory, os.path.basename(outputFilename))
+
+    # Strip the extension of the output filename, we only need the name
+    outputName = GetWorkoutOutputName(outputFilename)
+
+    try:
+        ConvertGpxFile(inputFilename, outputName, apiKey, interpolationResolution, startDistance, stopDistance, plot,
+                       elevationCacheFilename=elevationCacheFilename, srtmDirectory=srtmDirectory, compact=compact,
+                       compress=compress, plotFormat=plotFormat, smoothing=smoothing,
+                       smoothingWindow=smoothingWindow, simplifyTolerance=simplifyTolerance,
+                       simplifyMethod=simplifyMethod, simplifyWithElevation=simplifyWithElevation,
+                       maxElevationError=maxElevationError, slopeStep=slopeStep,
+                       processes=jobs or multiprocessing.cpu_count(), courseCacheDirectory=courseCacheDirectory,
+                       outputFormat=outputFormat)
+    except ElevationError as error:
+        print error
+        exit(2)
+
+    if profileFilename is not None:
+        GetInstrumentation().Report(profileFilename)
+
+    print "Done!!!"
+
+    # Only wait for user input if plots are enabled
+    if plot:
+        raw_input("Press Enter to continue...")
+
+
+if __name__ == "__main__":
+    main()
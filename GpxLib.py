@@ -1,21 +1,186 @@
 # (c) 2018 Phillip Myburgh
 # Distributed under the MIT Licence
 
+import sys
 import math
 from math import radians, cos, sin, asin, sqrt
 from time import sleep
-import urllib
+import time
+import httplib
+import urlparse
+import socket
+import threading
+import random
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import json
-from StringIO import StringIO
 import copy
 import os
+import itertools
+import functools
+import heapq
+import sqlite3
+import gzip
+import hashlib
+import tempfile
+import zipfile
+import struct
+from xml.sax.saxutils import escape as xmlEscape
 
-import xml.etree.ElementTree
-from lxml.etree import tostring
-from lxml.builder import E
+import numpy as np
 
-import matplotlib.pyplot as plt
-plt.ion()
+from lxml.etree import iterparse
+
+
+# The radius of earth used for all distance calculations, in meters
+RADIUS_OF_EARTH = 6378.1 * 1000.0
+
+# The Google Maps Elevation API
+GOOGLE_ELEVATION_URL = "https://maps.googleapis.com/maps/api/elevation/json"
+
+# Where the scripts keep the elevations they retrieved, so they are not requested again on the next run
+DEFAULT_ELEVATION_CACHE_FILENAME = os.path.join(os.path.expanduser("~"), ".GpxElevationCache.sqlite")
+
+# Where the scripts keep the processed courses, so the same file with the same options is not processed again
+DEFAULT_COURSE_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".GpxCourseCache")
+
+
+class Instrumentation:
+    '''
+        Records the wall time and the number of points in and out of every pipeline stage, and counters such as the
+        number of haversine calculations, array copies and network requests.
+        Nothing is recorded (and almost nothing is spent) until it is enabled. Use the module instance through
+        GetInstrumentation()
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.__lock = threading.Lock()
+        self.Reset()
+
+
+    def Enable(self):
+        self.enabled = True
+
+
+    def Disable(self):
+        self.enabled = False
+
+
+    def Reset(self):
+        with self.__lock:
+            # Stage name -> [calls, seconds, points in, points out], in the order in which the stages first ran
+            self.stages = {}
+            self.stageOrder = []
+            self.counters = {}
+
+
+    def Count(self, name, count=1):
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+
+    def AddStage(self, name, seconds, pointsIn=0, pointsOut=0, calls=1):
+        with self.__lock:
+            if name not in self.stages:
+                self.stages[name] = [0, 0.0, 0, 0]
+                self.stageOrder.append(name)
+            stage = self.stages[name]
+            stage[0] += calls
+            stage[1] += seconds
+            stage[2] += pointsIn
+            stage[3] += pointsOut
+
+
+    def ToDict(self):
+        '''The recorded stages and counters as plain lists and dictionaries, e.g. to save as JSON'''
+        with self.__lock:
+            stages = [{"name": name, "calls": self.stages[name][0], "seconds": self.stages[name][1],
+                       "pointsIn": self.stages[name][2], "pointsOut": self.stages[name][3]}
+                      for name in self.stageOrder]
+            return {"stages": stages, "counters": dict(self.counters)}
+
+
+    def Merge(self, instrumentationDict):
+        '''Add the stages and counters of a ToDict() result, e.g. from a worker process'''
+        for stage in instrumentationDict["stages"]:
+            self.AddStage(stage["name"], stage["seconds"], stage["pointsIn"], stage["pointsOut"], stage["calls"])
+        for name, count in instrumentationDict["counters"].items():
+            self.Count(name, count)
+
+
+    def FormatTable(self):
+        instrumentationDict = self.ToDict()
+        lines = ["%-30s %6s %10s %12s %12s" % ("Stage", "Calls", "Seconds", "Points In", "Points Out")]
+        for stage in instrumentationDict["stages"]:
+            lines.append("%-30s %6d %10.4f %12d %12d" % (stage["name"], stage["calls"], stage["seconds"],
+                                                         stage["pointsIn"], stage["pointsOut"]))
+        lines.append("")
+        lines.append("%-30s %12s" % ("Counter", "Count"))
+        for name in sorted(instrumentationDict["counters"]):
+            lines.append("%-30s %12d" % (name, instrumentationDict["counters"][name]))
+        return "\n".join(lines)
+
+
+    def WriteJson(self, filename):
+        with open(filename, "w") as jsonFile:
+            json.dump(self.ToDict(), jsonFile, indent=2, sort_keys=True)
+
+
+    def Report(self, filename=None):
+        '''Print the stage table, or save everything as JSON if a filename is given'''
+        if filename:
+            self.WriteJson(filename)
+            print "Saved the profile to " + filename
+        else:
+            print self.FormatTable()
+
+
+_instrumentation = Instrumentation()
+
+
+def GetInstrumentation():
+    '''The Instrumentation which records all the stages and counters of this library'''
+    return _instrumentation
+
+
+def StartJobInstrumentation(enabled):
+    '''
+        Prepare the instrumentation for a job in a worker process, with enabled the GetInstrumentation().enabled of the
+        main process: spawned workers (as on Windows) do not inherit it. It is reset, so every job sends back only its
+        own stages. Returns the Instrumentation
+    '''
+    instrumentation = GetInstrumentation()
+    if enabled:
+        instrumentation.Enable()
+    instrumentation.Reset()
+    return instrumentation
+
+
+def _GetNumberOfPoints(value):
+    '''The number of points of a course (or list of points), or 0 for anything else'''
+    if hasattr(value, "GetNumberOfPoints"):
+        return value.GetNumberOfPoints()
+    if isinstance(value, list):
+        return len(value)
+    return 0
+
+
+def InstrumentedStage(function):
+    '''
+        Decorator for the pipeline stages. While the instrumentation is enabled, the wall time of every call is
+        recorded, with the number of points of the first argument (the course itself for methods) and the result
+    '''
+    @functools.wraps(function)
+    def InstrumentedFunction(*args, **kwargs):
+        if not _instrumentation.enabled:
+            return function(*args, **kwargs)
+        startTime = time.time()
+        result = function(*args, **kwargs)
+        seconds = time.time() - startTime
+        pointsIn = _GetNumberOfPoints(args[0]) if args else 0
+        _instrumentation.AddStage(function.__name__, seconds, pointsIn, _GetNumberOfPoints(result))
+        return result
+    return InstrumentedFunction
 
 
 def DegreesToRadians(x):
@@ -34,6 +199,10 @@ def Haversine(latitude1, longitude1, latitude2, longitude2, sphereRadius):
         Inputs should be in decimal degrees.
         Returns the distance in meters
     '''
+    if _instrumentation.enabled:
+        _instrumentation.Count("haversineCalls")
+        _instrumentation.Count("haversineDistances")
+
     # convert decimal degrees to radians
     longitude1, latitude1, longitude2, latitude2 = map(radians, [longitude1, latitude1, longitude2, latitude2])
 
@@ -50,8 +219,48 @@ def GetDistanceBetweenPoints(point1, point2):
         Get the 2d distance between 2 Point objects. Does not account for elevation.
         Returns distance in meters.
     '''
-    radiusOfEarth = 6378.1 * 1000.0
-    return Haversine(point1.latitude, point1.longitude, point2.latitude, point2.longitude, radiusOfEarth)
+    return Haversine(point1.latitude, point1.longitude, point2.latitude, point2.longitude, RADIUS_OF_EARTH)
+
+
+def HaversineArray(latitudes1, longitudes1, latitudes2, longitudes2, sphereRadius):
+    '''
+        Vectorized version of Haversine. Takes arrays (or scalars, which are broadcast) of coordinates in decimal
+        degrees and returns an array with the great-circle distance between each pair of points.
+        Returns the distances in meters
+    '''
+    # convert decimal degrees to radians
+    latitudes1, longitudes1, latitudes2, longitudes2 = [np.radians(np.asarray(values, dtype=np.float64))
+                                                        for values in [latitudes1, longitudes1, latitudes2, longitudes2]]
+
+    # haversine formula
+    dlon = longitudes2 - longitudes1
+    dlat = latitudes2 - latitudes1
+    a = np.sin(dlat / 2.0) ** 2 + np.cos(latitudes1) * np.cos(latitudes2) * np.sin(dlon / 2.0) ** 2
+    c = 2.0 * np.arcsin(np.sqrt(a))
+
+    if _instrumentation.enabled:
+        _instrumentation.Count("haversineCalls")
+        _instrumentation.Count("haversineDistances", c.size)
+
+    return c * sphereRadius
+
+
+def GetSegmentDistances(latitudes, longitudes):
+    '''
+        Get the 2d distance between each pair of consecutive points given as latitude and longitude arrays.
+        Returns an array (one shorter than the inputs) with the distances in meters.
+    '''
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    return HaversineArray(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:], RADIUS_OF_EARTH)
+
+
+def GetDistancesToPoint(latitudes, longitudes, point):
+    '''
+        Get the 2d distance between each of the points given as latitude and longitude arrays and a single Point.
+        Returns an array with the distances in meters.
+    '''
+    return HaversineArray(latitudes, longitudes, point.latitude, point.longitude, RADIUS_OF_EARTH)
 
 
 def GetMiddlePoint(point1, point2):
@@ -77,122 +286,570 @@ def GetMiddlePoint(point1, point2):
     return GpxPoint(RadiansToDegrees(lat3), RadiansToDegrees(lon3), ele3)
 
 
+def _ReadOnlyArray(values):
+    '''
+        Returns the values as a read-only float array. Arrays which are already read-only are shared instead of copied
+    '''
+    if isinstance(values, np.ndarray) and values.dtype == np.float64 and not values.flags.writeable:
+        return values
+    if _instrumentation.enabled:
+        _instrumentation.Count("arrayCopies")
+    array = np.array(values, dtype=np.float64)
+    array.flags.writeable = False
+    return array
+
+
+def _GetStarts(starts, numberOfPoints):
+    '''
+        The sorted, unique indices of the first points of the segments or tracks of a course, as a read-only array.
+        Starts outside the course are dropped, and the first point is always a start
+    '''
+    starts = np.asarray(starts if starts is not None else [], dtype=np.int64)
+    starts = np.union1d(starts[(starts >= 0) & (starts < numberOfPoints)], [0] if numberOfPoints > 0 else [])
+    starts = starts.astype(np.int64)
+    starts.flags.writeable = False
+    return starts
+
+
+def _ReadOnlyView(array):
+    '''Returns a read-only view of the array, which cannot be made writeable again by the caller'''
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
 def LinearInterpolate(x1, y1, x2, y2, x):
     return ((x-x1)*(y2-y1)/(x2-x1)) + y1
 
 
+def _InterpolateAtDistances(distances, values, queryDistances):
+    '''
+        Finds the values at all the query distances with a sorted search over the increasing distances array. Uses
+        linear interpolation between points (and extrapolates from the first or last 2 points when out of range).
+        Returns an array with a value for every query distance
+    '''
+    queryDistances = np.asarray(queryDistances, dtype=np.float64)
+    if len(distances) == 1:
+        return np.full(queryDistances.shape, float(values[0]))
+
+    upper = np.clip(np.searchsorted(distances, queryDistances, side="right"), 1, len(distances) - 1)
+    lower = upper - 1
+    x1 = distances[lower]
+    y1 = values[lower]
+    gaps = distances[upper] - x1
+    # Points at the same distance have no slope to interpolate with, so the lower value is used
+    interpolated = (queryDistances - x1) * (values[upper] - y1) / np.where(gaps > 0, gaps, 1.0) + y1
+    return np.where((gaps > 0) & (queryDistances != x1), interpolated, y1)
+
+
+def _InterpolateAtDistance(distances, values, distance):
+    '''Single distance version of _InterpolateAtDistances'''
+    return float(_InterpolateAtDistances(distances, values, [distance])[0])
+
+
+def _ZigZag(values):
+    '''Move the sign of the values to the lowest bit, like the polyline encoding does. Negative values are inverted'''
+    return np.where(values < 0, ~(values << 1), values << 1)
+
+
+def _GetPolylineCoordinates(latitudes, longitudes):
+    '''The quantized coordinates, interleaved as lat, lon, lat, lon...'''
+    coordinates = np.empty(2 * len(latitudes), dtype=np.int64)
+    coordinates[0::2] = _QuantizeCoordinates(latitudes)
+    coordinates[1::2] = _QuantizeCoordinates(longitudes)
+    return coordinates
+
+
+def _GetPolylineValues(coordinates):
+    '''The zigzag encoded differences between the coordinates. The first point is relative to 0, 0'''
+    differences = coordinates.copy()
+    differences[2:] -= coordinates[:-2]
+    return _ZigZag(differences)
+
+
+def _GetPolylineCharacterCounts(values):
+    '''The number of characters (5 bit chunks) needed for every encoded value. 0 still needs one character'''
+    counts = np.ones(len(values), dtype=np.int64)
+    remaining = values >> 5
+    while np.any(remaining):
+        counts += remaining > 0
+        remaining >>= 5
+    return counts
+
+
+def _EncodePolylineValues(values, counts):
+    '''Encode the zigzag values to the polyline characters, all the values at once'''
+    numberOfChunks = int(counts.max()) if len(counts) else 0
+    # One column per 5 bit chunk, starting with the lowest bits. Every chunk but the last of a value has the 0x20 bit
+    chunks = np.empty((len(values), numberOfChunks), dtype=np.int64)
+    for chunkIndex in range(0, numberOfChunks):
+        chunks[:, chunkIndex] = ((values >> (5 * chunkIndex)) & 0x1f) | np.where(counts > chunkIndex + 1, 0x20, 0)
+    used = np.arange(numberOfChunks) < counts[:, np.newaxis]
+    return (chunks[used] + 63).astype(np.uint8).tostring()
+
+
+def EncodePolyline(latitudes, longitudes):
+    '''
+        Basically does a lossy compression of the coordinates to an ascii string, with a precision of 1e-5 degrees
+        See for explanation: https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    '''
+    values = _GetPolylineValues(_GetPolylineCoordinates(latitudes, longitudes))
+    return _EncodePolylineValues(values, _GetPolylineCharacterCounts(values))
+
+
+def DecodePolyline(polyline):
+    '''The opposite of EncodePolyline. Returns the latitude and longitude arrays'''
+    chunks = np.frombuffer(polyline, dtype=np.uint8).astype(np.int64) - 63
+    if len(chunks) == 0:
+        return np.empty(0), np.empty(0)
+    # Every value ends with a chunk without the 0x20 bit
+    lastChunks = np.flatnonzero(chunks < 0x20)
+    firstChunks = np.concatenate([[0], lastChunks[:-1] + 1])
+    shifts = 5 * (np.arange(len(chunks)) - np.repeat(firstChunks, lastChunks - firstChunks + 1))
+    values = np.add.reduceat((chunks & 0x1f) << shifts, firstChunks)
+    differences = np.where(values & 1, ~(values >> 1), values >> 1)
+    coordinates = np.cumsum(differences.reshape(-1, 2), axis=0) / 1.0e5
+    return coordinates[:, 0], coordinates[:, 1]
+
+
+def PackPolylines(latitudes, longitudes, maxCharacters, maxPoints):
+    '''
+        Split the coordinates into as few polylines as possible, each with at most maxCharacters characters and
+        maxPoints points. Every polyline starts from 0, 0 again, so its first point takes more characters.
+        The lengths are worked out up front, so every point is only encoded once.
+        Returns a list of (start index, stop index, polyline). Raises a ValueError if a single point does not fit
+    '''
+    coordinates = _GetPolylineCoordinates(latitudes, longitudes)
+    relativeValues = _GetPolylineValues(coordinates)
+    absoluteValues = _ZigZag(coordinates)
+    relativeCounts = _GetPolylineCharacterCounts(relativeValues)
+    absoluteCounts = _GetPolylineCharacterCounts(absoluteValues)
+    # The length of every point relative to the point before it, and on its own as the first point of a polyline
+    relativeLengths = relativeCounts[0::2] + relativeCounts[1::2]
+    absoluteLengths = absoluteCounts[0::2] + absoluteCounts[1::2]
+    cumulativeLengths = np.concatenate([[0], np.cumsum(relativeLengths)])
+
+    numberOfPoints = len(latitudes)
+    startIndices = []
+    start = 0
+    while start < numberOfPoints:
+        # The length of [start, stop) is absoluteLengths[start] + cumulativeLengths[stop] - cumulativeLengths[start + 1]
+        maxLength = maxCharacters - absoluteLengths[start] + cumulativeLengths[start + 1]
+        stop = int(np.searchsorted(cumulativeLengths, maxLength, side="right")) - 1
+        stop = min(stop, start + maxPoints, numberOfPoints)
+        if stop <= start:
+            raise ValueError("A single point does not fit in a polyline of " + str(maxCharacters) + " characters")
+        startIndices.append(start)
+        start = stop
+
+    # Encode everything at once, with the first point of every polyline relative to 0, 0
+    starts = np.array(startIndices, dtype=np.int64)
+    startValues = np.concatenate([2 * starts, 2 * starts + 1])
+    relativeValues[startValues] = absoluteValues[startValues]
+    relativeCounts[startValues] = absoluteCounts[startValues]
+    encoded = _EncodePolylineValues(relativeValues, relativeCounts)
+
+    stops = np.append(starts[1:], numberOfPoints)
+    characterOffsets = np.concatenate([[0], np.cumsum(relativeCounts)])[2 * np.append(starts, numberOfPoints)]
+    return [(int(start), int(stop), encoded[characterOffsets[index]:characterOffsets[index + 1]])
+            for index, (start, stop) in enumerate(zip(starts, stops))]
+
+
 def ConvertGpxPointsToPolyLineEncoding(gpxPoints):
     '''
         Basically does a lossy compression of the gpx points to an ascii string
         See for explanation: https://developers.google.com/maps/documentation/utilities/polylinealgorithm
     '''
-    def GetFiveBitChunks(value):
-        # Makes an array of 5 bit chunks, starting from the right (as first array element)
-        fiveBitMask = (2**5)-1
-        chunks = []
-        while value > 0:
-            chunkValue = value & fiveBitMask
-            if (value > fiveBitMask): # if this isn't the last element
-                chunkValue |= 0x20
-            chunks.append(chunkValue)
-            value >>= 5
-        return chunks
-
-    def PolylineEncodeValue(value):
-        if value < 0:
-            value = ~(value << 1)
-        else:
-            value = (value << 1)
-        chunks = GetFiveBitChunks(value)
-        chunks = [chunk + 63 for chunk in chunks]
-        outputString = ""
-        for chunk in chunks:
-            outputString += chr(chunk)
-
-        # We cannot have an empty string, otherwise the lat,lon pairs would become shredded
-        # We escape 0 values with a ? (which is 0 + 63 offset)
-        if outputString == "":
-            outputString = "?"
+    return EncodePolyline([gpxPoint.latitude for gpxPoint in gpxPoints], [gpxPoint.longitude for gpxPoint in gpxPoints])
 
-        return outputString
 
-    previousGpxPoint = GpxPoint(0,0,0)
-    outputString = ""
-    for gpxPoint in gpxPoints:
+class ElevationError(Exception):
+    '''Raised when the elevation data cannot be retrieved'''
+    pass
 
-        latitudeDiff = int(round(gpxPoint.latitude * 1.0e5)) - int(round(previousGpxPoint.latitude * 1.0e5))
-        longitudeDiff = int(round(gpxPoint.longitude * 1.0e5)) - int(round(previousGpxPoint.longitude * 1.0e5))
 
-        outputString += PolylineEncodeValue(latitudeDiff)
-        outputString += PolylineEncodeValue(longitudeDiff)
-        previousGpxPoint = gpxPoint
-    return outputString
+class TokenBucket:
+    '''
+        Thread safe rate limiter. Tokens are added at the given rate per second, up to the capacity, and every
+        Acquire takes a token, waiting for one if there is none left
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.__tokens = self.capacity
+        self.__lastUpdate = time.time()
+        self.__lock = threading.Lock()
+
+
+    def Acquire(self):
+        while True:
+            with self.__lock:
+                now = time.time()
+                self.__tokens = min(self.capacity, self.__tokens + (now - self.__lastUpdate) * self.rate)
+                self.__lastUpdate = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                waitTime = (1 - self.__tokens) / self.rate
+            sleep(waitTime)
+
+
+class _ElevationRequester:
+    '''
+        Does the elevation requests for GetCorrectElevationFromGoogle. Every thread keeps its own connection open
+        between requests. A failed request is retried with a randomised (jittered) exponential backoff
+    '''
+    def __init__(self, baseUrl, tokenBucket, retries, retryBackoffTime):
+        self.__url = urlparse.urlsplit(baseUrl)
+        self.__tokenBucket = tokenBucket
+        self.__retries = retries
+        self.__retryBackoffTime = retryBackoffTime
+        self.__threadData = threading.local()
+        self.__connections = []
+        self.__lock = threading.Lock()
+
+
+    def __GetConnection(self):
+        connection = getattr(self.__threadData, "connection", None)
+        if connection is None:
+            connectionClass = httplib.HTTPSConnection if self.__url.scheme == "https" else httplib.HTTPConnection
+            connection = connectionClass(self.__url.netloc, timeout=60)
+            self.__threadData.connection = connection
+            with self.__lock:
+                self.__connections.append(connection)
+        return connection
+
+
+    def Request(self, query):
+        '''Get the json results of the request with the given query string'''
+        requestPath = self.__url.path + "?" + query
+        for attempt in range(0, self.__retries):
+            self.__tokenBucket.Acquire()
+            if _instrumentation.enabled:
+                _instrumentation.Count("networkRequests")
+                if attempt > 0:
+                    _instrumentation.Count("networkRetries")
+            try:
+                connection = self.__GetConnection()
+                connection.request("GET", requestPath)
+                data = connection.getresponse().read()
+                js = json.loads(data)
+            except (httplib.HTTPException, socket.error, ValueError) as error:
+                # Start with a new connection on the next attempt
+                self.__threadData.connection.close()
+                self.__threadData.connection = None
+                data = str(error)
+                js = None
+
+            if js is not None and js.get('status') == 'OK':
+                return js["results"]
+
+            if attempt + 1 < self.__retries:
+                backoffTime = self.__retryBackoffTime * (2 ** attempt) * random.uniform(0.5, 1.5)
+                print "Failed, Retrying in ", backoffTime, "seconds..."
+                sleep(backoffTime)
+
+        raise ElevationError("==== Failure To Retrieve ====\n" + urlparse.urlunsplit(self.__url) + "?" + query +
+                             "\nreturned:\n" + str(data))
+
+
+    def Close(self):
+        for connection in self.__connections:
+            connection.close()
+
+
+@InstrumentedStage
+def GetCorrectElevationFromGoogle(gpxPoints, apiKey, baseUrl=GOOGLE_ELEVATION_URL, requestsPerSecond=40,
+                                  numberOfThreads=8, retries=3, retryBackoffTime=5):
+    '''
+        Using the Google maps API, we fill in the correct elevation for the gpsPoints.
+        The points are split into requests which are sent concurrently from numberOfThreads threads, while a token
+        bucket keeps the rate below requestsPerSecond (Google's limit is 50 requests per second). Each request is
+        tried up to retries times, backing off retryBackoffTime seconds (doubling every time) in between
+    '''
+    maxLocationsPerRequest = 512 # 512 Location Limit according to Google
+    maxRequestLength = 2000 # Not an official limit. There has been some issues online by dev's if the request is too long
 
+    # Encode the points otherwise we cannot use the maximum number of points because there is a character limit
+    # for all requests. The points are packed into as few requests as fit in the request length
+    queryPrefix = "locations=enc:"
+    querySuffix = "&key=" + apiKey
+    maxPolylineLength = maxRequestLength - len(baseUrl) - 1 - len(queryPrefix) - len(querySuffix)
+    try:
+        polylines = PackPolylines([gpxPoint.latitude for gpxPoint in gpxPoints],
+                                  [gpxPoint.longitude for gpxPoint in gpxPoints], maxPolylineLength,
+                                  maxLocationsPerRequest)
+    except ValueError:
+        raise ElevationError("GetCorrectElevationFromGoogle> We have a problem! A single point does not fit in the "
+                             "request length...")
+    queries = [queryPrefix + polyline + querySuffix for _, _, polyline in polylines]
+
+    # The bucket can hold a token for each thread, so all of them can start straight away
+    requester = _ElevationRequester(baseUrl, TokenBucket(requestsPerSecond, numberOfThreads), retries,
+                                    retryBackoffTime)
+    pool = ThreadPool(max(1, min(numberOfThreads, len(queries))))
+    try:
+        # map keeps the results in the same order as the requests
+        results = pool.map(requester.Request, queries)
+    finally:
+        pool.close()
+        pool.join()
+        requester.Close()
 
-def GetCorrectElevationFromGoogle(gpxPoints, apiKey):
-    '''Using the Google maps API, we fill in the correct elevation for the gpsPoints'''
     outputGpxPoints = []
-    maxLocationsPerRequest = 512 # 512 Location Limit according to Google
-    maxRequestLength = 2000 # Not an official limit. There has been some issues online by dev's if the request is too long
-    requestDelay = 1.0 / 10.0 # Google's limit is 50 requests per second. So we err on the safe side
-    retries = 3
-    retryBackoffTime = 5 # Wait in 5 seconds multiples before trying again
+    for jsonLocation in itertools.chain.from_iterable(results):
+        latitude = jsonLocation["location"]["lat"]
+        longitude = jsonLocation["location"]["lng"]
+        elevation = jsonLocation["elevation"]
+        outputGpxPoints.append(GpxPoint(latitude, longitude, elevation))
 
-    pointsProcessed = 0
-    while True:
-        pointsLeft = len(gpxPoints) - pointsProcessed
+    return outputGpxPoints
 
-        if pointsLeft == 0:
-            return outputGpxPoints
 
-        pointsToProcess = min(pointsLeft, maxLocationsPerRequest)
+def _QuantizeCoordinates(values):
+    '''Round the coordinates to whole 1e-5 degree steps, exactly like the polyline encoding does'''
+    values = np.asarray(values, dtype=np.float64) * 1.0e5
+    return (np.sign(values) * np.floor(np.abs(values) + 0.5)).astype(np.int64)
 
-        # Encode the points otherwise we cannot use the maximum number of points because there is a character limit
-        # for all requests. We also have to check the length of the string
-        while (True):
-            requestString = "https://maps.googleapis.com/maps/api/elevation/json?locations=enc:"
-            polylineEncodedPoints = ConvertGpxPointsToPolyLineEncoding(gpxPoints[pointsProcessed : pointsProcessed + pointsToProcess])
-            requestString += polylineEncodedPoints
-            requestString += "&key=" + apiKey
-            if (len(requestString) <= maxRequestLength):
-                break
-            # If the request is too long, decrease the number of points to process
-            if (pointsToProcess <= 10):
-                print "GetCorrectElevationFromGoogle> We have a problem! We cannot bring the request length down without having less than 10 points..."
-                exit(2)
-            pointsToProcess -= 10
-
-        urlFp = urllib.urlopen(requestString)
-        data = urlFp.read()
-        try:
-            js = json.loads(str(data))
-        except:
-            js = None
-
-        urlFp.close()
-        if 'status' not in js or js['status'] != 'OK':
-            retries -= 1
-            if retries <= 0:
-                print '==== Failure To Retrieve ===='
-                print requestString
-                print "returned:"
-                print data
-                exit (2)
-
-            print "Failed, Retrying in ", retryBackoffTime, "seconds..."
-            sleep(retryBackoffTime)
-            retryBackoffTime *= 2
-            continue
 
-        for jsonLocation in js["results"]:
-            latitude = jsonLocation["location"]["lat"]
-            longitude = jsonLocation["location"]["lng"]
-            elevation = jsonLocation["elevation"]
-            outputGpxPoints.append(GpxPoint(latitude, longitude, elevation))
+class ElevationCache:
+    '''
+        Persistent cache of elevations stored in a SQLite file. Points are keyed by their latitude and longitude rounded
+        to 5 decimals, which is all the precision the polyline encoded elevation requests have anyway.
+        When there are more than maxEntries elevations, the least recently used ones are removed.
+        The hits and misses counters count the points looked up since the cache was opened
+    '''
+    # Number of keys per sql statement, to stay below the sqlite variable limit
+    _chunkSize = 500
+
+    def __init__(self, filename, maxEntries=1000000):
+        self.filename = filename
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        # Batch conversions share the file between processes, so wait for the other writers
+        self.__connection = sqlite3.connect(filename, timeout=60)
+        with self.__connection:
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS elevations "
+                                      "(key INTEGER PRIMARY KEY, elevation REAL NOT NULL, lastUsed REAL NOT NULL)")
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS elevationsLastUsed ON elevations (lastUsed)")
+
+
+    @staticmethod
+    def _GetKeys(latitudes, longitudes):
+        # Pack the quantized latitude and longitude into a single integer key
+        latitudeKeys = _QuantizeCoordinates(latitudes) + 9000000
+        longitudeKeys = _QuantizeCoordinates(longitudes) + 18000000
+        return latitudeKeys * 36000001 + longitudeKeys
+
+
+    def GetElevations(self, latitudes, longitudes):
+        '''Look up the elevations of the points. Returns an array with NaN for all the points not in the cache'''
+        keys = self._GetKeys(latitudes, longitudes)
+        uniqueKeys, inverse = np.unique(keys, return_inverse=True)
+        uniqueKeys = uniqueKeys.tolist()
+
+        cachedElevations = {}
+        for chunkStart in range(0, len(uniqueKeys), self._chunkSize):
+            chunk = uniqueKeys[chunkStart:chunkStart + self._chunkSize]
+            query = "SELECT key, elevation FROM elevations WHERE key IN (" + ",".join("?" * len(chunk)) + ")"
+            cachedElevations.update(self.__connection.execute(query, chunk))
+
+        elevations = np.array([cachedElevations.get(key, np.nan) for key in uniqueKeys], dtype=np.float64)[inverse]
+        self.hits += int(np.count_nonzero(~np.isnan(elevations)))
+        self.misses += int(np.count_nonzero(np.isnan(elevations)))
+
+        # Mark the hits as recently used
+        now = time.time()
+        with self.__connection:
+            self.__connection.executemany("UPDATE elevations SET lastUsed = ? WHERE key = ?",
+                                          [(now, key) for key in cachedElevations])
+        return elevations
+
+
+    def SetElevations(self, latitudes, longitudes, elevations):
+        '''Store the elevations of the points, and evict the least recently used ones if the cache is full'''
+        keys = self._GetKeys(latitudes, longitudes).tolist()
+        now = time.time()
+        with self.__connection:
+            self.__connection.executemany("INSERT OR REPLACE INTO elevations (key, elevation, lastUsed) VALUES (?, ?, ?)",
+                                          zip(keys, np.asarray(elevations, dtype=np.float64).tolist(),
+                                              itertools.repeat(now)))
+            numberOfEvictions = self.GetNumberOfEntries() - self.maxEntries
+            if numberOfEvictions > 0:
+                self.__connection.execute("DELETE FROM elevations WHERE key IN "
+                                          "(SELECT key FROM elevations ORDER BY lastUsed LIMIT ?)", (numberOfEvictions,))
+
+
+    def GetNumberOfEntries(self):
+        return self.__connection.execute("SELECT COUNT(*) FROM elevations").fetchone()[0]
+
+
+    def Close(self):
+        self.__connection.close()
+
+
+class ElevationProvider:
+    '''
+        Interface for anything that can give the elevations of points. GpxCourse.CorrectElevation uses a provider to
+        replace the elevations of a course
+    '''
+    def GetElevations(self, latitudes, longitudes):
+        '''Returns an array with the elevation in meters of each point given by the latitude and longitude arrays'''
+        raise NotImplementedError()
+
+
+class GoogleElevationProvider(ElevationProvider):
+    '''
+        Gets the elevations from the Google Maps Elevation API. The keyword arguments are passed on to
+        GetCorrectElevationFromGoogle, e.g. to change the url or the number of requests per second
+    '''
+    def __init__(self, apiKey, **requestOptions):
+        self.apiKey = apiKey
+        self.requestOptions = requestOptions
 
-        sleep(requestDelay)
-        pointsProcessed += pointsToProcess
 
+    def GetElevations(self, latitudes, longitudes):
+        if len(latitudes) == 0:
+            return np.zeros(0)
+        if not self.apiKey:
+            raise ElevationError("A Google Maps API key is needed to get the elevations from google")
+        gpxPoints = [GpxPoint(latitude, longitude, 0) for latitude, longitude in
+                     zip(np.asarray(latitudes).tolist(), np.asarray(longitudes).tolist())]
+        newPoints = GetCorrectElevationFromGoogle(gpxPoints, self.apiKey, **self.requestOptions)
+        return np.array([gpxPoint.elevation for gpxPoint in newPoints], dtype=np.float64)
+
+
+class SrtmElevationProvider(ElevationProvider):
+    '''
+        Gets the elevations offline from SRTM .hgt tiles in a directory, e.g. S26E028.hgt for the 1 degree square
+        with its south west corner at 26S 28E. A tile is a square grid of big-endian 16 bit elevations, starting at the
+        north west corner. Any grid size works (1201 for SRTM3, 3601 for SRTM1), it is worked out from the file size.
+        The tiles are memory mapped, and the elevation between the 4 surrounding samples is interpolated bilinearly
+    '''
+    # SRTM marks samples without data with this value
+    voidValue = -32768
+
+    def __init__(self, tileDirectory):
+        self.tileDirectory = tileDirectory
+        self.__tiles = {}
+
+
+    @staticmethod
+    def GetTileName(latitude, longitude):
+        '''Get the name of the tile which contains the point with the given (whole degree) south west corner'''
+        latitude = int(math.floor(latitude))
+        longitude = int(math.floor(longitude))
+        return "%s%02d%s%03d.hgt" % ("N" if latitude >= 0 else "S", abs(latitude),
+                                     "E" if longitude >= 0 else "W", abs(longitude))
+
+
+    def __GetTile(self, latitude, longitude):
+        tileName = self.GetTileName(latitude, longitude)
+        if tileName not in self.__tiles:
+            tileFilename = os.path.join(self.tileDirectory, tileName)
+            if not os.path.isfile(tileFilename):
+                raise ElevationError("The SRTM tile " + tileFilename + " is missing")
+            samples = int(round(math.sqrt(os.path.getsize(tileFilename) / 2)))
+            if samples < 2 or samples * samples * 2 != os.path.getsize(tileFilename):
+                raise ElevationError("The SRTM tile " + tileFilename + " is not a square grid of 16 bit samples")
+            self.__tiles[tileName] = np.memmap(tileFilename, dtype=">i2", mode="r", shape=(samples, samples))
+        return self.__tiles[tileName]
+
+
+    def GetElevations(self, latitudes, longitudes):
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        elevations = np.zeros(len(latitudes))
+
+        # Do all the points of a tile at once
+        southEdges = np.floor(latitudes)
+        westEdges = np.floor(longitudes)
+        tileIds, tileIndices = np.unique(southEdges * 1000 + westEdges, return_inverse=True)
+        for tileIndex in range(0, len(tileIds)):
+            points = np.nonzero(tileIndices == tileIndex)[0]
+            southEdge = southEdges[points[0]]
+            westEdge = westEdges[points[0]]
+            tile = self.__GetTile(southEdge, westEdge)
+            maxIndex = tile.shape[0] - 1
+
+            # Rows go from north to south, columns from west to east
+            rows = (southEdge + 1 - latitudes[points]) * maxIndex
+            columns = (longitudes[points] - westEdge) * maxIndex
+            topRows = np.minimum(np.floor(rows).astype(np.int64), maxIndex - 1)
+            leftColumns = np.minimum(np.floor(columns).astype(np.int64), maxIndex - 1)
+            rowFractions = rows - topRows
+            columnFractions = columns - leftColumns
+
+            samples = np.array([tile[topRows, leftColumns], tile[topRows, leftColumns + 1],
+                                tile[topRows + 1, leftColumns], tile[topRows + 1, leftColumns + 1]], dtype=np.float64)
+            weights = np.array([(1 - rowFractions) * (1 - columnFractions), (1 - rowFractions) * columnFractions,
+                                rowFractions * (1 - columnFractions), rowFractions * columnFractions])
+
+            # Voids are left out, and the weights of the other samples are scaled up to make up for it
+            weights[samples == self.voidValue] = 0
+            totalWeights = weights.sum(axis=0)
+            if np.any(totalWeights == 0):
+                raise ElevationError("There is no SRTM data around some of the points in " +
+                                     self.GetTileName(southEdge, westEdge))
+            elevations[points] = (samples * weights).sum(axis=0) / totalWeights
+
+        return elevations
+
+
+def InterpolateBetweenCoordinates(latitudes, longitudes, elevations, interpolationResolution):
+    '''
+        Creates new latitude, longitude and elevation arrays so none of the points are further apart than the
+        interpolation resolution. All the original points are kept. Each segment that is too long is split into the
+        smallest number of equal parts that are within the resolution, with the new points placed on the great circle
+        between the 2 original points. Elevations are interpolated linearly.
+        Returns a (latitudes, longitudes, elevations) tuple of arrays
+    '''
+    if interpolationResolution <= 0:
+        raise ValueError("The interpolation resolution must be larger than 0")
+
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    elevations = np.asarray(elevations, dtype=np.float64)
+    if len(latitudes) <= 1:
+        return latitudes.copy(), longitudes.copy(), elevations.copy()
+
+    # Each segment is split into this many parts, and contributes its start point plus the new points
+    segmentDistances = GetSegmentDistances(latitudes, longitudes)
+    partsPerSegment = np.maximum(np.ceil(segmentDistances / interpolationResolution), 1).astype(np.int64)
+    segmentIndices = np.repeat(np.arange(len(segmentDistances)), partsPerSegment)
+    firstOutputIndices = np.cumsum(partsPerSegment) - partsPerSegment
+    fractions = (np.arange(len(segmentIndices)) - firstOutputIndices[segmentIndices]) / \
+                partsPerSegment[segmentIndices].astype(np.float64)
+
+    # The original points are copied as is, only the new points are calculated
+    outputLatitudes = np.append(latitudes[segmentIndices], latitudes[-1])
+    outputLongitudes = np.append(longitudes[segmentIndices], longitudes[-1])
+    outputElevations = np.append(elevations[segmentIndices], elevations[-1])
+
+    newPoints = np.nonzero(fractions > 0)[0]
+    if len(newPoints) > 0:
+        fraction = fractions[newPoints]
+        startIndices = segmentIndices[newPoints]
+        latitude1 = np.radians(latitudes[startIndices])
+        longitude1 = np.radians(longitudes[startIndices])
+        latitude2 = np.radians(latitudes[startIndices + 1])
+        longitude2 = np.radians(longitudes[startIndices + 1])
+
+        # Spherical linear interpolation between the 2 points
+        angularDistance = segmentDistances[startIndices] / RADIUS_OF_EARTH
+        a = np.sin((1.0 - fraction) * angularDistance) / np.sin(angularDistance)
+        b = np.sin(fraction * angularDistance) / np.sin(angularDistance)
+        x = a * np.cos(latitude1) * np.cos(longitude1) + b * np.cos(latitude2) * np.cos(longitude2)
+        y = a * np.cos(latitude1) * np.sin(longitude1) + b * np.cos(latitude2) * np.sin(longitude2)
+        z = a * np.sin(latitude1) + b * np.sin(latitude2)
+
+        outputLatitudes[newPoints] = np.degrees(np.arctan2(z, np.sqrt(x ** 2 + y ** 2)))
+        outputLongitudes[newPoints] = np.degrees(np.arctan2(y, x))
+        outputElevations[newPoints] = elevations[startIndices] + \
+                                      fraction * (elevations[startIndices + 1] - elevations[startIndices])
+
+    return outputLatitudes, outputLongitudes, outputElevations
 
 
 def InterpolateBetweenPoints(gpxPoints, interpolationResolution):
@@ -201,39 +858,161 @@ def InterpolateBetweenPoints(gpxPoints, interpolationResolution):
         New points are placed between all points that are too far apart. The distance between points vary and are
         not equal in distance
     '''
-    if len(gpxPoints) <= 1:
-        return copy.deepcopy(gpxPoints)
+    latitudes, longitudes, elevations = InterpolateBetweenCoordinates([gpxPoint.latitude for gpxPoint in gpxPoints],
+                                                                      [gpxPoint.longitude for gpxPoint in gpxPoints],
+                                                                      [gpxPoint.elevation for gpxPoint in gpxPoints],
+                                                                      interpolationResolution)
+    return [GpxPoint(latitude, longitude, elevation) for latitude, longitude, elevation in
+            zip(latitudes.tolist(), longitudes.tolist(), elevations.tolist())]
+
 
-    elif len(gpxPoints) == 2:
-        distance = GetDistanceBetweenPoints(gpxPoints[0], gpxPoints[1])
+# The algorithms that GpxCourse.Simplify can use
+SIMPLIFICATION_METHODS = ["douglasPeucker", "visvalingam"]
 
-        if distance > interpolationResolution:
-            middlePoint = GetMiddlePoint(gpxPoints[0], gpxPoints[1])
 
-            outputCopy = []
-            # Recursively add the first + middle, and middle + last point
-            outputCopy.extend(InterpolateBetweenPoints([gpxPoints[0], middlePoint], interpolationResolution))
-            outputCopy.extend(InterpolateBetweenPoints([middlePoint, gpxPoints[1]], interpolationResolution))
+def GetReductionRatio(originalCourse, reducedCourse):
+    '''The fraction of the points of the original course that are left in the reduced course'''
+    return reducedCourse.GetNumberOfPoints() / float(max(originalCourse.GetNumberOfPoints(), 1))
+
+
+def _GetCartesianCoordinates(latitudes, longitudes, elevations=None):
+    '''
+        Convert the coordinates to x, y, z points in meters on the sphere, so distances can be measured in a straight
+        line. If the elevations are given, they are added as a 4th coordinate
+    '''
+    latitudes = np.radians(latitudes)
+    longitudes = np.radians(longitudes)
+    columns = [RADIUS_OF_EARTH * np.cos(latitudes) * np.cos(longitudes),
+               RADIUS_OF_EARTH * np.cos(latitudes) * np.sin(longitudes),
+               RADIUS_OF_EARTH * np.sin(latitudes)]
+    if elevations is not None:
+        columns.append(np.asarray(elevations, dtype=np.float64))
+    return np.column_stack(columns)
+
+
+def _GetDistancesToSegments(points, starts, ends):
+    '''The distance of every point (row) to the line segment between the start and end points on the same row'''
+    segments = ends - starts
+    segmentLengthsSquared = np.einsum("ij,ij->i", segments, segments)
+    fractions = np.einsum("ij,ij->i", points - starts, segments) / np.where(segmentLengthsSquared > 0,
+                                                                            segmentLengthsSquared, 1.0)
+    closestPoints = starts + np.clip(fractions, 0.0, 1.0)[:, np.newaxis] * segments
+    return np.sqrt(np.einsum("ij,ij->i", points - closestPoints, points - closestPoints))
+
+
+def _SimplifyDouglasPeucker(points, tolerance):
+    '''
+        Douglas-Peucker simplification of the points (one per row). All the ranges that still have to be split are
+        handled together, so every level of the recursion is a single pass over the points.
+        Returns a boolean array of the points to keep
+    '''
+    numberOfPoints = len(points)
+    if numberOfPoints < 3:
+        return np.ones(numberOfPoints, dtype=bool)
+    keep = np.zeros(numberOfPoints, dtype=bool)
+    keep[[0, -1]] = True
+    starts = np.array([0])
+    ends = np.array([numberOfPoints - 1])
+    while True:
+        # The number of points between the start and end of every range
+        lengths = ends - starts - 1
+        hasPoints = lengths > 0
+        starts, ends, lengths = starts[hasPoints], ends[hasPoints], lengths[hasPoints]
+        if len(starts) == 0:
+            break
 
-            return outputCopy
+        rangeIds = np.repeat(np.arange(len(starts)), lengths)
+        rangeOffsets = np.cumsum(lengths) - lengths
+        indices = np.arange(lengths.sum()) - rangeOffsets[rangeIds] + starts[rangeIds] + 1
+        distances = _GetDistancesToSegments(points[indices], points[starts[rangeIds]], points[ends[rangeIds]])
 
-        else:  # 2 points are fine, just return them
-            return copy.deepcopy(gpxPoints)
+        # The point furthest away from the segment of every range
+        maxDistances = np.maximum.reduceat(distances, rangeOffsets)
+        candidates = np.flatnonzero(distances == maxDistances[rangeIds])
+        firstCandidates = candidates[np.concatenate([[True], np.diff(rangeIds[candidates]) != 0])]
+        splits = indices[firstCandidates]
 
+        # Ranges with a point too far away are split at that point
+        split = maxDistances > tolerance
+        keep[splits[split]] = True
+        starts, ends = np.concatenate([starts[split], splits[split]]), np.concatenate([splits[split], ends[split]])
+
+    return keep
+
+
+def _GetTriangleAreas(points1, points2, points3):
+    '''The areas of the triangles on every row of the points, in any number of dimensions'''
+    sides1 = points2 - points1
+    sides2 = points3 - points1
+    areasSquared = (np.einsum("ij,ij->i", sides1, sides1) * np.einsum("ij,ij->i", sides2, sides2) -
+                    np.einsum("ij,ij->i", sides1, sides2) ** 2)
+    return 0.5 * np.sqrt(np.maximum(areasSquared, 0.0))
+
+
+def _SimplifyVisvalingam(points, tolerance):
+    '''
+        Visvalingam-Whyatt simplification of the points (one per row). The point with the smallest triangle is removed
+        until all the triangles are at least tolerance^2. Uses a heap, so it is O(n log n).
+        Returns a boolean array of the points to keep
+    '''
+    numberOfPoints = len(points)
+    if numberOfPoints < 3:
+        return np.ones(numberOfPoints, dtype=bool)
+
+    minimumArea = tolerance * tolerance
+    pointList = points.tolist()
+    keep = [True] * numberOfPoints
+    previous = range(-1, numberOfPoints - 1)
+    following = range(1, numberOfPoints + 1)
+    areas = [0.0] + _GetTriangleAreas(points[:-2], points[1:-1], points[2:]).tolist() + [0.0]
+    # Only the points that are small enough to be removed have to be on the heap
+    heap = [(area, index) for index, area in enumerate(areas) if area < minimumArea and 0 < index < numberOfPoints - 1]
+    heapq.heapify(heap)
+
+    while heap:
+        area, index = heapq.heappop(heap)
+        # Skip heap entries of removed points, or with an area that has changed since
+        if not keep[index] or area != areas[index]:
+            continue
+        keep[index] = False
+        previousIndex = previous[index]
+        nextIndex = following[index]
+        following[previousIndex] = nextIndex
+        previous[nextIndex] = previousIndex
+        # The neighbours get new triangles. They may not get smaller than the removed one, so that the order in which
+        # points are removed stays the same
+        for neighbour in (previousIndex, nextIndex):
+            if 0 < neighbour < numberOfPoints - 1:
+                point1 = pointList[previous[neighbour]]
+                point2 = pointList[neighbour]
+                point3 = pointList[following[neighbour]]
+                side1 = [value2 - value1 for value1, value2 in zip(point1, point2)]
+                side2 = [value3 - value1 for value1, value3 in zip(point1, point3)]
+                dot11 = sum([value * value for value in side1])
+                dot22 = sum([value * value for value in side2])
+                dot12 = sum([value1 * value2 for value1, value2 in zip(side1, side2)])
+                newArea = max(area, 0.5 * sqrt(max(dot11 * dot22 - dot12 * dot12, 0.0)))
+                areas[neighbour] = newArea
+                if newArea < minimumArea:
+                    heapq.heappush(heap, (newArea, neighbour))
+
+    return np.array(keep, dtype=bool)
+
+
+def _SimplifyCoordinates(latitudes, longitudes, elevations, tolerance, method, useElevation):
+    '''Simplify the coordinates, see GpxCourse.Simplify. Returns a (latitudes, longitudes, elevations) tuple of arrays'''
+    coordinates = _GetCartesianCoordinates(latitudes, longitudes, elevations if useElevation else None)
+    if method == "douglasPeucker":
+        keep = _SimplifyDouglasPeucker(coordinates, tolerance)
     else:
-        distanceBetweenStartAndFinish = 0.0
-        for index in range(0, len(gpxPoints)-2):
-            distanceBetweenStartAndFinish += GetDistanceBetweenPoints(gpxPoints[index], gpxPoints[index+1])
-        if distanceBetweenStartAndFinish <= interpolationResolution:
-            # if the distance between the first and the last point are still within spec, we can remove all points inbetween
-            outputCopy = [gpxPoints[0], gpxPoints[-1]]
-            return copy.deepcopy(outputCopy)
+        keep = _SimplifyVisvalingam(coordinates, tolerance)
+    return latitudes[keep], longitudes[keep], elevations[keep]
 
-    outputCopy = []
-    upperIndex = len(gpxPoints) - 1
-    outputCopy.extend(InterpolateBetweenPoints(gpxPoints[0:upperIndex/2], interpolationResolution))
-    outputCopy.extend(InterpolateBetweenPoints(gpxPoints[upperIndex/2:upperIndex], interpolationResolution))
-    return outputCopy
+
+def _MapSegment(job):
+    '''Worker of GpxCourse.MapSegments'''
+    function, latitudes, longitudes, elevations = job
+    return function(latitudes, longitudes, elevations)
 
 
 class GpxPoint:
@@ -274,13 +1053,51 @@ class SlopePoint:
 class GpxCourse:
     '''
         Represents a course, which is an array of GpxPoints.
+        The points are stored as read-only latitude, longitude and elevation columns.
+        The course can be made up of several tracks, each with one or more segments (e.g. every day of a tour, or
+        every time the gps lost its signal). They are stored as the indices of their first points. The distance
+        between 2 segments still counts towards the course distance, but no points are ever made up in between.
         Class is immutable and will give a copy whenever you try and change something
     '''
     def __init__(self, gpxPoints, name=""):
-        self.__gpxPoints = gpxPoints
+        self.__SetColumns([gpxPoint.latitude for gpxPoint in gpxPoints],
+                          [gpxPoint.longitude for gpxPoint in gpxPoints],
+                          [gpxPoint.elevation for gpxPoint in gpxPoints])
         self.name = name
 
 
+    @classmethod
+    def FromArrays(cls, latitudes, longitudes, elevations, name="", segmentStarts=None, trackStarts=None,
+                   cumulativeDistances=None):
+        '''
+            Create a GpxCourse straight from latitude, longitude and elevation arrays, without any GpxPoints.
+            segmentStarts and trackStarts are the indices of the first point of every segment and track. Every track
+            start is a segment start as well. By default the whole course is one track with one segment.
+            Precomputed cumulative distances (see GetCumulativeDistances) are used as is, instead of calculating them
+        '''
+        gpxCourse = cls([], name)
+        gpxCourse.__SetColumns(latitudes, longitudes, elevations, segmentStarts, trackStarts)
+        if cumulativeDistances is not None:
+            cumulativeDistances = _ReadOnlyArray(cumulativeDistances)
+            if len(cumulativeDistances) != gpxCourse.GetNumberOfPoints():
+                raise ValueError("There must be a cumulative distance for every point")
+            gpxCourse.__cumulativeDistances = cumulativeDistances
+        return gpxCourse
+
+
+    def __SetColumns(self, latitudes, longitudes, elevations, segmentStarts=None, trackStarts=None):
+        self.__latitudes = _ReadOnlyArray(latitudes)
+        self.__longitudes = _ReadOnlyArray(longitudes)
+        self.__elevations = _ReadOnlyArray(elevations)
+        if not len(self.__latitudes) == len(self.__longitudes) == len(self.__elevations):
+            raise ValueError("The latitude, longitude and elevation arrays must have the same length")
+        self.__trackStarts = _GetStarts(trackStarts, len(self.__latitudes))
+        self.__segmentStarts = _GetStarts(np.union1d(_GetStarts(segmentStarts, len(self.__latitudes)),
+                                                     self.__trackStarts), len(self.__latitudes))
+        # Built on first use by GetCumulativeDistances
+        self.__cumulativeDistances = None
+
+
     def SetName(self, name):
         self.name = name
 
@@ -290,24 +1107,117 @@ class GpxCourse:
 
 
     def GetNumberOfPoints(self):
-        return len(self.__gpxPoints)
+        return len(self.__latitudes)
 
 
-    # Overload the [] by returning a copy of the gpx point
+    # Overload the [] by returning a new gpx point (or a list of them for a slice)
     def __getitem__(self, key):
-        return copy.deepcopy (self.__gpxPoints[key])
+        if isinstance(key, slice):
+            return [self[index] for index in range(*key.indices(self.GetNumberOfPoints()))]
+        return GpxPoint(float(self.__latitudes[key]), float(self.__longitudes[key]), float(self.__elevations[key]))
 
 
     def GetGpxPoints(self):
-        return copy.deepcopy(self.__gpxPoints)
+        if _instrumentation.enabled:
+            _instrumentation.Count("pointListCopies")
+        return [GpxPoint(latitude, longitude, elevation) for latitude, longitude, elevation in
+                zip(self.__latitudes.tolist(), self.__longitudes.tolist(), self.__elevations.tolist())]
+
+
+    def GetLatitudes(self):
+        '''Read-only array of all the latitudes'''
+        return _ReadOnlyView(self.__latitudes)
+
+
+    def GetLongitudes(self):
+        '''Read-only array of all the longitudes'''
+        return _ReadOnlyView(self.__longitudes)
+
+
+    def GetElevations(self):
+        '''Read-only array of all the elevations'''
+        return _ReadOnlyView(self.__elevations)
+
+
+    def GetSegmentStarts(self):
+        '''Read-only array with the index of the first point of every segment'''
+        return _ReadOnlyView(self.__segmentStarts)
+
+
+    def GetTrackStarts(self):
+        '''Read-only array with the index of the first point of every track'''
+        return _ReadOnlyView(self.__trackStarts)
+
+
+    def GetNumberOfSegments(self):
+        return len(self.__segmentStarts)
+
+
+    def GetNumberOfTracks(self):
+        return len(self.__trackStarts)
+
+
+    def GetSegment(self, index):
+        '''Get a segment as a GpxCourse of its own'''
+        start = self.__segmentStarts[index]
+        stop = self.__segmentStarts[index + 1] if index + 1 < len(self.__segmentStarts) else self.GetNumberOfPoints()
+        return GpxCourse.FromArrays(self.__latitudes[start:stop], self.__longitudes[start:stop],
+                                    self.__elevations[start:stop], self.name)
+
+
+    def GetSegments(self):
+        return [self.GetSegment(index) for index in range(0, self.GetNumberOfSegments())]
+
+
+    def MapSegments(self, function, processes=1):
+        '''
+            Run function(latitudes, longitudes, elevations) on every segment on its own, and join the
+            (latitudes, longitudes, elevations) arrays it returns into a new GpxCourse with the same segments and tracks.
+            With more than 1 process the segments are spread over a pool of worker processes, so the function has to be
+            picklable (a module level function, or a functools.partial of one)
+        '''
+        stops = np.append(self.__segmentStarts[1:], self.GetNumberOfPoints())
+        jobs = [(function, self.__latitudes[start:stop], self.__longitudes[start:stop],
+                 self.__elevations[start:stop]) for start, stop in zip(self.__segmentStarts, stops)]
+        if processes > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(processes, len(jobs)))
+            try:
+                # map keeps the segments in order
+                results = pool.map(_MapSegment, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_MapSegment(job) for job in jobs]
+
+        if len(results) == 0:
+            return GpxCourse.FromArrays([], [], [], self.name)
+        segmentLengths = [len(latitudes) for latitudes, _, _ in results]
+        segmentStarts = np.cumsum([0] + segmentLengths[:-1])
+        trackStarts = segmentStarts[np.searchsorted(self.__segmentStarts, self.__trackStarts)]
+        return GpxCourse.FromArrays(np.concatenate([result[0] for result in results]),
+                                    np.concatenate([result[1] for result in results]),
+                                    np.concatenate([result[2] for result in results]), self.name,
+                                    segmentStarts, trackStarts)
+
+
+    def GetCumulativeDistances(self):
+        '''
+            Read-only array with the distance from the start of the course up to each point.
+            The distances are only calculated once, the first time they are needed
+        '''
+        if self.__cumulativeDistances is None:
+            segmentDistances = GetSegmentDistances(self.__latitudes, self.__longitudes)
+            cumulativeDistances = np.zeros(self.GetNumberOfPoints())
+            np.cumsum(segmentDistances, out=cumulativeDistances[1:])
+            self.__cumulativeDistances = _ReadOnlyArray(cumulativeDistances)
+
+        return _ReadOnlyView(self.__cumulativeDistances)
 
 
     def GetDistanceAtIndex(self, index):
         '''Get the total distance of the given array of Points, up to a certain index'''
-        totalDistance = 0.0
-        for index in range(0, index): # do for indices 0 to index-1
-            totalDistance += GetDistanceBetweenPoints(self[index], self[index + 1])
-        return totalDistance
+        return float(self.GetCumulativeDistances()[index])
 
 
     def GetTotalDistance(self):
@@ -317,121 +1227,274 @@ class GpxCourse:
 
     def GetElevationAtDistance(self, distance):
         '''Finds the elevation at a given distance. Will also use linear interpolation between points'''
-        # First we use binary search to find the distance
-        lower = 0
-        upper = self.GetNumberOfPoints() - 1
-        while lower < upper:
-            middleIndex = lower + (upper - lower) // 2
-            middleDistance = self.GetDistanceAtIndex(middleIndex)
-            if distance == middleDistance:
-                return self[middleIndex].elevation
-            elif distance > middleDistance:
-                if lower == middleIndex:
-                    break
-                lower = middleIndex
-            elif distance < middleDistance:
-                upper = middleIndex
-
-        # if we end up here, it means that we have to interpolate between upper and lower...
-        x1 = self.GetDistanceAtIndex(lower)
-        y1 = self[lower].elevation
-        x2 = self.GetDistanceAtIndex(upper)
-        y2 = self[upper].elevation
-        elevation = LinearInterpolate(x1, y1, x2, y2, distance)
-
-        return elevation
+        return _InterpolateAtDistance(self.GetCumulativeDistances(), self.__elevations, distance)
+
+
+    def GetElevationsAtDistances(self, distances):
+        '''Array version of GetElevationAtDistance, returns an array with the elevation at each of the distances'''
+        return _InterpolateAtDistances(self.GetCumulativeDistances(), self.__elevations, distances)
 
 
+    @InstrumentedStage
     def RemoveAllDuplicateGpxPoints(self):
-        outputPoints = []
-        outputPoints.append(self[0])
-        for index in range(1, self.GetNumberOfPoints()-1):
-            distance = GetDistanceBetweenPoints(self[index], self[index - 1])
-            if distance > 0:
-                outputPoints.append(copy.copy(self[index]))
+        # Keep the first point of every segment, and every point after it that is not at the same position as its
+        # previous point
+        keep = np.zeros(self.GetNumberOfPoints(), dtype=bool)
+        keep[1:] = GetSegmentDistances(self.__latitudes, self.__longitudes) > 0
+        keep[self.__segmentStarts] = True
+
+        # The new index of every kept point
+        newIndices = np.cumsum(keep) - 1
+        return GpxCourse.FromArrays(self.__latitudes[keep], self.__longitudes[keep], self.__elevations[keep], self.name,
+                                    newIndices[self.__segmentStarts], newIndices[self.__trackStarts])
+
+
+    @InstrumentedStage
+    def Simplify(self, tolerance, method="douglasPeucker", useElevation=False, processes=1):
+        '''
+            Return a new GpxCourse with only the points that are needed to keep the shape of the course within the
+            tolerance in meters. The method is one of SIMPLIFICATION_METHODS. For Douglas-Peucker the tolerance is the
+            largest distance a removed point may be from the simplified track. For Visvalingam-Whyatt points are
+            removed while the triangle they form with their neighbours is smaller than tolerance^2 square meters.
+            With useElevation the elevation is taken into account as well, so climbs and descents keep their shape.
+            The first and last points of every segment are always kept. Use GetReductionRatio to see how much smaller it
+            became. The segments are simplified on their own, in parallel if processes is more than 1
+        '''
+        if method not in SIMPLIFICATION_METHODS:
+            raise ValueError("Unknown simplification method " + str(method) + ", use one of " +
+                             ", ".join(SIMPLIFICATION_METHODS))
+        if tolerance < 0:
+            raise ValueError("The tolerance cannot be negative, got " + str(tolerance))
+
+        return self.MapSegments(functools.partial(_SimplifyCoordinates, tolerance=tolerance, method=method,
+                                                  useElevation=useElevation), processes)
+
 
-        return GpxCourse(outputPoints, self.name)
+    @InstrumentedStage
+    def CorrectElevation(self, apiKey=None, elevationCache=None, elevationProvider=None):
+        '''
+            Return a new GpxCourse with the elevations from the ElevationProvider, or from Google (using the apiKey) if
+            no provider is given. If an ElevationCache is given, only the points which are not in the cache are
+            requested, and the new elevations are added to the cache
+        '''
+        if elevationProvider is None:
+            elevationProvider = GoogleElevationProvider(apiKey)
+
+        if elevationCache is not None:
+            elevations = elevationCache.GetElevations(self.__latitudes, self.__longitudes)
+        else:
+            elevations = np.empty(self.GetNumberOfPoints())
+            elevations.fill(np.nan)
 
+        missing = np.nonzero(np.isnan(elevations))[0]
+        if len(missing) > 0:
+            elevations[missing] = elevationProvider.GetElevations(self.__latitudes[missing], self.__longitudes[missing])
+            if elevationCache is not None:
+                elevationCache.SetElevations(self.__latitudes[missing], self.__longitudes[missing], elevations[missing])
 
-    def CorrectElevation(self, apiKey):
-        newPoints = GetCorrectElevationFromGoogle(self.GetGpxPoints(), apiKey)
-        return GpxCourse(newPoints, self.name)
+        return GpxCourse.FromArrays(self.__latitudes, self.__longitudes, elevations, self.name, self.__segmentStarts,
+                                    self.__trackStarts)
 
 
+    @InstrumentedStage
     def PruneDistance(self, distance, start=0):
         '''
             Return a new GpxCourse which is a copy of the current instance expect that the distance is limited
             to the distance passed as parameter
         '''
-        newGpxPoints = []
-        index = 0
-        while index < self.GetNumberOfPoints():
-            currentDistance = self.GetDistanceAtIndex(index)
-            if currentDistance > distance:
-                break
-            if currentDistance >= start:
-                newGpxPoints.append(self[index])
-            index += 1
+        cumulativeDistances = self.GetCumulativeDistances()
+        startIndex = np.searchsorted(cumulativeDistances, start, side="left")
+        stopIndex = np.searchsorted(cumulativeDistances, distance, side="right")
+        stopIndex = max(startIndex, stopIndex)
 
-        return GpxCourse(newGpxPoints, self.name)
+        return GpxCourse.FromArrays(self.__latitudes[startIndex:stopIndex], self.__longitudes[startIndex:stopIndex],
+                                    self.__elevations[startIndex:stopIndex], self.name,
+                                    self.__segmentStarts - startIndex, self.__trackStarts - startIndex)
 
 
-    def InterpolateToGivenResolution(self, interpolationResolution):
+    @InstrumentedStage
+    def InterpolateToGivenResolution(self, interpolationResolution, processes=1):
         '''
             Create a new GpxCourse where none of the points are further apart than the interpolation resolution.
             New points are placed between all points that are too far apart. The distance between points vary and are
-            not equal in distance
+            not equal in distance. The gaps between segments are left as is. The segments are interpolated on their
+            own, in parallel if processes is more than 1
         '''
-        newGpxPoints = self.GetGpxPoints()
-        newGpxPoints = InterpolateBetweenPoints(newGpxPoints, interpolationResolution)
-        return GpxCourse(newGpxPoints, self.name)
+        if interpolationResolution <= 0:
+            raise ValueError("The interpolation resolution must be larger than 0")
+        return self.MapSegments(functools.partial(InterpolateBetweenCoordinates,
+                                                  interpolationResolution=interpolationResolution), processes)
 
 
+    @InstrumentedStage
     def CreateProfile(self):
         '''
             Take a Point array and return a new ProfilePoint array. 
             The profile is easier to do processing on so is a good first step
         '''
-        outputPoints = []
-        distance = 0.0
-        outputPoints.append(ProfilePoint(distance, self[0].elevation))
-        for index in range(0, self.GetNumberOfPoints() - 1):
-            distance += GetDistanceBetweenPoints(self[index], self[index + 1])
-            outputPoints.append(ProfilePoint(distance, self[index + 1].elevation))
-
-        return ProfileCourse(outputPoints, self.name)
+        return ProfileCourse.FromArrays(self.GetCumulativeDistances(), self.__elevations, self.name)
 
 
+    @InstrumentedStage
     def CreateEquidistantProfile(self, gapInMeters):
         '''
             Take a Point array and return a new ProfilePoint array where all points are equally far apart (specified by the gapInMeters
             parameter. This is extremely useful when you want to do filtering on the data because filters are highly
-            dependent on the sampling frequency of the data
+            dependent on the sampling frequency of the data. The gap does not have to be a whole number of meters.
+            The last point is always at the end of the course
         '''
-        # First generate a profile, then we will interpolate
-        profilePoints = self.CreateProfile()
+        if gapInMeters <= 0:
+            raise ValueError("The gap has to be larger than 0, got " + str(gapInMeters))
+        if self.GetNumberOfPoints() == 0:
+            return ProfileCourse.FromArrays([], [], self.name)
 
-        outputPoints = []
-        totalDistance = profilePoints.GetTotalDistance()
-        truncatedTotalDistance = int(totalDistance)
-        for distance in range(0, truncatedTotalDistance, gapInMeters):
-            elevation = profilePoints.GetElevationAtDistance(distance)
-            outputPoints.append(ProfilePoint(distance, elevation))
+        distances = self.GetCumulativeDistances()
+        totalDistance = float(distances[-1])
+        sampleDistances = np.arange(0.0, totalDistance, gapInMeters)
+        if len(sampleDistances) == 0 or sampleDistances[-1] < totalDistance:
+            sampleDistances = np.append(sampleDistances, totalDistance)
 
-        # Now add the last point, which we did not get with the trunk
-        if truncatedTotalDistance < totalDistance:
-            outputPoints.append(ProfilePoint(totalDistance, profilePoints.GetElevationAtDistance(totalDistance)))
+        # All the samples are interpolated in one go over the distance and elevation columns
+        return ProfileCourse.FromArrays(sampleDistances, np.interp(sampleDistances, distances, self.__elevations),
+                                        self.name)
 
-        return ProfileCourse(outputPoints, self.name)
 
+# The filters that ProfileCourse.Smooth can use
+SMOOTHING_METHODS = ["movingAverage", "median", "savitzkyGolay", "lowPass"]
+
+
+def _GetLowPassFactor(windowSize):
+    '''The factor of the first order low-pass filter with the same span as a moving average of windowSize points'''
+    return 2.0 / (windowSize + 1.0)
+
+
+def _GetSmoothingContext(method, windowSize):
+    '''
+        The number of points on each side of a point that influence its smoothed value. For the low-pass filter,
+        which never forgets completely, this is where the influence has dropped below 1e-9
+    '''
+    if method == "lowPass":
+        factor = _GetLowPassFactor(windowSize)
+        if factor >= 1.0:
+            return 0
+        return int(math.ceil(math.log(1e-9) / math.log(1.0 - factor)))
+    return windowSize // 2
+
+
+def _CheckSmoothingParameters(method, windowSize, polynomialOrder):
+    if method not in SMOOTHING_METHODS:
+        raise ValueError("Unknown smoothing method " + str(method) + ", use one of " + ", ".join(SMOOTHING_METHODS))
+    if windowSize < 1 or (method != "lowPass" and windowSize % 2 == 0):
+        raise ValueError("The smoothing window has to be an odd number of points, got " + str(windowSize))
+    if method == "savitzkyGolay" and not 0 <= polynomialOrder < windowSize:
+        raise ValueError("The polynomial order has to be smaller than the window size, got " + str(polynomialOrder))
+
+
+def _LowPassForward(values, factor):
+    '''
+        First order low-pass filter y[i] = factor * x[i] + (1 - factor) * y[i - 1], starting at y[-1] = x[0].
+        The recursion is solved in closed form for blocks of points, as long as the powers of (1 - factor) fit in a float
+    '''
+    decay = 1.0 - factor
+    if decay <= 0.0:
+        return values.copy()
+    output = np.empty_like(values)
+    blockSize = max(1, int(100 * math.log(10) / -math.log(decay)))
+    previous = values[0]
+    for start in range(0, len(values), blockSize):
+        block = values[start:start + blockSize]
+        powers = decay ** np.arange(1, len(block) + 1)
+        output[start:start + len(block)] = powers * (previous + factor * np.cumsum(block / powers))
+        previous = output[start + len(block) - 1]
+    return output
+
+
+def _SmoothElevations(elevations, method, windowSize, polynomialOrder):
+    '''Smooth the elevation array with one of the SMOOTHING_METHODS. The result has the same length'''
+    elevations = np.asarray(elevations, dtype=np.float64)
+    if len(elevations) < 2 or windowSize == 1:
+        return elevations.copy()
+
+    # Extend both ends with the point reflection of the data, which keeps the ends of a steady climb in place
+    context = _GetSmoothingContext(method, windowSize)
+    padded = np.pad(elevations, context, mode="reflect", reflect_type="odd")
+
+    if method == "movingAverage":
+        smoothed = np.convolve(padded, np.ones(windowSize) / windowSize, mode="valid")
+    elif method == "median":
+        windows = np.lib.stride_tricks.as_strided(padded, shape=(len(elevations), windowSize),
+                                                  strides=(padded.strides[0], padded.strides[0]))
+        smoothed = np.median(windows, axis=1)
+    elif method == "savitzkyGolay":
+        # Fitting a polynomial to the window and taking its value in the middle is the same as a convolution
+        offsets = np.arange(-context, context + 1, dtype=np.float64)
+        coefficients = np.linalg.pinv(np.vander(offsets, polynomialOrder + 1, increasing=True))[0]
+        smoothed = np.convolve(padded, coefficients[::-1], mode="valid")
+    else:
+        # Filter forward and then backward, so that the profile is not shifted
+        factor = _GetLowPassFactor(windowSize)
+        smoothed = _LowPassForward(_LowPassForward(padded, factor)[::-1], factor)[::-1]
+        smoothed = smoothed[context:context + len(elevations)]
+
+    return smoothed
 
-class ProfileCourse:
 
+def SmoothElevationChunks(elevationChunks, method="movingAverage", windowSize=5, polynomialOrder=2):
+    '''
+        Streaming version of ProfileCourse.Smooth. Takes an iterable of elevation arrays (of equidistant points) and
+        yields the smoothed elevations chunk by chunk, so only a chunk and a window of points are kept in memory.
+        The output is the same as smoothing all the elevations at once (for the low-pass filter, to within 1e-9 of
+        the elevation changes)
+    '''
+    _CheckSmoothingParameters(method, windowSize, polynomialOrder)
+    context = _GetSmoothingContext(method, windowSize)
+    # The points before the pending points, which are already smoothed but still needed as context
+    previous = np.empty(0)
+    pending = np.empty(0)
+    for chunk in elevationChunks:
+        pending = np.concatenate([pending, np.asarray(chunk, dtype=np.float64)])
+        # Keep enough points after the last output point to smooth it
+        numberReady = len(pending) - context
+        if numberReady <= 0:
+            continue
+        window = np.concatenate([previous, pending])
+        smoothed = _SmoothElevations(window, method, windowSize, polynomialOrder)
+        yield smoothed[len(previous):len(previous) + numberReady]
+        previous = window[max(0, len(previous) + numberReady - context):len(previous) + numberReady]
+        pending = pending[numberReady:]
+
+    if len(previous) + len(pending) > 0:
+        smoothed = _SmoothElevations(np.concatenate([previous, pending]), method, windowSize, polynomialOrder)
+        yield smoothed[len(previous):]
+
+
+class ProfileCourse:
+    '''
+        Represents a profile, which is an array of ProfilePoints.
+        The points are stored as read-only distance and elevation columns.
+        Class is immutable and will give a copy whenever you try and change something
+    '''
     def __init__(self, profilePoints, name=""):
-        self.__profilePoints = profilePoints
+        self.__SetColumns([profilePoint.distance for profilePoint in profilePoints],
+                          [profilePoint.elevation for profilePoint in profilePoints])
         self.name = name
 
 
+    @classmethod
+    def FromArrays(cls, distances, elevations, name=""):
+        '''Create a ProfileCourse straight from distance and elevation arrays, without any ProfilePoints'''
+        profileCourse = cls([], name)
+        profileCourse.__SetColumns(distances, elevations)
+        return profileCourse
+
+
+    def __SetColumns(self, distances, elevations):
+        self.__distances = _ReadOnlyArray(distances)
+        self.__elevations = _ReadOnlyArray(elevations)
+        if len(self.__distances) != len(self.__elevations):
+            raise ValueError("The distance and elevation arrays must have the same length")
+
+
     def SetName(self, name):
         self.name = name
 
@@ -440,17 +1503,32 @@ class ProfileCourse:
         return self.name
 
 
-    # Overload the [] by returning a copy of the gpx point
+    # Overload the [] by returning a new profile point (or a list of them for a slice)
     def __getitem__(self, key):
-        return copy.deepcopy(self.__profilePoints[key])
+        if isinstance(key, slice):
+            return [self[index] for index in range(*key.indices(self.GetNumberOfPoints()))]
+        return ProfilePoint(float(self.__distances[key]), float(self.__elevations[key]))
 
 
     def GetNumberOfPoints(self):
-        return len(self.__profilePoints)
+        return len(self.__distances)
 
 
     def GetProfilePoints(self):
-        return copy.deepcopy(self.__profilePoints)
+        if _instrumentation.enabled:
+            _instrumentation.Count("pointListCopies")
+        return [ProfilePoint(distance, elevation) for distance, elevation in
+                zip(self.__distances.tolist(), self.__elevations.tolist())]
+
+
+    def GetDistances(self):
+        '''Read-only array of all the distances'''
+        return _ReadOnlyView(self.__distances)
+
+
+    def GetElevations(self):
+        '''Read-only array of all the elevations'''
+        return _ReadOnlyView(self.__elevations)
 
 
     def GetElevationGain(self):
@@ -458,209 +1536,451 @@ class ProfileCourse:
             Get the total elevation gain of the profile. This value may be a bit optimistic on unfiltered data because
             each jitter with a positive value will increase the elevation gain.
         '''
-        elevationGain = 0
-        for index in range(0, self.GetNumberOfPoints() - 1):
-            elevationDifference = self[index + 1].elevation - self[index].elevation
-            if elevationDifference > 0:
-                elevationGain += elevationDifference
-
-        return elevationGain
+        elevationDifferences = np.diff(self.__elevations)
+        return float(elevationDifferences[elevationDifferences > 0].sum())
 
 
     def GetTotalDistance(self):
-        return self[-1].distance
+        return float(self.__distances[-1])
 
 
     def GetHighestElevation(self):
         '''
             Get the highest elevation of the profile. 
         '''
-        highestElevation = self[0].elevation
-        for index in range(0, self.GetNumberOfPoints()):
-            if self[index].elevation > highestElevation:
-                highestElevation = self[index].elevation
-
-        return highestElevation
+        return float(self.__elevations.max())
 
 
     def GetLowestElevation(self):
         '''
             Get the lowest elevation of the profile. 
         '''
-        lowestElevation = self[0].elevation
-        for index in range(0, self.GetNumberOfPoints()):
-            if self[index].elevation < lowestElevation:
-                lowestElevation = self[index].elevation
-
-        return lowestElevation
+        return float(self.__elevations.min())
 
 
     def GetElevationAtDistance(self, distance):
         '''Finds the elevation at a given distance. Will also use linear interpolation between points'''
-        # First we use binary search to find the distance
-        lower = 0
-        upper = self.GetNumberOfPoints() - 1
-        while lower < upper:
-            middleIndex = lower + (upper - lower) // 2
-            middleDistance = self[middleIndex].distance
-            if distance == middleDistance:
-                return self[middleIndex].elevation
-            elif distance > middleDistance:
-                if lower == middleIndex:
-                    break
-                lower = middleIndex
-            elif distance < middleDistance:
-                upper = middleIndex
-
-        # if we end up here, it means that we have to interpolate between upper and lower...
-        x1 = self[lower].distance
-        y1 = self[lower].elevation
-        x2 = self[upper].distance
-        y2 = self[upper].elevation
-        elevation = LinearInterpolate(x1, y1, x2, y2, distance)
-
-        return elevation
+        return _InterpolateAtDistance(self.__distances, self.__elevations, distance)
+
+
+    def GetElevationsAtDistances(self, distances):
+        '''Array version of GetElevationAtDistance, returns an array with the elevation at each of the distances'''
+        return _InterpolateAtDistances(self.__distances, self.__elevations, distances)
 
 
     def GetAverageDistanceBetweenPoints(self):
-        return self[-1].distance / self.GetNumberOfPoints()
+        return self.GetTotalDistance() / self.GetNumberOfPoints()
 
 
-    def CreateSlopeCourse(self):
+    @InstrumentedStage
+    def Smooth(self, method="movingAverage", windowSize=5, polynomialOrder=2, chunkSize=None):
         '''
-        Convert the Profile points to slope/distance points and return a Slope Course.
+            Return a new ProfileCourse with smoothed elevations, to get rid of the gps jitter. This only makes sense
+            for an equidistant profile, because the window is a number of points. The method is one of
+            SMOOTHING_METHODS: a moving average, a median, a Savitzky-Golay filter (with the given polynomial order) or
+            a forward-backward first order low-pass filter. If a chunk size is given, the elevations are smoothed a
+            chunk at a time to limit the memory use
         '''
-        slopePoints = []
-        trailingIndex = 0
-        for index in range(1, self.GetNumberOfPoints() - 1):
-            previousPoint = self[trailingIndex]
-            currentPoint = self[index]
+        _CheckSmoothingParameters(method, windowSize, polynomialOrder)
+        if chunkSize is None:
+            elevations = _SmoothElevations(self.__elevations, method, windowSize, polynomialOrder)
+        else:
+            elevationChunks = (self.__elevations[start:start + chunkSize]
+                               for start in range(0, self.GetNumberOfPoints(), chunkSize))
+            elevations = np.concatenate([np.empty(0)] + list(SmoothElevationChunks(elevationChunks, method,
+                                                                                    windowSize, polynomialOrder)))
+        return ProfileCourse.FromArrays(self.__distances, elevations, self.name)
 
-            distanceBetweenPoints = currentPoint.distance - previousPoint.distance
 
-            if distanceBetweenPoints == 0:
-                continue
+    @InstrumentedStage
+    def CreateSlopeCourse(self):
+        '''
+        Convert the Profile points to slope/distance points and return a Slope Course.
+        The profile distances are expected to be increasing, which is the case for all the profiles we create.
+        '''
+        # The last profile point is never the end of a slope, it only sets the distance of the last slope point
+        distances = self.__distances[:-1]
+        elevations = self.__elevations[:-1]
 
-            elevationGainBetweenPoints = currentPoint.elevation - previousPoint.elevation
-            slope = float(elevationGainBetweenPoints) / float(distanceBetweenPoints) * 100.0
+        # Points which are at the same distance as the point before them are skipped. The slope is then
+        # calculated from the first point at that distance
+        keep = np.ones(len(distances), dtype=bool)
+        keep[1:] = distances[1:] != distances[:-1]
+        distances = distances[keep]
+        elevations = elevations[keep]
 
-            # Slopes are constant between 2 profile points. So we should make it "look" like a bar graph
-            # by adding 2 points for each slope
-            slopePoints.append(SlopePoint(previousPoint.distance, slope))
-            slopePoints.append(SlopePoint(currentPoint.distance, slope))
+        if len(distances) < 2:
+            return SlopeCourse([])
 
-            trailingIndex = index
+        slopes = np.diff(elevations) / np.diff(distances) * 100.0
 
-        if len(slopePoints) == 0:
-            return SlopeCourse(slopePoints)
+        # Slopes are constant between 2 profile points. So we should make it "look" like a bar graph
+        # by adding 2 points for each slope, and then the last point
+        slopeDistances = np.empty(2 * len(slopes) + 1)
+        slopeDistances[0:-1:2] = distances[:-1]
+        slopeDistances[1::2] = distances[1:]
+        slopeDistances[-1] = self.__distances[-1]
 
-        # Add the last point
-        lastPoint = self[-1]
-        lastSlopePoint = slopePoints[-1]
-        slopePoints.append(SlopePoint(lastPoint.distance, lastSlopePoint.slope))
+        slopeValues = np.empty(2 * len(slopes) + 1)
+        slopeValues[0:-1:2] = slopes
+        slopeValues[1::2] = slopes
+        slopeValues[-1] = slopes[-1]
 
-        return SlopeCourse(slopePoints)
+        return SlopeCourse.FromArrays(slopeDistances, slopeValues)
 
 
 
 class SlopeCourse:
     '''
     Represents a slope based course where the course is represented by slope instead of the normal elevation
+    The points are stored as read-only distance and slope columns.
     Class is immutable and will give a copy whenever you try and change something
     '''
     def __init__(self, slopePoints):
-        self.__slopePoints = slopePoints
+        self.__SetColumns([slopePoint.distance for slopePoint in slopePoints],
+                          [slopePoint.slope for slopePoint in slopePoints])
 
 
-    # Overload the [] by returning a copy of the slope point
+    @classmethod
+    def FromArrays(cls, distances, slopes):
+        '''Create a SlopeCourse straight from distance and slope arrays, without any SlopePoints'''
+        slopeCourse = cls([])
+        slopeCourse.__SetColumns(distances, slopes)
+        return slopeCourse
+
+
+    def __SetColumns(self, distances, slopes):
+        self.__distances = _ReadOnlyArray(distances)
+        self.__slopes = _ReadOnlyArray(slopes)
+        if len(self.__distances) != len(self.__slopes):
+            raise ValueError("The distance and slope arrays must have the same length")
+
+
+    # Overload the [] by returning a new slope point (or a list of them for a slice)
     def __getitem__(self, key):
-        return copy.copy(self.__slopePoints[key])
+        if isinstance(key, slice):
+            return [self[index] for index in range(*key.indices(self.GetNumberOfPoints()))]
+        return SlopePoint(float(self.__distances[key]), float(self.__slopes[key]))
 
 
     def GetNumberOfPoints(self):
-        return len(self.__slopePoints)
+        return len(self.__distances)
 
 
     def GetSlopePoints(self):
-        return copy.deepcopy(self.__slopePoints)
+        if _instrumentation.enabled:
+            _instrumentation.Count("pointListCopies")
+        return [SlopePoint(distance, slope) for distance, slope in
+                zip(self.__distances.tolist(), self.__slopes.tolist())]
+
+
+    def GetDistances(self):
+        '''Read-only array of all the distances'''
+        return _ReadOnlyView(self.__distances)
+
+
+    def GetSlopes(self):
+        '''Read-only array of all the slopes'''
+        return _ReadOnlyView(self.__slopes)
 
 
     def GetSlopeAtDistance(self, distance):
         '''Finds the slope at a given distance. '''
-        # First we use binary search to find the distance
-        lower = 0
-        upper = self.GetNumberOfPoints() - 1
-        while lower < upper:
-            middleIndex = lower + (upper - lower) // 2
-            middleDistance = self[middleIndex].distance
-            if distance == middleDistance:
-                return self[middleIndex].slope
-            elif distance > middleDistance:
-                if lower == middleIndex:
-                    break
-                lower = middleIndex
-            elif distance < middleDistance:
-                upper = middleIndex
-
-        # if we end up here it means that we are between 2 points. We don't interpolate slopes, slopes are constant
-        # and we need to return the lower bound slope
-        return self[lower].slope
+        return float(self.GetSlopesAtDistances([distance])[0])
+
+
+    def GetSlopesAtDistances(self, distances):
+        '''
+            Array version of GetSlopeAtDistance. We don't interpolate slopes, slopes are constant until the next point,
+            so every distance gets the slope of the last point at or before it (or the first slope before the start)
+        '''
+        indices = np.searchsorted(self.__distances, np.asarray(distances, dtype=np.float64), side="right") - 1
+        return self.__slopes[np.clip(indices, 0, self.GetNumberOfPoints() - 1)]
 
 
     def GetAverageDistanceBetweenPoints(self):
-        return self[-1].distance / self.GetNumberOfPoints()
+        return float(self.__distances[-1]) / self.GetNumberOfPoints()
+
 
+    def GetRelativeElevations(self):
+        '''The elevation at every point, relative to the start of the course'''
+        elevations = np.zeros(self.GetNumberOfPoints())
+        elevations[1:] = np.cumsum(self.__slopes[:-1] / 100.0 * np.diff(self.__distances))
+        return elevations
 
-    def Compress(self):
-        # TODO: Test me
+
+    @InstrumentedStage
+    def Compress(self, maxElevationError=0, slopeStep=0):
+        '''
+            Return a new SlopeCourse without the points that are not needed. By default only points with the same
+            slope as the point before them are removed, which loses nothing.
+            With a maximum elevation error (in meters) runs of slopes are merged into one slope, as long as the
+            elevation of the course stays within the error everywhere. With a slope step (in %) the slopes are also
+            rounded to multiples of the step. A slope between two points that has no multiple of the step within the
+            error is still rounded, so the error can then be up to half the step over the distance between the points
+            (e.g. 0.25% over 1000m is 2.5m), but it does not add up over the course.
+            Use GetMaxElevationError to see the error that was achieved.
+            The last point, which marks the end of the course, is always kept
+        '''
+        if maxElevationError < 0 or slopeStep < 0:
+            raise ValueError("The maximum elevation error and slope step cannot be negative")
+        if maxElevationError > 0 or slopeStep > 0:
+            return self.__CompressWithinError(maxElevationError, slopeStep)
+
+        # A point is only needed when its slope differs from the slope of the point before it
+        keep = np.ones(self.GetNumberOfPoints(), dtype=bool)
+        keep[1:] = self.__slopes[1:] != self.__slopes[:-1]
+        keep[-1:] = True
+        return SlopeCourse.FromArrays(self.__distances[keep], self.__slopes[keep])
+
+
+    def __CompressWithinError(self, maxElevationError, slopeStep):
+        '''
+            Merge the slopes in one pass over the points. While a run of slopes grows, we keep the range of slopes
+            that would keep every point of the run within the error. When the range becomes empty (or has no multiple
+            of the slope step left), the run ends at the previous point with the slope in the range that gets closest
+            to the elevation at its end, and the next run starts from there
+        '''
+        if self.GetNumberOfPoints() < 2:
+            return SlopeCourse.FromArrays(self.__distances, self.__slopes)
+
+        # Only the points where the distance changes are corners of the elevation profile
+        corners = np.ones(self.GetNumberOfPoints(), dtype=bool)
+        corners[1:] = np.diff(self.__distances) > 0
+        distances = self.__distances[corners].tolist()
+        elevations = self.GetRelativeElevations()[corners].tolist()
+        if len(distances) < 2:
+            return SlopeCourse.FromArrays(self.__distances[-1:], self.__slopes[-1:])
+
+        def IsFeasible(lowestSlope, highestSlope):
+            if slopeStep > 0:
+                return math.ceil(lowestSlope / slopeStep - 1e-9) * slopeStep <= highestSlope + 1e-9
+            return lowestSlope <= highestSlope
+
+        def ChooseSlope(lowestSlope, highestSlope, exactSlope):
+            if slopeStep == 0:
+                return min(max(exactSlope, lowestSlope), highestSlope)
+            slope = round(exactSlope / slopeStep) * slopeStep
+            if IsFeasible(lowestSlope, highestSlope):
+                slope = min(max(slope, math.ceil(lowestSlope / slopeStep - 1e-9) * slopeStep),
+                            math.floor(highestSlope / slopeStep + 1e-9) * slopeStep)
+            return slope
+
+        outputDistances = []
         outputSlopes = []
-        outputSlopes.append(self[0])
-        for index in range(1, self.GetNumberOfPoints()):
-            if outputSlopes[-1].slope != self[index].slope:
-                outputSlopes.append(self[index])
+        startDistance = distances[0]
+        startElevation = elevations[0]
+        startIndex = 0
+        lowestSlope, highestSlope = -np.inf, np.inf
+        index = 1
+        while True:
+            if index < len(distances):
+                gap = (distances[index] - startDistance) / 100.0
+                newLowestSlope = max(lowestSlope, (elevations[index] - maxElevationError - startElevation) / gap)
+                newHighestSlope = min(highestSlope, (elevations[index] + maxElevationError - startElevation) / gap)
+                # A run always takes at least one slope, even if it cannot be rounded to within the error. The next run
+                # aims at the original elevation again, so the rounding error does not add up
+                if index == startIndex + 1 or IsFeasible(newLowestSlope, newHighestSlope):
+                    lowestSlope, highestSlope = newLowestSlope, newHighestSlope
+                    index += 1
+                    continue
+
+            # End the run at the last point that fitted
+            endIndex = index - 1
+            gap = (distances[endIndex] - startDistance) / 100.0
+            slope = ChooseSlope(lowestSlope, highestSlope, (elevations[endIndex] - startElevation) / gap)
+            if outputSlopes == [] or outputSlopes[-1] != slope:
+                outputDistances.append(startDistance)
+                outputSlopes.append(slope)
+            startElevation += slope * gap
+            startDistance = distances[endIndex]
+            startIndex = endIndex
+            lowestSlope, highestSlope = -np.inf, np.inf
+            if index == len(distances):
+                break
 
-        return SlopeCourse(outputSlopes)
+        outputDistances.append(distances[-1])
+        outputSlopes.append(outputSlopes[-1])
+        return SlopeCourse.FromArrays(outputDistances, outputSlopes)
 
 
 
 
-def _GetAllGpxPointsFromRootXml(root):
-    gpxPoints = []
-    for child in root.findall('.//trkpt'):
-        latitude = float(child.attrib['lat'])
-        longitude = float(child.attrib['lon'])
+def GetMaxElevationError(slopeCourse, otherSlopeCourse):
+    '''The largest difference in (relative) elevation between two slope courses of the same course, in meters'''
+    distances = np.union1d(slopeCourse.GetDistances(), otherSlopeCourse.GetDistances())
+    if len(distances) == 0:
+        return 0.0
+    elevations = np.interp(distances, slopeCourse.GetDistances(), slopeCourse.GetRelativeElevations())
+    otherElevations = np.interp(distances, otherSlopeCourse.GetDistances(), otherSlopeCourse.GetRelativeElevations())
+    return float(np.max(np.abs(elevations - otherElevations)))
 
-        elevationTag = child.find("ele")
 
-        elevation = float(elevationTag.text) if elevationTag is not None else 0.0
+def ResampleProfiles(profiles, resolution):
+    '''
+        Resample the profiles onto one shared distance grid, every resolution meters over the distance all of them
+        cover. Returns the distances and a 2-D array with the elevations of every profile in a row
+    '''
+    if len(profiles) == 0:
+        raise ValueError("There are no profiles to resample")
+    if resolution <= 0:
+        raise ValueError("The resolution has to be larger than 0")
+    totalDistance = min(profile.GetTotalDistance() for profile in profiles)
+    distances = np.arange(0, int(totalDistance / resolution) + 1) * float(resolution)
+    elevations = np.empty((len(profiles), len(distances)))
+    for row, profile in enumerate(profiles):
+        elevations[row] = profile.GetElevationsAtDistances(distances)
+    return distances, elevations
 
-        gpxPoints.append(GpxPoint(latitude, longitude, elevation))
 
-    return gpxPoints
+# The profiles are compared in blocks of this many elevations (rows x grid points), so the memory use stays bounded
+PROFILE_COMPARISON_BLOCK_SIZE = 4000000
 
 
+def GetProfileDifferences(distances, elevations, gradientDistance=1000):
+    '''
+        Compare every pair of the resampled profiles (see ResampleProfiles). Returns a dictionary with the n x n
+        arrays rmse, maxDeviation (both in meters), gainDifference (the row's gain minus the column's gain) and
+        gradientDifference (the mean absolute difference of the average gradients, in %, of every gradientDistance
+        meters), plus the gains and the gradients (n x number of whole gradientDistances) themselves
+    '''
+    distances = np.asarray(distances, dtype=np.float64)
+    elevations = np.atleast_2d(np.asarray(elevations, dtype=np.float64))
+    numberOfProfiles, numberOfDistances = elevations.shape
+    if numberOfDistances == 0 or numberOfDistances != len(distances):
+        raise ValueError("Every profile needs an elevation at each of the (at least one) distances")
+
+    elevationDifferences = np.diff(elevations, axis=1)
+    gains = np.where(elevationDifferences > 0, elevationDifferences, 0).sum(axis=1)
+
+    # The elevations at every whole gradientDistance, the gradient is the slope between two of them
+    gradientDistances = np.arange(0, int(distances[-1] / gradientDistance) + 1) * float(gradientDistance)
+    gradientElevations = np.array([np.interp(gradientDistances, distances, row) for row in elevations])
+    gradients = np.diff(gradientElevations, axis=1) / gradientDistance * 100
+
+    rmse = np.zeros((numberOfProfiles, numberOfProfiles))
+    maxDeviation = np.zeros((numberOfProfiles, numberOfProfiles))
+    gradientDifference = np.zeros((numberOfProfiles, numberOfProfiles))
+    blockRows = max(1, PROFILE_COMPARISON_BLOCK_SIZE // (numberOfProfiles * numberOfDistances))
+    for start in range(0, numberOfProfiles, blockRows):
+        stop = min(start + blockRows, numberOfProfiles)
+        # The differences of this block of profiles with all the profiles: blockRows x n x grid points
+        differences = elevations[start:stop, np.newaxis, :] - elevations[np.newaxis, :, :]
+        rmse[start:stop] = np.sqrt(np.mean(differences ** 2, axis=2))
+        maxDeviation[start:stop] = np.abs(differences).max(axis=2)
+        if gradients.shape[1] > 0:
+            gradientDifference[start:stop] = np.abs(gradients[start:stop, np.newaxis, :] -
+                                                    gradients[np.newaxis, :, :]).mean(axis=2)
+
+    return {"rmse": rmse, "maxDeviation": maxDeviation, "gainDifference": gains[:, np.newaxis] - gains[np.newaxis, :],
+            "gradientDifference": gradientDifference, "gains": gains, "gradients": gradients}
+
+
+def _GetLocalTag(element):
+    '''Get the tag of the xml element, without the namespace'''
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def IterateGpxFile(inputFilename, metadata=None, includeRoutes=True):
+    '''
+        Parse the gpx file in a single pass and yield a (latitude, longitude, elevation) tuple for every track point as
+        soon as it has been read. Route points are yielded as well, unless includeRoutes is False. Elements are cleared
+        once they are processed, so the memory used stays the same no matter how large the file is.
+        If a metadata dictionary is given, the name of the course is stored in it under "name" as soon as it is found.
+        The metadata name is preferred over the track (or route) name.
+        The structure of the file is stored in the metadata as well: "trackStops" and "segmentStops" are lists with
+        the index after the last point of every track (trk or rte) and segment (trkseg, a route is a single segment),
+        and "routeTracks" lists the indices of the tracks that are routes. Empty tracks and segments are listed as well
+    '''
+    trackName = None
+    routeName = None
+    metadataName = None
+    trackStops = []
+    segmentStops = []
+    routeTracks = []
+    if metadata is not None:
+        metadata.update(trackStops=trackStops, segmentStops=segmentStops, routeTracks=routeTracks)
+
+    pointTags = ("trkpt", "rtept") if includeRoutes else ("trkpt",)
+    trackTags = ("trk", "rte") if includeRoutes else ("trk",)
+    numberOfPoints = 0
+    # Only the elements we need are reported, and the namespaces are matched with a wildcard
+    tags = ["{*}" + tag for tag in pointTags + trackTags + ("trkseg", "name")]
+    for _, element in iterparse(inputFilename, events=("end",), tag=tags):
+        tag = _GetLocalTag(element)
+        if tag in pointTags:
+            elevationTag = element.find("{*}ele")
+            elevation = float(elevationTag.text) if elevationTag is not None else 0.0
+            numberOfPoints += 1
+            yield float(element.get("lat")), float(element.get("lon")), elevation
+
+        elif tag == "name":
+            # Look for a name in either the trk, rte or the metadata tags. Tracks come after the routes in a gpx file,
+            # and their name is preferred
+            parentTag = _GetLocalTag(element.getparent())
+            if parentTag not in ("trk", "rte", "metadata"):
+                # The name of a point (or a link etc.), which is cleared with the point itself. Pruning here would
+                # drop the earlier children of the point, such as its elevation
+                continue
+            if parentTag == "trk" and trackName is None:
+                trackName = str(element.text).strip()
+                if metadata is not None and metadataName is None:
+                    metadata["name"] = trackName
+            elif parentTag == "rte" and routeName is None and trackName is None:
+                routeName = str(element.text).strip()
+                if metadata is not None and metadataName is None:
+                    metadata["name"] = routeName
+            elif parentTag == "metadata" and metadataName is None:
+                metadataName = str(element.text).strip()
+                if metadata is not None:
+                    metadata["name"] = metadataName
 
+        else:
+            # The end of a track or segment. Only the end events are used, because start events for every point would
+            # slow down the parsing. The element itself is left as is, its points have been cleared already
+            if tag in trackTags:
+                if tag == "rte":
+                    routeTracks.append(len(trackStops))
+                trackStops.append(numberOfPoints)
+            segmentStops.append(numberOfPoints)
+            continue
+
+        # Clear the processed element, and drop everything before it from its parent
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+@InstrumentedStage
 def ParseGpxFile(inputFilename):
-    '''Parse the gpx file and return a GpxCourse'''
-    with open(inputFilename, 'r') as myfile:
-        xmlData = myfile.read().replace('\n', '')
-    e = xml.etree.ElementTree.parse(inputFilename).getroot()
-    it = xml.etree.ElementTree.iterparse(StringIO(xmlData))
-    for _, el in it:
-        if '}' in el.tag:
-            el.tag = el.tag.split('}', 1)[1]  # strip all namespaces
-    root = it.root
-    gpxPoints = _GetAllGpxPointsFromRootXml(root)
-
-    gpxCourse = GpxCourse(gpxPoints)
-
-    # Look for a name in either the trk or the metadata tags
-    nameTag = root.find(".//trk/name")
-    if nameTag is not None:
-        gpxCourse.SetName(str(nameTag.text).strip())
-    nameTag = root.find(".//metadata/name")
-    if nameTag is not None:
-        gpxCourse.SetName(str(nameTag.text).strip())
+    '''
+        Parse the gpx file and return a GpxCourse, with the tracks and segments of the file. The points are streamed
+        straight into the course columns. The routes are only used when the file has no track points, because a route
+        is usually the plan of the ride that was recorded in the tracks
+    '''
+    metadata = {}
+    gpxData = IterateGpxFile(inputFilename, metadata)
+    points = np.fromiter(itertools.chain.from_iterable(gpxData), dtype=np.float64).reshape(-1, 3)
+
+    numberOfPoints = len(points)
+    trackStops = np.array(metadata["trackStops"], dtype=np.int64)
+    trackStarts = np.concatenate([[0], trackStops[:-1]]).astype(np.int64)
+    segmentStarts = np.concatenate([[0], metadata["segmentStops"][:-1]]).astype(np.int64)
+    isRoute = np.zeros(numberOfPoints, dtype=bool)
+    for routeTrack in metadata["routeTracks"]:
+        isRoute[trackStarts[routeTrack]:trackStops[routeTrack]] = True
+
+    if np.any(isRoute) and not np.all(isRoute):
+        keep = ~isRoute
+        # The new index of every point, where a dropped point gets the index of the next point that is kept
+        newIndices = np.concatenate([[0], np.cumsum(keep)])
+        points = points[keep]
+        trackStarts = newIndices[trackStarts]
+        segmentStarts = newIndices[segmentStarts]
+
+    gpxCourse = GpxCourse.FromArrays(points[:, 0], points[:, 1], points[:, 2], metadata.get("name", ""),
+                                     segmentStarts, trackStarts)
+
     # And if we don't have a name, use the filename as the name...
     if gpxCourse.GetName() == "":
         bareFilename = os.path.basename(os.path.splitext(inputFilename)[0])
@@ -669,125 +1989,646 @@ def ParseGpxFile(inputFilename):
     return gpxCourse
 
 
-def GenerateTcxSlopeWorkout(slopeCourse, outputName):
-    '''Create a tcx file of name outputName.tcx (do not add the extension to the name)'''
-    TrainingDbTag = E("TrainingCenterDatabase")
-    TrainingDbTag.attrib["xmlns"] = "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"
-    output = TrainingDbTag
-    Courses = E("Courses")
-    Course = E("Course")
-    CourseName = E("name", outputName)
-    Track = E("Track")
-
-    TrainingDbTag.append(Courses)
-    Courses.append(Course)
-    Course.append(CourseName)
-    Course.append(Track)
-
-    for slopePoint in slopeCourse.GetSlopePoints():
-        TrackPoint = E("Trackpoint")
-        Track.append(TrackPoint)
-        TrackPoint.append(E("DistanceMeters", str(slopePoint.distance)))
-        ExtensionsTag = E("Extensions")
-        TrackPoint.append(ExtensionsTag)
-        TPXTag = E("TPX")
-        ExtensionsTag.append(TPXTag)
-        TPXTag.append(E("Slope", str(slopePoint.slope)))
-
-    outputXml = tostring(output, pretty_print=True)
-
-    outputFilename = outputName + ".tcx"
-
-    with open(outputFilename, "w+") as f:
-        f.write('<?xml version="1.0"?>\n')
-        f.write(outputXml)
-
-
-def NextFigure(title = ""):
-    plt.figure(NextFigure.currentFigure)
-    NextFigure.currentFigure += 1
-    plt.title(title)
-NextFigure.currentFigure = 0
-
-
-def PlotSlope(slopeCourse, maxDistance, title = "", style=""):
-    NextFigure(title)
-    plotDataSlope = []
-    plotDataDistance = []
-    for slopePoint in slopeCourse.GetSlopePoints():
-        if slopePoint.distance > maxDistance and maxDistance > 0:
-            break
-        plotDataSlope.append(slopePoint.slope)
-        plotDataDistance.append(slopePoint.distance)
-    plt.plot(plotDataDistance, plotDataSlope, style)
-    plt.show()
-
-
-def PlotProfile(profile, maxDistance, title = "", style=""):
-    NextFigure(title)
-    plotDataElevation = []
-    plotDataDistance = []
-    for index in range(0, profile.GetNumberOfPoints() - 1):
-        if profile[index].distance > maxDistance and maxDistance > 0:
-            break
-        plotDataElevation.append(profile[index].elevation)
-        plotDataDistance.append(profile[index].distance)
-    plt.ylabel("Elevation (meters)")
-    plt.xlabel("Distance (meters)")
-    startDistance = profile[0].distance
-    totalDistance = profile.GetTotalDistance()
-    highestElevation = profile.GetHighestElevation()
-    lowestElevation = profile.GetLowestElevation()
-    elevationGain = profile.GetElevationGain()
-    textX = startDistance
-    textY = highestElevation
-    profileTextInfo = "Elevation Gain = " + str(int(elevationGain)) + "m\n"
-    profileTextInfo += "Total Distance = " + str(int(totalDistance)) + "m\n"
-    profileTextInfo += "Lowest Elevation = " + str(int(lowestElevation)) + "m\n"
-    profileTextInfo += "Highest Elevation = " + str(int(highestElevation)) + "m"
-
-    plt.text(textX, textY, profileTextInfo, multialignment="left",va="top", ha="left")
-
-    plt.plot(plotDataDistance, plotDataElevation, style)
-    plt.show()
-
-
-def PlotProfiles(profiles, maxDistance, title = "", style=""):
-    NextFigure(title)
-    for profile in profiles:
-        plotDataElevation = []
-        plotDataDistance = []
-        for index in range(0, profile.GetNumberOfPoints() - 1):
-            if profile[index].distance > maxDistance and maxDistance > 0:
+def WriteGpxFile(gpxCourse, filename):
+    '''
+        Write the course to a gpx file, with a trk for every track and a trkseg for every segment. The points are
+        streamed to the file in chunks. Returns the filename
+    '''
+    numberOfPoints = gpxCourse.GetNumberOfPoints()
+    segmentStarts = gpxCourse.GetSegmentStarts().tolist()
+    segmentStops = segmentStarts[1:] + [numberOfPoints]
+    trackStarts = set(gpxCourse.GetTrackStarts().tolist())
+    trackpointTemplate = '<trkpt lat="%r" lon="%r"><ele>%r</ele></trkpt>\n'
+
+    with open(filename, "w") as gpxFile:
+        gpxFile.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                      '<gpx version="1.1" creator="GpxLib" xmlns="http://www.topografix.com/GPX/1/1">\n')
+        for segmentIndex, (segmentStart, segmentStop) in enumerate(zip(segmentStarts, segmentStops)):
+            if segmentStart in trackStarts:
+                if segmentIndex > 0:
+                    gpxFile.write('</trk>\n')
+                gpxFile.write('<trk><name>' + xmlEscape(gpxCourse.GetName()) + '</name>\n')
+            gpxFile.write('<trkseg>\n')
+            for start in range(segmentStart, segmentStop, TCX_WRITE_CHUNK_SIZE):
+                stop = min(start + TCX_WRITE_CHUNK_SIZE, segmentStop)
+                gpxFile.write("".join(trackpointTemplate % point for point in
+                                      itertools.izip(gpxCourse.GetLatitudes()[start:stop].tolist(),
+                                                     gpxCourse.GetLongitudes()[start:stop].tolist(),
+                                                     gpxCourse.GetElevations()[start:stop].tolist())))
+            gpxFile.write('</trkseg>\n')
+        if len(segmentStarts) > 0:
+            gpxFile.write('</trk>\n')
+        gpxFile.write('</gpx>\n')
+
+    return filename
+
+
+# The binary course files start with this, followed by the version, the length of the json header and the header
+COURSE_FILE_MAGIC = "GPXCOURS"
+COURSE_FILE_VERSION = 1
+COURSE_FILE_EXTENSION = ".course"
+
+# The columns of the binary course files, in the order they are stored, with their (little endian) type
+_COURSE_FILE_COLUMNS = [("latitudes", "<f8"), ("longitudes", "<f8"), ("elevations", "<f8"),
+                        ("cumulativeDistances", "<f8"), ("segmentStarts", "<i8"), ("trackStarts", "<i8")]
+
+# The columns start at a multiple of the page size, so they can be memory mapped as they are
+_COURSE_FILE_ALIGNMENT = 4096
+
+
+def SaveCourse(gpxCourse, filename):
+    '''
+        Save the course to a binary course file, which LoadCourse can memory map. The file has a small json header with
+        the name and the number of values of every column, followed by the raw columns, including the cumulative
+        distances so they never have to be calculated again. Returns the filename
+    '''
+    columns = {"latitudes": gpxCourse.GetLatitudes(), "longitudes": gpxCourse.GetLongitudes(),
+               "elevations": gpxCourse.GetElevations(), "cumulativeDistances": gpxCourse.GetCumulativeDistances(),
+               "segmentStarts": gpxCourse.GetSegmentStarts(), "trackStarts": gpxCourse.GetTrackStarts()}
+    header = json.dumps({"name": gpxCourse.GetName(),
+                         "lengths": [len(columns[column]) for column, _ in _COURSE_FILE_COLUMNS]})
+    prefix = COURSE_FILE_MAGIC + np.array([COURSE_FILE_VERSION, len(header)], dtype="<u4").tostring() + header
+
+    with open(filename, "wb") as courseFile:
+        courseFile.write(prefix + "\0" * (-len(prefix) % _COURSE_FILE_ALIGNMENT))
+        for column, dtype in _COURSE_FILE_COLUMNS:
+            courseFile.write(np.ascontiguousarray(columns[column], dtype=dtype).tostring())
+
+    return filename
+
+
+def IsCourseFile(filename):
+    '''True if the file is a binary course file, rather than a gpx file'''
+    with open(filename, "rb") as courseFile:
+        return courseFile.read(len(COURSE_FILE_MAGIC)) == COURSE_FILE_MAGIC
+
+
+@InstrumentedStage
+def LoadCourse(filename):
+    '''
+        Load a GpxCourse from either a binary course file or a gpx file. Binary course files are memory mapped
+        read-only, so the columns are not copied or even read until they are used, and the pages are shared by all the
+        processes that load the same file
+    '''
+    if not IsCourseFile(filename):
+        return ParseGpxFile(filename)
+
+    data = np.memmap(filename, dtype=np.uint8, mode="r")
+    prefixLength = len(COURSE_FILE_MAGIC) + 8
+    version, headerLength = data[len(COURSE_FILE_MAGIC):prefixLength].view("<u4").tolist()
+    if version != COURSE_FILE_VERSION:
+        raise ValueError(filename + " is a version " + str(version) + " course file, only version " +
+                         str(COURSE_FILE_VERSION) + " is supported")
+    header = json.loads(data[prefixLength:prefixLength + headerLength].tostring())
+
+    columns = {}
+    offset = prefixLength + headerLength
+    offset += -offset % _COURSE_FILE_ALIGNMENT
+    for (column, dtype), length in zip(_COURSE_FILE_COLUMNS, header["lengths"]):
+        columnBytes = length * np.dtype(dtype).itemsize
+        columns[column] = data[offset:offset + columnBytes].view(dtype)
+        offset += columnBytes
+
+    return GpxCourse.FromArrays(columns["latitudes"], columns["longitudes"], columns["elevations"],
+                                header["name"].encode("utf-8"), columns["segmentStarts"], columns["trackStarts"],
+                                columns["cumulativeDistances"])
+
+
+def GetFileHash(filename):
+    '''The sha1 hex digest of the content of the file'''
+    fileHash = hashlib.sha1()
+    with open(filename, "rb") as hashedFile:
+        for block in iter(lambda: hashedFile.read(1024 * 1024), ""):
+            fileHash.update(block)
+    return fileHash.hexdigest()
+
+
+def GetCourseCacheParameters(interpolationResolution, startDistance=0, stopDistance=0, apiKey=None, srtmDirectory=None,
+                             simplifyTolerance=None, simplifyMethod="douglasPeucker", simplifyWithElevation=False,
+                             smoothing=None, smoothingWindow=5):
+    '''
+        The CourseCache parameters of the processed GpxCourse and of its (smoothed) equidistant ProfileCourse, for the
+        options of the scripts. All the scripts use this, so they share the cached courses.
+        Returns a (gpx parameters, profile parameters) tuple of dictionaries
+    '''
+    # The elevations come from the same source the scripts would choose
+    if srtmDirectory:
+        elevationSource = "srtm:" + os.path.abspath(srtmDirectory)
+    elif apiKey:
+        elevationSource = "google"
+    else:
+        elevationSource = "gpx"
+
+    # Options which are not used are left out, so they do not make new entries
+    gpxParameters = dict(stage="gpx", interpolationResolution=interpolationResolution, startDistance=startDistance,
+                         stopDistance=stopDistance, elevationSource=elevationSource)
+    if simplifyTolerance:
+        gpxParameters.update(simplifyTolerance=simplifyTolerance, simplifyMethod=simplifyMethod,
+                             simplifyWithElevation=simplifyWithElevation)
+    profileParameters = dict(gpxParameters, stage="profile")
+    if smoothing:
+        profileParameters.update(smoothing=smoothing, smoothingWindow=smoothingWindow)
+    return gpxParameters, profileParameters
+
+
+class CourseCache:
+    '''
+        Persistent cache of processed GpxCourses and ProfileCourses, stored as one numpy .npz file per course in the
+        given directory. Courses are keyed by the content of the gpx file they were made from, plus the parameters of
+        everything that was done to them, so changing either the file or an option gives a new entry.
+        When the files take up more than maxBytes, the least recently used ones are removed.
+        The cache is only there to save time, so a directory that cannot be read or written makes it miss rather than
+        fail. The hits and misses counters count the courses looked up since the cache was opened
+    '''
+    # Part of every key, so the cached courses are not used anymore when the way they are stored changes
+    _version = 1
+
+    def __init__(self, directory, maxBytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        # The file hashes, by (filename, size, modification time), so every file is only read once
+        self.__fileHashes = {}
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process created it in the meantime, or it cannot be created and every course is a miss
+                pass
+
+
+    def GetKey(self, inputFilename, **parameters):
+        '''The key of the course made from the gpx file with the given parameters. Parameters must be json values'''
+        fileStat = os.stat(inputFilename)
+        fileKey = (os.path.abspath(inputFilename), fileStat.st_size, fileStat.st_mtime)
+        if fileKey not in self.__fileHashes:
+            self.__fileHashes[fileKey] = GetFileHash(inputFilename)
+        description = json.dumps([self._version, self.__fileHashes[fileKey], parameters], sort_keys=True)
+        return hashlib.sha1(description).hexdigest()
+
+
+    def __GetFilename(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+
+    def Get(self, key):
+        '''Get the GpxCourse or ProfileCourse stored under the key, or None if it is not in the cache'''
+        filename = self.__GetFilename(key)
+        try:
+            with open(filename, "rb") as courseFile:
+                columns = np.load(courseFile, allow_pickle=False)
+                courseType = str(columns["type"])
+                name = str(columns["name"])
+                if courseType == "gpx":
+                    course = GpxCourse.FromArrays(columns["latitudes"], columns["longitudes"], columns["elevations"],
+                                                  name, columns["segmentStarts"], columns["trackStarts"])
+                else:
+                    course = ProfileCourse.FromArrays(columns["distances"], columns["elevations"], name)
+            # Mark it as recently used
+            os.utime(filename, None)
+        except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+            # Not in the cache, or a broken file which will be replaced
+            self.misses += 1
+            return None
+        self.hits += 1
+        return course
+
+
+    def Set(self, key, course):
+        '''
+            Store a GpxCourse or ProfileCourse, and evict the least recently used courses if the cache is full.
+            Returns False if the course could not be written, e.g. because the disk is full
+        '''
+        if isinstance(course, GpxCourse):
+            columns = dict(type="gpx", latitudes=course.GetLatitudes(), longitudes=course.GetLongitudes(),
+                           elevations=course.GetElevations(), segmentStarts=course.GetSegmentStarts(),
+                           trackStarts=course.GetTrackStarts())
+        else:
+            columns = dict(type="profile", distances=course.GetDistances(), elevations=course.GetElevations())
+
+        # Write to a temporary file first, so other processes never see a half written course
+        try:
+            fileHandle, temporaryFilename = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        except (IOError, OSError):
+            return False
+        try:
+            with os.fdopen(fileHandle, "wb") as courseFile:
+                np.savez(courseFile, name=course.GetName(), **columns)
+            filename = self.__GetFilename(key)
+            if os.name == "nt" and os.path.exists(filename):
+                # Windows does not rename over an existing file. It exists when another process stored the same
+                # course in the meantime, or when Get did not accept it
+                os.remove(filename)
+            os.rename(temporaryFilename, filename)
+        except (IOError, OSError):
+            try:
+                os.remove(temporaryFilename)
+            except OSError:
+                pass
+            return False
+        self.__Evict()
+        return True
+
+
+    def __Evict(self):
+        courseFiles = []
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return
+        for filename in filenames:
+            if filename.endswith(".npz"):
+                try:
+                    fileStat = os.stat(os.path.join(self.directory, filename))
+                except OSError:
+                    continue
+                courseFiles.append((fileStat.st_mtime, fileStat.st_size, filename))
+
+        totalBytes = sum(size for _, size, _ in courseFiles)
+        # The most recent file is always kept, even if it is larger than the cache
+        for _, size, filename in sorted(courseFiles)[:-1]:
+            if totalBytes <= self.maxBytes:
                 break
-            plotDataElevation.append(profile[index].elevation)
-            plotDataDistance.append(profile[index].distance)
-        totalElevationGain = profile.GetElevationGain()
-        profileLabel = profile.name + " (" + str(int(totalElevationGain)) + "m)"
-        plt.plot(plotDataDistance, plotDataElevation, style, label=profileLabel)
-
-
-    plt.ylabel("Elevation (meters)")
-    plt.xlabel("Distance (meters)")
-    plt.legend(loc='upper left')
-
-    plt.show()
-
-
-def PlotGpx(gpxCourse, maxDistance, title = "", style=""):
-    NextFigure(title)
-    plotDataEle = []
-    plotDataDistance = []
-    totalDistance = 0
-    plotDataEle.append(gpxCourse[0].elevation)
-    plotDataDistance.append(0)
-    for index in range(1, gpxCourse.GetNumberOfPoints() - 1):
-        totalDistance += GetDistanceBetweenPoints(gpxCourse[index], gpxCourse[index-1])
-        if totalDistance > maxDistance and maxDistance > 0:
-            break
-        plotDataEle.append(gpxCourse[index].elevation)
-        plotDataDistance.append(totalDistance)
-    plt.plot(plotDataDistance, plotDataEle, style)
-    plt.show()
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                pass
+            totalBytes -= size
+
+
+    def GetNumberOfEntries(self):
+        return len([filename for filename in os.listdir(self.directory) if filename.endswith(".npz")])
 
 
+def GetCachedCourse(courseCache, inputFilename, parameters, createFunction):
+    '''
+        Get the course made from the gpx file with the given parameters (a dictionary) from the CourseCache, or create
+        it with createFunction() and store it in the cache. Without a cache (None) the course is always created, and
+        so it is when the cache cannot be used
+    '''
+    if courseCache is None:
+        return createFunction()
+    try:
+        key = courseCache.GetKey(inputFilename, **parameters)
+    except (IOError, OSError):
+        # The file cannot be read to get its key, createFunction reports that if it matters
+        return createFunction()
+    course = courseCache.Get(key)
+    if course is None:
+        course = createFunction()
+        courseCache.Set(key, course)
+    return course
+
+
+def ProcessGpxFile(inputFilename, interpolationResolution, startDistance=0, stopDistance=0, apiKey=None,
+                   elevationCacheFilename=None, srtmDirectory=None, simplifyTolerance=None,
+                   simplifyMethod="douglasPeucker", simplifyWithElevation=False, smoothing=None, smoothingWindow=5,
+                   processes=1, courseCache=None, withGpxCourse=True, verbose=False, statistics=None):
+    '''
+        Run the pipeline all the scripts share on a gpx (or binary course) file: parse, simplify, interpolate, trim
+        and correct the elevations (from the SRTM tiles, or from google with the elevation cache file), and make the
+        (smoothed) equidistant profile. The gpx course and the profile are taken from the CourseCache when it is given
+        and has them, and stored in it otherwise.
+        Returns a (gpxCourse, profile) tuple. Without withGpxCourse the gpx course is not loaded when the profile is
+        in the cache, and is None then.
+        If a statistics dictionary is given, the (hits, misses) of the elevation cache are stored in it under
+        "elevationCache" when it is used
+    '''
+    gpxParameters, profileParameters = GetCourseCacheParameters(interpolationResolution, startDistance, stopDistance,
+                                                                apiKey, srtmDirectory, simplifyTolerance,
+                                                                simplifyMethod, simplifyWithElevation, smoothing,
+                                                                smoothingWindow)
+
+    def CreateGpxCourse():
+        if verbose:
+            print "Parsing ", inputFilename, "..."
+
+        gpxCourse = LoadCourse(inputFilename)
+
+        if verbose:
+            print "There are " + str(gpxCourse.GetNumberOfPoints()) + " gps points..."
+            if gpxCourse.GetNumberOfSegments() > 1:
+                print "In " + str(gpxCourse.GetNumberOfTracks()) + " tracks and " + \
+                      str(gpxCourse.GetNumberOfSegments()) + " segments..."
+
+        if simplifyTolerance:
+            simplifiedCourse = gpxCourse.Simplify(simplifyTolerance, simplifyMethod, simplifyWithElevation,
+                                                  processes)
+            if verbose:
+                print "Simplified to " + str(simplifiedCourse.GetNumberOfPoints()) + " gps points (%.1f%% of the points)" % (
+                    100 * GetReductionRatio(gpxCourse, simplifiedCourse))
+            gpxCourse = simplifiedCourse
+
+        if verbose:
+            print "Interpolating..."
+
+        gpxCourse = gpxCourse.InterpolateToGivenResolution(interpolationResolution, processes)
+
+        if startDistance > 0 or stopDistance > 0:
+            if verbose:
+                print "Trimming..."
+            gpxCourse = gpxCourse.PruneDistance(stopDistance if stopDistance > 0 else sys.maxint, startDistance)
+
+        if verbose:
+            print "There are " + str(gpxCourse.GetNumberOfPoints()) + " gps points after interpolation..."
+
+        if srtmDirectory:
+            if verbose:
+                print "Getting all the elevation data from the SRTM tiles..."
+            gpxCourse = gpxCourse.CorrectElevation(elevationProvider=SrtmElevationProvider(srtmDirectory))
+        elif apiKey:
+            if verbose:
+                print "Getting all the elevation data from google..."
+            elevationCache = ElevationCache(elevationCacheFilename) if elevationCacheFilename else None
+            try:
+                gpxCourse = gpxCourse.CorrectElevation(apiKey, elevationCache)
+            finally:
+                if elevationCache is not None:
+                    elevationCache.Close()
+            if elevationCache is not None:
+                if verbose:
+                    print "Elevation cache: " + str(elevationCache.hits) + " hits, " + str(elevationCache.misses) + \
+                          " misses"
+                if statistics is not None:
+                    statistics["elevationCache"] = (elevationCache.hits, elevationCache.misses)
+        return gpxCourse
+
+    # The gpx course is only loaded (or created) once, whether the profile needs it or the caller does
+    gpxCourses = []
+
+    def GetGpxCourse():
+        if not gpxCourses:
+            gpxCourses.append(GetCachedCourse(courseCache, inputFilename, gpxParameters, CreateGpxCourse))
+        return gpxCourses[0]
+
+    def CreateProfile():
+        profile = GetGpxCourse().CreateEquidistantProfile(interpolationResolution)
+        if smoothing:
+            profile = profile.Smooth(smoothing, smoothingWindow)
+        return profile
+
+    if withGpxCourse:
+        GetGpxCourse()
+    profile = GetCachedCourse(courseCache, inputFilename, profileParameters, CreateProfile)
+    if verbose and courseCache is not None:
+        print "Course cache: " + str(courseCache.hits) + " hits, " + str(courseCache.misses) + " misses"
+    return (gpxCourses[0] if gpxCourses else None), profile
+
+
+# The tcx trackpoints (and fit records) are written in chunks of this many points, so the memory use does not grow
+# with the course
+TCX_WRITE_CHUNK_SIZE = 10000
+
+WORKOUT_FORMATS = ["tcx", "fit"]
+
+
+def GetWorkoutFilename(outputName, outputFormat="tcx", compress=False):
+    '''The name of the workout file that is written for outputName in the given format'''
+    if outputFormat not in WORKOUT_FORMATS:
+        raise ValueError("Unknown workout format " + str(outputFormat) + ", use one of " + ", ".join(WORKOUT_FORMATS))
+    return outputName + "." + outputFormat + (".gz" if compress else "")
+
+
+def GetWorkoutOutputName(outputFilename):
+    '''The outputName of a workout filename: the filename without its trailing .gz, .tcx and .fit extensions'''
+    outputName, extension = os.path.splitext(outputFilename)
+    while extension.lower() in [".gz"] + ["." + outputFormat for outputFormat in WORKOUT_FORMATS]:
+        outputFilename = outputName
+        outputName, extension = os.path.splitext(outputFilename)
+    return outputFilename
+
+
+def _OpenWorkoutFile(outputName, outputFormat, compress):
+    '''Open the workout file of outputName for writing, gzipped if compress is set. Returns the file and its name'''
+    outputFilename = GetWorkoutFilename(outputName, outputFormat, compress)
+    if compress:
+        return gzip.open(outputFilename, "wb"), outputFilename
+    return open(outputFilename, "wb"), outputFilename
+
+
+def _GetTcxTemplates(compact):
+    '''Get the header, trackpoint and footer templates of a tcx course file, either indented or without whitespace'''
+    lines = [(0, '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">'),
+             (1, '<Courses>'), (2, '<Course>'), (3, '<name>%(name)s</name>'), (3, '<Track>')]
+    trackpointLines = [(4, '<Trackpoint>'), (5, '<DistanceMeters>%(distance)s</DistanceMeters>'), (5, '<Extensions>'),
+                       (6, '<TPX>'), (7, '<Slope>%(slope)s</Slope>'), (6, '</TPX>'), (5, '</Extensions>'),
+                       (4, '</Trackpoint>')]
+    footerLines = [(3, '</Track>'), (2, '</Course>'), (1, '</Courses>'), (0, '</TrainingCenterDatabase>')]
+
+    def Join(taggedLines):
+        if compact:
+            return "".join(line for _, line in taggedLines)
+        return "".join("  " * indent + line + "\n" for indent, line in taggedLines)
+
+    header = '<?xml version="1.0"?>' + ("" if compact else "\n") + Join(lines)
+    return header, Join(trackpointLines), Join(footerLines)
+
+
+@InstrumentedStage
+def GenerateTcxSlopeWorkout(slopeCourse, outputName, distancePrecision=2, slopePrecision=2, compact=False,
+                            compress=False, name=None):
+    '''
+        Create a tcx file of name outputName.tcx (do not add the extension to the name). The name of the course in
+        the file defaults to the outputName.
+        The trackpoints are streamed to the file, with the distances and slopes rounded to the given number of
+        decimals. compact leaves out all the whitespace and compress writes a gzipped outputName.tcx.gz instead.
+        Returns the name of the file that was written
+    '''
+    header, trackpointTemplate, footer = _GetTcxTemplates(compact)
+    trackpointTemplate = trackpointTemplate % {"distance": "%%.%df" % distancePrecision,
+                                               "slope": "%%.%df" % slopePrecision}
+
+    outputFile, outputFilename = _OpenWorkoutFile(outputName, "tcx", compress)
+    with outputFile:
+        outputFile.write(header % {"name": xmlEscape(outputName if name is None else name)})
+        distances = slopeCourse.GetDistances()
+        slopes = slopeCourse.GetSlopes()
+        for start in range(0, len(distances), TCX_WRITE_CHUNK_SIZE):
+            stop = start + TCX_WRITE_CHUNK_SIZE
+            outputFile.write("".join(trackpointTemplate % point for point in
+                                     itertools.izip(distances[start:stop].tolist(), slopes[start:stop].tolist())))
+        outputFile.write(footer)
+
+    return outputFilename
+
+
+# Fit timestamps are seconds since 1989-12-31 00:00 UTC
+FIT_EPOCH = 631065600
+FIT_PROTOCOL_VERSION = 0x10
+FIT_PROFILE_VERSION = 2132
+# The record timestamps of a course are the times a virtual partner riding at this speed (m/s) gets to the points
+FIT_COURSE_SPEED = 25 / 3.6
+# The longest course name (in bytes) most devices show
+FIT_MAX_NAME_BYTES = 31
+
+# Base types of the fit fields
+_FIT_ENUM = 0x00
+_FIT_STRING = 0x07
+_FIT_SINT16 = 0x83
+_FIT_UINT16 = 0x84
+_FIT_UINT32 = 0x86
+
+# Global message numbers
+_FIT_FILE_ID = 0
+_FIT_LAP = 19
+_FIT_RECORD = 20
+_FIT_EVENT = 21
+_FIT_COURSE = 31
+
+
+def _GetFitCrcTable():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_FIT_CRC_TABLE = _GetFitCrcTable()
+
+
+def GetFitCrc(data, crc=0):
+    '''The fit (CRC-16/ARC) checksum of the data, continued from the checksum of the data before it'''
+    table = _FIT_CRC_TABLE
+    for byte in bytearray(data):
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class _FitMessage:
+    '''
+        A local fit message type: the definition message and the numpy dtype of its data messages. The fields are
+        (field number, numpy type, fit base type) tuples, in the order they are written
+    '''
+    def __init__(self, localType, globalNumber, fields):
+        self.definition = struct.pack("<BBBHB", 0x40 | localType, 0, 0, globalNumber, len(fields)) + \
+                          "".join(struct.pack("<BBB", number, np.dtype(numpyType).itemsize, baseType)
+                                  for number, numpyType, baseType in fields)
+        self.dtype = np.dtype([("header", "u1")] + [("f%d" % number, numpyType) for number, numpyType, _ in fields])
+        self.localType = localType
+
+
+    def Pack(self, *columns):
+        '''The data messages of the given columns (one value or array per field) as a string'''
+        numberOfMessages = max([np.size(column) for column in columns] + [1])
+        messages = np.zeros(numberOfMessages, dtype=self.dtype)
+        messages["header"] = self.localType
+        for name, column in zip(self.dtype.names[1:], columns):
+            messages[name] = column
+        return messages.tostring()
+
+
+class _FitFileWriter:
+    '''Writes the header, the messages and the trailing checksum of a fit file, keeping the checksum as it goes'''
+    def __init__(self, outputFile, dataSize):
+        self.__outputFile = outputFile
+        self.__crc = 0
+        header = struct.pack("<BBHI4s", 14, FIT_PROTOCOL_VERSION, FIT_PROFILE_VERSION, dataSize, ".FIT")
+        self.Write(header + struct.pack("<H", GetFitCrc(header)))
+
+
+    def Write(self, data):
+        self.__crc = GetFitCrc(data, self.__crc)
+        self.__outputFile.write(data)
+
+
+    def Close(self):
+        self.__outputFile.write(struct.pack("<H", self.__crc))
+
+
+@InstrumentedStage
+def GenerateFitSlopeWorkout(slopeCourse, outputName, compress=False, name=None, profile=None,
+                            speed=FIT_COURSE_SPEED):
+    '''
+        Create a binary fit course file of name outputName.fit (do not add the extension to the name), with a record
+        with the distance and grade of every slope point. If the ProfileCourse is given, the records also get the
+        altitude, which starts at the elevation of the profile and follows the slopes.
+        The name of the course defaults to the outputName. The records are streamed to the file in chunks and
+        compress writes a gzipped outputName.fit.gz instead. Returns the name of the file that was written
+    '''
+    distances = slopeCourse.GetDistances()
+    slopes = slopeCourse.GetSlopes()
+    numberOfPoints = len(distances)
+    if numberOfPoints == 0:
+        raise ValueError("Cannot write a fit course without any points")
+
+    relativeElevations = slopeCourse.GetRelativeElevations()
+    elevationChanges = np.diff(relativeElevations)
+    startTime = int(time.time()) - FIT_EPOCH
+    totalDistance = float(distances[-1])
+    totalTime = int(round((totalDistance - distances[0]) / speed))
+
+    courseName = outputName if name is None else name
+    if not isinstance(courseName, unicode):
+        courseName = courseName.decode("utf-8", "replace")
+    # Cut the name without cutting a character in half, the string field ends with a null byte
+    courseName = courseName.encode("utf-8")[:FIT_MAX_NAME_BYTES].decode("utf-8", "ignore").encode("utf-8") + "\0"
+
+    recordFields = [(253, "<u4", _FIT_UINT32), (5, "<u4", _FIT_UINT32), (9, "<i2", _FIT_SINT16)]
+    if profile is not None:
+        recordFields.append((2, "<u2", _FIT_UINT16))
+
+    fileIdMessage = _FitMessage(0, _FIT_FILE_ID, [(0, "u1", _FIT_ENUM), (1, "<u2", _FIT_UINT16),
+                                                  (2, "<u2", _FIT_UINT16), (4, "<u4", _FIT_UINT32)])
+    courseMessage = _FitMessage(1, _FIT_COURSE, [(4, "u1", _FIT_ENUM), (5, "S%d" % len(courseName), _FIT_STRING)])
+    lapMessage = _FitMessage(2, _FIT_LAP, [(253, "<u4", _FIT_UINT32), (2, "<u4", _FIT_UINT32),
+                                           (7, "<u4", _FIT_UINT32), (8, "<u4", _FIT_UINT32),
+                                           (9, "<u4", _FIT_UINT32), (21, "<u2", _FIT_UINT16),
+                                           (22, "<u2", _FIT_UINT16)])
+    eventMessage = _FitMessage(3, _FIT_EVENT, [(253, "<u4", _FIT_UINT32), (0, "u1", _FIT_ENUM),
+                                               (1, "u1", _FIT_ENUM)])
+    recordMessage = _FitMessage(4, _FIT_RECORD, recordFields)
+
+    # The header holds the size of the data, which is known up front so the file can be streamed (also gzipped)
+    messages = [fileIdMessage, courseMessage, lapMessage, eventMessage, recordMessage]
+    dataSize = sum(len(message.definition) + message.dtype.itemsize for message in messages) + \
+               eventMessage.dtype.itemsize + (numberOfPoints - 1) * recordMessage.dtype.itemsize
+
+    outputFile, outputFilename = _OpenWorkoutFile(outputName, "fit", compress)
+    with outputFile:
+        fitFile = _FitFileWriter(outputFile, dataSize)
+        # A course file (6) from a development manufacturer (255), for cycling (2)
+        fitFile.Write(fileIdMessage.definition + fileIdMessage.Pack(6, 255, 0, startTime))
+        fitFile.Write(courseMessage.definition + courseMessage.Pack(2, courseName))
+        fitFile.Write(lapMessage.definition +
+                      lapMessage.Pack(startTime, startTime, totalTime * 1000, totalTime * 1000,
+                                      int(round(totalDistance * 100)),
+                                      min(int(round(elevationChanges[elevationChanges > 0].sum())), 0xFFFE),
+                                      min(int(round(-elevationChanges[elevationChanges < 0].sum())), 0xFFFE)))
+        # The timer start event (0, 0)
+        fitFile.Write(eventMessage.definition + eventMessage.Pack(startTime, 0, 0))
+
+        fitFile.Write(recordMessage.definition)
+        if profile is not None:
+            startElevation = profile.GetElevationsAtDistances(distances[:1])[0]
+        for start in range(0, numberOfPoints, TCX_WRITE_CHUNK_SIZE):
+            stop = start + TCX_WRITE_CHUNK_SIZE
+            columns = [startTime + np.round((distances[start:stop] - distances[0]) / speed),
+                       np.round(distances[start:stop] * 100),
+                       np.round(np.clip(slopes[start:stop], -327.67, 327.67) * 100)]
+            if profile is not None:
+                altitudes = startElevation + relativeElevations[start:stop]
+                columns.append(np.round((np.clip(altitudes, -500, 12606) + 500) * 5))
+            fitFile.Write(recordMessage.Pack(*columns))
+
+        # The timer stop disable all event (0, 9)
+        fitFile.Write(eventMessage.Pack(startTime + totalTime, 0, 9))
+        fitFile.Close()
+
+    return outputFilename
+
+
+def GenerateSlopeWorkout(slopeCourse, outputName, outputFormat="tcx", compact=False, compress=False, name=None,
+                         profile=None):
+    '''
+        Write the slope course as a tcx or fit workout (see WORKOUT_FORMATS) named outputName plus the extension.
+        compact is only used by tcx and the profile (for the altitudes) only by fit. Returns the name of the file
+    '''
+    if outputFormat == "fit":
+        return GenerateFitSlopeWorkout(slopeCourse, outputName, compress=compress, name=name, profile=profile)
+    if outputFormat == "tcx":
+        return GenerateTcxSlopeWorkout(slopeCourse, outputName, compact=compact, compress=compress, name=name)
+    raise ValueError("Unknown workout format " + str(outputFormat) + ", use one of " + ", ".join(WORKOUT_FORMATS))
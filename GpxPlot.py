@@ -0,0 +1,154 @@
+# (c) 2018 Phillip Myburgh
+# Distributed under the MIT Licence
+
+# Plotting of the GpxLib courses. matplotlib is only imported once something is plotted, so the library and the
+# conversions stay quick to load when nothing is plotted.
+#
+# The Plot* functions open interactive windows. The Save*Plot functions render straight to an image file without
+# pyplot or a display, so they can be used from batch conversions and worker processes.
+
+import os
+
+import numpy as np
+
+
+# The size of the saved plots in inches
+SAVED_PLOT_SIZE = (12, 6)
+
+
+def GetPyplot():
+    '''Import matplotlib.pyplot in interactive mode the first time it is needed'''
+    if GetPyplot.pyplot is None:
+        import matplotlib.pyplot as plt
+        plt.ion()
+        GetPyplot.pyplot = plt
+    return GetPyplot.pyplot
+GetPyplot.pyplot = None
+
+
+def NextFigure(title = ""):
+    plt = GetPyplot()
+    plt.figure(NextFigure.currentFigure)
+    NextFigure.currentFigure += 1
+    plt.title(title)
+NextFigure.currentFigure = 0
+
+
+def _GetProfilePlotData(profile, maxDistance):
+    '''Get the distance and elevation columns of the profile, up to maxDistance. The last point is not plotted'''
+    numberOfPoints = profile.GetNumberOfPoints() - 1
+    distances = profile.GetDistances()
+    if maxDistance > 0:
+        numberOfPoints = min(numberOfPoints, np.searchsorted(distances, maxDistance, side="right"))
+    return distances[:numberOfPoints], profile.GetElevations()[:numberOfPoints]
+
+
+def _DrawSlope(axes, slopeCourse, maxDistance, style):
+    plotDataDistance = slopeCourse.GetDistances()
+    plotDataSlope = slopeCourse.GetSlopes()
+    if maxDistance > 0:
+        numberOfPoints = np.searchsorted(plotDataDistance, maxDistance, side="right")
+        plotDataDistance = plotDataDistance[:numberOfPoints]
+        plotDataSlope = plotDataSlope[:numberOfPoints]
+    axes.plot(plotDataDistance, plotDataSlope, style)
+
+
+def _DrawProfile(axes, profile, maxDistance, style):
+    plotDataDistance, plotDataElevation = _GetProfilePlotData(profile, maxDistance)
+    axes.set_ylabel("Elevation (meters)")
+    axes.set_xlabel("Distance (meters)")
+    startDistance = profile.GetDistances()[0]
+    totalDistance = profile.GetTotalDistance()
+    highestElevation = profile.GetHighestElevation()
+    lowestElevation = profile.GetLowestElevation()
+    elevationGain = profile.GetElevationGain()
+    textX = startDistance
+    textY = highestElevation
+    profileTextInfo = "Elevation Gain = " + str(int(elevationGain)) + "m\n"
+    profileTextInfo += "Total Distance = " + str(int(totalDistance)) + "m\n"
+    profileTextInfo += "Lowest Elevation = " + str(int(lowestElevation)) + "m\n"
+    profileTextInfo += "Highest Elevation = " + str(int(highestElevation)) + "m"
+
+    axes.text(textX, textY, profileTextInfo, multialignment="left",va="top", ha="left")
+
+    axes.plot(plotDataDistance, plotDataElevation, style)
+
+
+def _DrawProfiles(axes, profiles, maxDistance, style):
+    for profile in profiles:
+        plotDataDistance, plotDataElevation = _GetProfilePlotData(profile, maxDistance)
+        totalElevationGain = profile.GetElevationGain()
+        profileLabel = profile.name + " (" + str(int(totalElevationGain)) + "m)"
+        axes.plot(plotDataDistance, plotDataElevation, style, label=profileLabel)
+
+
+    axes.set_ylabel("Elevation (meters)")
+    axes.set_xlabel("Distance (meters)")
+    axes.legend(loc='upper left')
+
+
+def _DrawGpx(axes, gpxCourse, maxDistance, style):
+    # The last point is not plotted
+    numberOfPoints = max(gpxCourse.GetNumberOfPoints() - 1, 1)
+    plotDataDistance = gpxCourse.GetCumulativeDistances()
+    if maxDistance > 0:
+        numberOfPoints = min(numberOfPoints, max(np.searchsorted(plotDataDistance, maxDistance, side="right"), 1))
+    plotDataDistance = plotDataDistance[:numberOfPoints]
+    plotDataEle = gpxCourse.GetElevations()[:numberOfPoints]
+    axes.plot(plotDataDistance, plotDataEle, style)
+
+
+def _ShowPlot(drawFunction, data, maxDistance, title, style):
+    NextFigure(title)
+    plt = GetPyplot()
+    drawFunction(plt.gca(), data, maxDistance, style)
+    plt.show()
+
+
+def _SavePlot(filename, drawFunction, data, maxDistance, title, style):
+    '''
+        Render a plot straight to a file, without pyplot. The file type (e.g. png or svg) is taken from the extension
+        of the filename. Returns the filename
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=SAVED_PLOT_SIZE)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+    axes.set_title(title)
+    drawFunction(axes, data, maxDistance, style)
+    figure.savefig(filename, format=os.path.splitext(filename)[1][1:].lower() or "png")
+    return filename
+
+
+def PlotSlope(slopeCourse, maxDistance, title = "", style=""):
+    _ShowPlot(_DrawSlope, slopeCourse, maxDistance, title, style)
+
+
+def PlotProfile(profile, maxDistance, title = "", style=""):
+    _ShowPlot(_DrawProfile, profile, maxDistance, title, style)
+
+
+def PlotProfiles(profiles, maxDistance, title = "", style=""):
+    _ShowPlot(_DrawProfiles, profiles, maxDistance, title, style)
+
+
+def PlotGpx(gpxCourse, maxDistance, title = "", style=""):
+    _ShowPlot(_DrawGpx, gpxCourse, maxDistance, title, style)
+
+
+def SaveSlopePlot(slopeCourse, filename, maxDistance=0, title = "", style=""):
+    return _SavePlot(filename, _DrawSlope, slopeCourse, maxDistance, title, style)
+
+
+def SaveProfilePlot(profile, filename, maxDistance=0, title = "", style=""):
+    return _SavePlot(filename, _DrawProfile, profile, maxDistance, title, style)
+
+
+def SaveProfilesPlot(profiles, filename, maxDistance=0, title = "", style=""):
+    return _SavePlot(filename, _DrawProfiles, profiles, maxDistance, title, style)
+
+
+def SaveGpxPlot(gpxCourse, filename, maxDistance=0, title = "", style=""):
+    return _SavePlot(filename, _DrawGpx, gpxCourse, maxDistance, title, style)
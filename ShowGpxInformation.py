@@ -8,6 +8,7 @@ import os
 import argparse
 
 from GpxLib import *
+from GpxPlot import *
 
 
 
@@ -15,9 +16,21 @@ argumentParser = argparse.ArgumentParser(
                 description='Show profile information of the given .gpx file')
 argumentParser.add_argument('inputFilename', type=str, help='Input Filename')
 argumentParser.add_argument('--apiKey', "-a", type=str, help='Google Maps API Key')
-argumentParser.add_argument('--interpolationResolution', "-r", type=int, help='Resolution of the interpolation in meter (defaults to 100m)')
+argumentParser.add_argument('--interpolationResolution', "-r", type=float, help='Resolution of the interpolation in meter (defaults to 100m)')
+argumentParser.add_argument('--smoothing', type=str, choices=SMOOTHING_METHODS, help='Smooth the elevations of the profile to get rid of gps jitter')
+argumentParser.add_argument('--smoothingWindow', type=int, default=5, help='Number of profile points in the smoothing window, odd except for lowPass (defaults to 5)')
+argumentParser.add_argument('--simplify', type=float, metavar='TOLERANCE', help='Remove the gps points that are not needed to keep the shape of the course within this many meters, before interpolating')
+argumentParser.add_argument('--simplifyMethod', type=str, choices=SIMPLIFICATION_METHODS, default="douglasPeucker", help='Algorithm used to simplify the course (defaults to douglasPeucker)')
+argumentParser.add_argument('--simplifyWithElevation', action='store_true', help='Flag without a value to also keep the shape of the elevation when simplifying')
 argumentParser.add_argument('--startDistance', "-start", type=int, help='Trims everything before the start distance (default 0m)')
 argumentParser.add_argument('--stopDistance', "-stop", type=int, help='Trims everything after the stop distance')
+argumentParser.add_argument('--elevationCache', "-c", type=str, default=DEFAULT_ELEVATION_CACHE_FILENAME, help='File in which the elevations from google are cached (defaults to ~/.GpxElevationCache.sqlite)')
+argumentParser.add_argument('--noElevationCache', action='store_true', help='Flag without a value to always get all the elevations from google')
+argumentParser.add_argument('--courseCache', type=str, default=DEFAULT_COURSE_CACHE_DIRECTORY, help='Directory in which the processed courses are cached (defaults to ~/.GpxCourseCache)')
+argumentParser.add_argument('--noCourseCache', action='store_true', help='Flag without a value to always process the gpx file again')
+argumentParser.add_argument('--srtmDirectory', "-s", type=str, help='Directory with SRTM .hgt tiles to get the elevations from, instead of google')
+argumentParser.add_argument('--profile', type=str, nargs='?', const='', metavar='JSONFILE', help='Print the time and number of points of every stage, or save them to the given JSON file')
+argumentParser.add_argument('--plotFilename', "-f", type=str, help='Save the plot to the given .png or .svg file instead of showing it')
 
 commandlineArguments = argumentParser.parse_args()
 
@@ -25,7 +38,20 @@ inputFilename = commandlineArguments.inputFilename
 apiKey = commandlineArguments.apiKey
 interpolationResolution = commandlineArguments.interpolationResolution
 startDistance = commandlineArguments.startDistance
+simplifyTolerance = commandlineArguments.simplify
+simplifyMethod = commandlineArguments.simplifyMethod
+simplifyWithElevation = commandlineArguments.simplifyWithElevation
+smoothing = commandlineArguments.smoothing
+smoothingWindow = commandlineArguments.smoothingWindow
 stopDistance = commandlineArguments.stopDistance
+elevationCacheFilename = None if commandlineArguments.noElevationCache else commandlineArguments.elevationCache
+srtmDirectory = commandlineArguments.srtmDirectory
+courseCacheDirectory = None if commandlineArguments.noCourseCache else commandlineArguments.courseCache
+plotFilename = commandlineArguments.plotFilename
+profileFilename = commandlineArguments.profile
+
+if profileFilename is not None:
+    GetInstrumentation().Enable()
 
 
 # If the interpolation resolution was left out, set it to 100m
@@ -37,34 +63,25 @@ if startDistance is None:
 if stopDistance is None:
     stopDistance = 0
 
-print "Parsing ", inputFilename, "..."
-
-gpxCourse = ParseGpxFile(inputFilename)
-
-print "There are " + str(gpxCourse.GetNumberOfPoints()) + " gps points..."
-print "Interpolating..."
-
-gpxCourse = gpxCourse.InterpolateToGivenResolution(interpolationResolution)
-
-if startDistance > 0 or stopDistance > 0:
-    print "Trimming..."
-    if stopDistance == 0:
-        stopDistance = sys.maxint
-    gpxCourse = gpxCourse.PruneDistance(stopDistance, startDistance)
+courseCache = CourseCache(courseCacheDirectory) if courseCacheDirectory else None
+_, profile = ProcessGpxFile(inputFilename, interpolationResolution, startDistance, stopDistance, apiKey,
+                            elevationCacheFilename, srtmDirectory, simplifyTolerance, simplifyMethod,
+                            simplifyWithElevation, smoothing, smoothingWindow, courseCache=courseCache,
+                            withGpxCourse=False, verbose=True)
 
-print "There are " + str(gpxCourse.GetNumberOfPoints()) + " gps points after interpolation..."
-
-if apiKey:
-    print "Getting all the elevation data from google..."
-    gpxCourse = gpxCourse.CorrectElevation(apiKey)
-
-profile = gpxCourse.CreateEquidistantProfile(interpolationResolution)
-
-if profile.GetElevationGain() == 0 and apiKey is None:
+if profile.GetElevationGain() == 0 and apiKey is None and srtmDirectory is None:
     print "Elevation data seems to be missing. You would need an API key to retrieve this info from the internet."
 
-PlotProfile(profile, 0, "Course Profile")
+if profileFilename is not None:
+    GetInstrumentation().Report(profileFilename)
+
+if plotFilename:
+    print "Saved the plot to " + SaveProfilePlot(profile, plotFilename, title="Course Profile")
+else:
+    PlotProfile(profile, 0, "Course Profile")
 
 print "Done!!!"
 
-raw_input("Press Enter to continue...")
\ No newline at end of file
+# Only wait for user input if the plot is shown
+if not plotFilename:
+    raw_input("Press Enter to continue...")
\ No newline at end of file
@@ -2,8 +2,30 @@
 # Distributed under the MIT Licence
 
 import unittest
+import tempfile
+import shutil
+import os
+import json
+import math
+import gzip
+import sys
+import subprocess
+import time
+import httplib
+import struct
+import StringIO
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
 
+import numpy as np
+
+from lxml.etree import fromstring
+
+import GpxLib
 from GpxLib import *
+from GpxPlot import *
 
 
 class GpxCourseInfo:
@@ -13,6 +35,88 @@ class GpxCourseInfo:
         self.expectedElevationGain = expectedElevationGain
 
 
+def CreateTestGpxFile(content):
+    '''Write the gpx content to a temporary file and return the filename. The caller has to remove the file'''
+    fileHandle, filename = tempfile.mkstemp(suffix=".gpx")
+    with os.fdopen(fileHandle, "w") as gpxFile:
+        gpxFile.write(content)
+    return filename
+
+
+def ReadFitFile(data):
+    '''
+        Read the messages of a fit file (without compressed timestamps or developer fields) to check the writer.
+        Returns the data size from the header and a list of (global message number, {field number: value}) tuples
+    '''
+    headerSize, _, _, dataSize, signature = struct.unpack("<BBHI4s", data[:12])
+    assert signature == ".FIT"
+    formats = {0x00: "B", 0x02: "B", 0x83: "h", 0x84: "H", 0x86: "I"}
+    definitions = {}
+    messages = []
+    position = headerSize
+    while position < headerSize + dataSize:
+        recordHeader = ord(data[position])
+        position += 1
+        if recordHeader & 0x40:
+            globalNumber, numberOfFields = struct.unpack("<HB", data[position + 2:position + 5])
+            position += 5
+            fields = [struct.unpack("BBB", data[position + 3 * index:position + 3 * index + 3])
+                      for index in range(numberOfFields)]
+            position += 3 * numberOfFields
+            definitions[recordHeader & 0x0F] = (globalNumber, fields)
+        else:
+            globalNumber, fields = definitions[recordHeader & 0x0F]
+            values = {}
+            for number, size, baseType in fields:
+                value = data[position:position + size]
+                values[number] = value.rstrip("\0") if baseType == 0x07 else struct.unpack("<" + formats[baseType], value)[0]
+                position += size
+            messages.append((globalNumber, values))
+    return dataSize, messages
+
+
+class ElevationStandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+        Local stand in for the Google elevation API. The elevation of every location is its latitude, and the first
+        request for every set of locations fails, so that the retries get tested as well
+    '''
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), ElevationStandInRequestHandler)
+        self.lock = threading.Lock()
+        self.failedQueries = set()
+        self.numberOfRequests = 0
+        self.url = "http://127.0.0.1:" + str(self.server_address[1]) + "/elevation/json"
+
+
+class ElevationStandInRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        with self.server.lock:
+            self.server.numberOfRequests += 1
+            firstRequest = self.path not in self.server.failedQueries
+            self.server.failedQueries.add(self.path)
+        if firstRequest:
+            response = {"status": "OVER_QUERY_LIMIT", "results": []}
+        else:
+            results = [{"location": {"lat": lat, "lng": lon}, "elevation": lat}
+                       for lat, lon in zip(*[coordinates.tolist() for coordinates in
+                                             DecodePolyline(query["locations"][0][len("enc:"):])])]
+            response = {"status": "OK", "results": results}
+        data = json.dumps(response)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
 def CreateTestGpxCourse():
     gpxPoints = []
     # This is just the first few points of the 94.7 course
@@ -45,6 +149,171 @@ class TestGpxLib(unittest.TestCase):
         cls.courseInfo1 = GpxCourseInfo("./TestData/94.7Race.gpx", 93.94e3, 1434)
 
 
+    def test_ParseGpxFile(self):
+        self.assertEqual(self.courseInfo1.gpxCourse.GetName(), "94.7 2017")
+        self.assertEqual(self.courseInfo1.gpxCourse.GetNumberOfPoints(), 1053)
+        self.assertEqual(self.courseInfo1.gpxCourse[0].latitude, -25.9598389)
+        self.assertEqual(self.courseInfo1.gpxCourse[0].elevation, 1372.899)
+
+
+    def test_IterateGpxFile(self):
+        # The metadata name wins over the track name, and a point without elevation gets 0
+        filename = CreateTestGpxFile('''<?xml version="1.0"?>
+            <gpx xmlns="http://www.topografix.com/GPX/1/1">
+              <trk><name>Track</name><trkseg>
+                <trkpt lat="1.5" lon="2.5"><ele>10</ele></trkpt>
+                <trkpt lat="1.6" lon="2.6"></trkpt>
+              </trkseg></trk>
+              <metadata><name> Metadata </name></metadata>
+            </gpx>''')
+        try:
+            metadata = {}
+            points = list(IterateGpxFile(filename, metadata))
+            gpxCourse = ParseGpxFile(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(points, [(1.5, 2.5, 10.0), (1.6, 2.6, 0.0)])
+        self.assertEqual(metadata["name"], "Metadata")
+        self.assertEqual(gpxCourse.GetNumberOfPoints(), 2)
+        self.assertEqual(gpxCourse.GetName(), "Metadata")
+
+
+    def test_IterateGpxFileNamedPoints(self):
+        # The name of a point comes after its elevation, and must not take the elevation with it
+        filename = CreateTestGpxFile('''<?xml version="1.0"?>
+            <gpx xmlns="http://www.topografix.com/GPX/1/1">
+              <trk><name>Track</name><trkseg>
+                <trkpt lat="1.5" lon="2.5"><ele>100</ele><name>First</name></trkpt>
+                <trkpt lat="1.6" lon="2.6"><ele>200</ele><name>Second</name></trkpt>
+              </trkseg></trk>
+            </gpx>''')
+        try:
+            points = list(IterateGpxFile(filename))
+            gpxCourse = ParseGpxFile(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(points, [(1.5, 2.5, 100.0), (1.6, 2.6, 200.0)])
+        self.assertEqual(gpxCourse.GetElevations().tolist(), [100.0, 200.0])
+        self.assertEqual(gpxCourse.GetName(), "Track")
+
+        filename = CreateTestGpxFile('''<?xml version="1.0"?>
+            <gpx xmlns="http://www.topografix.com/GPX/1/1">
+              <rte><name>Route</name>
+                <rtept lat="1.5" lon="2.5"><ele>100</ele><name>Turn left</name></rtept>
+                <rtept lat="1.6" lon="2.6"><ele>200</ele><name>Turn right</name></rtept>
+              </rte>
+            </gpx>''')
+        try:
+            gpxCourse = ParseGpxFile(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(gpxCourse.GetElevations().tolist(), [100.0, 200.0])
+        self.assertEqual(gpxCourse.GetName(), "Route")
+
+
+    def test_ParseGpxFileSegments(self):
+        # 2 tracks with 3 segments between them (and an empty one), and a route which is dropped because there are tracks
+        filename = CreateTestGpxFile('''<?xml version="1.0"?>
+            <gpx xmlns="http://www.topografix.com/GPX/1/1">
+              <rte><name>Plan</name><rtept lat="0.0" lon="0.0"/><rtept lat="0.5" lon="0.0"/></rte>
+              <trk><name>Day 1</name>
+                <trkseg><trkpt lat="0.0" lon="0.0"/><trkpt lat="0.01" lon="0.0"/></trkseg>
+                <trkseg></trkseg>
+                <trkseg><trkpt lat="0.02" lon="0.0"/><trkpt lat="0.02" lon="0.0"/><trkpt lat="0.03" lon="0.0"/></trkseg>
+              </trk>
+              <trk><name>Day 2</name>
+                <trkseg><trkpt lat="0.5" lon="0.0"/><trkpt lat="0.51" lon="0.0"/></trkseg>
+              </trk>
+            </gpx>''')
+        try:
+            gpxCourse = ParseGpxFile(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(gpxCourse.GetName(), "Day 1")
+        self.assertEqual(gpxCourse.GetNumberOfPoints(), 7)
+        self.assertEqual(gpxCourse.GetSegmentStarts().tolist(), [0, 2, 5])
+        self.assertEqual(gpxCourse.GetTrackStarts().tolist(), [0, 5])
+        self.assertEqual([segment.GetNumberOfPoints() for segment in gpxCourse.GetSegments()], [2, 3, 2])
+
+        # Nothing is interpolated in the gaps between the segments, and the structure is kept
+        for processes in [1, 2]:
+            interpolatedCourse = gpxCourse.InterpolateToGivenResolution(100, processes)
+            # Every 0.01 degree step of about 1113m gets 11 new points
+            self.assertEqual(interpolatedCourse.GetNumberOfPoints(), 7 + 3 * 11)
+            self.assertEqual(interpolatedCourse.GetSegmentStarts().tolist(), [0, 13, 27])
+            self.assertEqual(interpolatedCourse.GetTrackStarts().tolist(), [0, 27])
+        self.assertTrue(np.all(interpolatedCourse.GetLatitudes()[13:] >= 0.02))
+
+        dedupedCourse = gpxCourse.RemoveAllDuplicateGpxPoints()
+        self.assertEqual(dedupedCourse.GetNumberOfPoints(), 6)
+        self.assertEqual(dedupedCourse.GetSegmentStarts().tolist(), [0, 2, 4])
+
+        prunedCourse = gpxCourse.PruneDistance(gpxCourse.GetTotalDistance(), gpxCourse.GetDistanceAtIndex(3))
+        # Point 2 is at the same distance as point 3, so the pruned course starts at the start of the second segment
+        self.assertEqual(prunedCourse.GetSegmentStarts().tolist(), [0, 3])
+        self.assertEqual(prunedCourse.GetTrackStarts().tolist(), [0, 3])
+
+        # A file with only a route uses the route. Route points usually have a name (the turn instructions)
+        filename = CreateTestGpxFile('''<?xml version="1.0"?>
+            <gpx xmlns="http://www.topografix.com/GPX/1/1">
+              <rte><name>Plan</name>
+                <rtept lat="0.0" lon="0.0"><ele>1200.5</ele><name>Start</name></rtept>
+                <rtept lat="0.25" lon="0.0"><ele>1350</ele><name>Turn left</name><desc>Main road</desc></rtept>
+                <rtept lat="0.5" lon="0.0"><ele>1300.25</ele><name>Finish</name></rtept>
+              </rte>
+            </gpx>''')
+        try:
+            gpxCourse = ParseGpxFile(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(gpxCourse.GetName(), "Plan")
+        self.assertEqual(gpxCourse.GetNumberOfPoints(), 3)
+        self.assertEqual(gpxCourse.GetNumberOfSegments(), 1)
+        self.assertEqual(gpxCourse.GetElevations().tolist(), [1200.5, 1350.0, 1300.25])
+        self.assertAlmostEqual(gpxCourse.CreateProfile().GetElevationGain(), 149.5)
+
+
+    def test_SaveAndLoadCourse(self):
+        directory = tempfile.mkdtemp()
+        try:
+            gpxCourse = GpxCourse.FromArrays([-25.95, -25.96, -25.97, -25.98], [28.02, 28.03, 28.04, 28.05],
+                                             [1300.5, 1310.25, 1320.0, 1330.0], "Course", [0, 1, 3], [0, 3])
+            courseFilename = SaveCourse(gpxCourse, os.path.join(directory, "course" + COURSE_FILE_EXTENSION))
+            self.assertTrue(IsCourseFile(courseFilename))
+
+            # The columns are memory mapped as they are, and the distances are not calculated again
+            instrumentation = GetInstrumentation()
+            instrumentation.Reset()
+            instrumentation.Enable()
+            try:
+                loadedCourse = LoadCourse(courseFilename)
+                self.assertTrue(isinstance(loadedCourse.GetLatitudes(), np.memmap))
+                self.assertTrue(isinstance(loadedCourse.GetCumulativeDistances(), np.memmap))
+                self.assertEqual(instrumentation.ToDict()["counters"].get("haversineCalls", 0), 0)
+                np.testing.assert_array_equal(loadedCourse.GetCumulativeDistances(), gpxCourse.GetCumulativeDistances())
+            finally:
+                instrumentation.Disable()
+                instrumentation.Reset()
+            self.assertEqual(loadedCourse.GetName(), "Course")
+            self.assertEqual(loadedCourse.GetLatitudes().tolist(), gpxCourse.GetLatitudes().tolist())
+            self.assertEqual(loadedCourse.GetElevations().tolist(), gpxCourse.GetElevations().tolist())
+            self.assertEqual(loadedCourse.GetSegmentStarts().tolist(), [0, 1, 3])
+            self.assertEqual(loadedCourse.GetTrackStarts().tolist(), [0, 3])
+            self.assertRaises(ValueError, loadedCourse.GetLatitudes().__setitem__, 0, 0.0)
+
+            # And back to a gpx file, which keeps the points, tracks and segments
+            gpxFilename = WriteGpxFile(loadedCourse, os.path.join(directory, "course.gpx"))
+            self.assertFalse(IsCourseFile(gpxFilename))
+            parsedCourse = LoadCourse(gpxFilename)
+            self.assertEqual(parsedCourse.GetName(), "Course")
+            self.assertEqual(parsedCourse.GetLongitudes().tolist(), gpxCourse.GetLongitudes().tolist())
+            self.assertEqual(parsedCourse.GetElevations().tolist(), gpxCourse.GetElevations().tolist())
+            self.assertEqual(parsedCourse.GetSegmentStarts().tolist(), [0, 1, 3])
+            self.assertEqual(parsedCourse.GetTrackStarts().tolist(), [0, 3])
+        finally:
+            shutil.rmtree(directory)
+
+
     def test_DegToRad(self):
         self.assertAlmostEqual(DegreesToRadians(65), 1.13446, 3)
 
@@ -80,11 +349,71 @@ class TestGpxLib(unittest.TestCase):
         self.assertEquals(expectedString, actualString)
 
 
+    def test_DecodePolyline(self):
+        latitudes, longitudes = DecodePolyline("_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+        np.testing.assert_allclose(latitudes, [38.5, 40.7, 43.252])
+        np.testing.assert_allclose(longitudes, [-120.2, -120.95, -126.453])
+
+        # Encoding and decoding again should only lose the precision below 1e-5 degrees
+        randomState = np.random.RandomState(0)
+        latitudes = np.concatenate([[0.0, 0.0], randomState.uniform(-90, 90, 1000)])
+        longitudes = np.concatenate([[0.0, 0.0], randomState.uniform(-180, 180, 1000)])
+        decodedLatitudes, decodedLongitudes = DecodePolyline(EncodePolyline(latitudes, longitudes))
+        np.testing.assert_allclose(decodedLatitudes, latitudes, atol=0.5e-5)
+        np.testing.assert_allclose(decodedLongitudes, longitudes, atol=0.5e-5)
+        self.assertEquals(len(DecodePolyline("")[0]), 0)
+
+
+    def test_PackPolylines(self):
+        randomState = np.random.RandomState(1)
+        latitudes = -26.0 + np.cumsum(randomState.uniform(-0.01, 0.01, 3000))
+        longitudes = 28.0 + np.cumsum(randomState.uniform(-0.01, 0.01, 3000))
+        polylines = PackPolylines(latitudes, longitudes, 500, 100)
+        self.assertEquals(polylines[0][0], 0)
+        self.assertEquals(polylines[-1][1], len(latitudes))
+        for (start, stop, polyline), nextPolyline in zip(polylines, polylines[1:] + [None]):
+            self.assertTrue(len(polyline) <= 500)
+            self.assertTrue(stop - start <= 100)
+            # Every polyline is the same as encoding its points on their own, and is packed as full as possible
+            self.assertEquals(polyline, EncodePolyline(latitudes[start:stop], longitudes[start:stop]))
+            if nextPolyline is not None:
+                self.assertEquals(nextPolyline[0], stop)
+                self.assertTrue(stop - start == 100 or
+                                len(EncodePolyline(latitudes[start:stop + 1], longitudes[start:stop + 1])) > 500)
+
+        self.assertRaises(ValueError, PackPolylines, latitudes, longitudes, 5, 100)
+
+
     def test_GetDistanceBetweenPoints(self):
         self.assertAlmostEqual(GetDistanceBetweenPoints(GpxPoint(36.12, -86.67, 0), GpxPoint(33.94, -118.40, 0)), 2889661.1679, 3)
         self.assertAlmostEqual(GetDistanceBetweenPoints(GpxPoint(38.898556, -77.037852, 0), GpxPoint(38.897147, -77.043934, 0)), 549.7677, 3)
 
 
+    def test_HaversineArray(self):
+        # The vectorized version should give the same answers as the scalar version
+        radiusOfEarth = 6371.0 * 1000.0
+        distances = HaversineArray([36.12, 38.898556], [-86.67, -77.037852], [33.94, 38.897147], [-118.40, -77.043934],
+                                   radiusOfEarth)
+        self.assertAlmostEqual(distances[0], 2886444.4428, 3)
+        self.assertAlmostEqual(distances[1], 549.15579, 3)
+
+
+    def test_GetSegmentDistances(self):
+        gpxCourse = CreateTestGpxCourse()
+        segmentDistances = GetSegmentDistances(gpxCourse.GetLatitudes(), gpxCourse.GetLongitudes())
+        self.assertEqual(len(segmentDistances), gpxCourse.GetNumberOfPoints() - 1)
+        for index in range(0, len(segmentDistances)):
+            self.assertAlmostEqual(segmentDistances[index],
+                                   GetDistanceBetweenPoints(gpxCourse[index], gpxCourse[index + 1]), 6)
+
+
+    def test_GetDistancesToPoint(self):
+        distances = GetDistancesToPoint([36.12, 38.898556], [-86.67, -77.037852], GpxPoint(33.94, -118.40, 0))
+        self.assertAlmostEqual(distances[0], 2889661.1679, 3)
+        self.assertAlmostEqual(distances[1], GetDistanceBetweenPoints(GpxPoint(38.898556, -77.037852, 0),
+                                                                      GpxPoint(33.94, -118.40, 0)), 3)
+
+
     def test_GetMiddlePoint(self):
         startPoint = GpxPoint(45.678, 5.4321, 0)
         endPoint = GpxPoint(46.810, 5.1015, 1000)
@@ -95,8 +424,56 @@ class TestGpxLib(unittest.TestCase):
 
 
     def test_InterpolateBetweenPoints(self):
-        #TODO: I still need a nice test for this function
-        self.assertTrue(True)
+        startPoint = GpxPoint(45.678, 5.4321, 0)
+        endPoint = GpxPoint(46.810, 5.1015, 1000)
+        distance = GetDistanceBetweenPoints(startPoint, endPoint)
+        gpxPoints = InterpolateBetweenPoints([startPoint, endPoint], distance / 4)
+        # The points are split into 4 equal parts, and the middle point is the same as GetMiddlePoint
+        self.assertEqual(len(gpxPoints), 5)
+        self.assertEqual(gpxPoints[0].latitude, startPoint.latitude)
+        self.assertEqual(gpxPoints[-1].longitude, endPoint.longitude)
+        middlePoint = GetMiddlePoint(startPoint, endPoint)
+        self.assertAlmostEqual(gpxPoints[2].latitude, middlePoint.latitude, 6)
+        self.assertAlmostEqual(gpxPoints[2].longitude, middlePoint.longitude, 6)
+        self.assertAlmostEqual(gpxPoints[1].elevation, 250.0, 6)
+        for index in range(1, len(gpxPoints)):
+            self.assertAlmostEqual(GetDistanceBetweenPoints(gpxPoints[index - 1], gpxPoints[index]), distance / 4, 3)
+
+
+    def test_CourseInterpolateToGivenResolution(self):
+        resolution = 10
+        gpxCourse = self.courseInfo1.gpxCourse
+        interpolatedCourse = gpxCourse.InterpolateToGivenResolution(resolution)
+        # None of the points may be further apart than the resolution, and the distance should stay the same
+        segmentDistances = GetSegmentDistances(interpolatedCourse.GetLatitudes(), interpolatedCourse.GetLongitudes())
+        self.assertLessEqual(segmentDistances.max(), resolution + 1e-6)
+        self.assertAlmostEqual(interpolatedCourse.GetTotalDistance(), gpxCourse.GetTotalDistance(), delta=1)
+        self.assertEqual(interpolatedCourse[-1].latitude, gpxCourse[-1].latitude)
+
+
+    def test_CourseIsImmutable(self):
+        gpxCourse = CreateTestGpxCourse()
+        # Changing a returned point should not change the course
+        gpxPoint = gpxCourse[0]
+        gpxPoint.elevation = 0
+        self.assertEqual(gpxCourse[0].elevation, 1372.899)
+        # And the columns are read-only views
+        with self.assertRaises(ValueError):
+            gpxCourse.GetElevations()[0] = 0
+        with self.assertRaises(ValueError):
+            gpxCourse.GetLatitudes().flags.writeable = True
+
+
+    def test_CourseFromArrays(self):
+        gpxCourse = CreateTestGpxCourse()
+        arrayCourse = GpxCourse.FromArrays(gpxCourse.GetLatitudes(), gpxCourse.GetLongitudes(),
+                                           gpxCourse.GetElevations(), "Arrays")
+        self.assertEqual(arrayCourse.GetNumberOfPoints(), gpxCourse.GetNumberOfPoints())
+        self.assertEqual(arrayCourse.GetName(), "Arrays")
+        self.assertEqual(arrayCourse[-1].latitude, gpxCourse[-1].latitude)
+        self.assertEqual(len(arrayCourse[1:3]), 2)
+        with self.assertRaises(ValueError):
+            GpxCourse.FromArrays([1, 2], [1, 2], [1])
 
 
     def test_GetDistanceAtIndex(self):
@@ -117,6 +494,233 @@ class TestGpxLib(unittest.TestCase):
         self.assertAlmostEqual(self.courseInfo1.gpxCourse.GetElevationAtDistance(5000), 1518.2241, 3)
 
 
+    def test_ElevationCache(self):
+        fileHandle, filename = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fileHandle)
+        try:
+            elevationCache = ElevationCache(filename, maxEntries=3)
+            elevationCache.SetElevations([-25.95, -25.96], [28.02, 28.03], [1300, 1310])
+            # Points that round to the same 5 decimals share their elevation
+            elevations = elevationCache.GetElevations([-25.950001, -25.97, -25.96], [28.02, 28.03, 28.03])
+            self.assertEqual(elevations[0], 1300)
+            self.assertTrue(np.isnan(elevations[1]))
+            self.assertEqual(elevations[2], 1310)
+            self.assertEqual((elevationCache.hits, elevationCache.misses), (2, 1))
+
+            # The cache keeps its entries between runs, and evicts the least recently used ones when it is full
+            elevationCache.Close()
+            elevationCache = ElevationCache(filename, maxEntries=3)
+            elevationCache.GetElevations([-25.95], [28.02])
+            elevationCache.SetElevations([-25.97, -25.98], [28.04, 28.05], [1320, 1330])
+            self.assertEqual(elevationCache.GetNumberOfEntries(), 3)
+            elevations = elevationCache.GetElevations([-25.95, -25.96], [28.02, 28.03])
+            self.assertEqual(elevations[0], 1300)
+            self.assertTrue(np.isnan(elevations[1]))
+            elevationCache.Close()
+        finally:
+            os.remove(filename)
+
+
+    def test_CourseCache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            gpxFilename = os.path.join(directory, "course.gpx")
+            shutil.copy("./TestData/94.7Race.gpx", gpxFilename)
+            courseCache = CourseCache(os.path.join(directory, "cache"))
+            gpxParameters, profileParameters = GetCourseCacheParameters(100, smoothing="median")
+            self.assertNotEqual(courseCache.GetKey(gpxFilename, **gpxParameters),
+                                courseCache.GetKey(gpxFilename, **profileParameters))
+
+            # The course is only created the first time, and keeps its columns, name and segments
+            gpxCourse = GpxCourse.FromArrays([1.0, 2.0, 3.0], [4.0, 5.0, 6.0], [7.0, 8.0, 9.0], "Cached", [0, 2])
+            createdCourses = []
+            def CreateGpxCourse():
+                createdCourses.append(gpxCourse)
+                return gpxCourse
+            for _ in range(0, 2):
+                cachedCourse = GetCachedCourse(courseCache, gpxFilename, gpxParameters, CreateGpxCourse)
+            self.assertEqual(len(createdCourses), 1)
+            self.assertEqual((courseCache.hits, courseCache.misses), (1, 1))
+            self.assertEqual(cachedCourse.GetName(), "Cached")
+            self.assertEqual(cachedCourse.GetLatitudes().tolist(), [1.0, 2.0, 3.0])
+            self.assertEqual(cachedCourse.GetElevations().tolist(), [7.0, 8.0, 9.0])
+            self.assertEqual(cachedCourse.GetSegmentStarts().tolist(), [0, 2])
+
+            profile = ProfileCourse.FromArrays([0.0, 100.0], [1300.0, 1310.0], "Profile")
+            courseCache.Set(courseCache.GetKey(gpxFilename, **profileParameters), profile)
+            cachedProfile = courseCache.Get(courseCache.GetKey(gpxFilename, **profileParameters))
+            self.assertEqual(cachedProfile.GetName(), "Profile")
+            self.assertEqual(cachedProfile.GetElevations().tolist(), [1300.0, 1310.0])
+
+            # Another cache in the same directory shares the courses, until the content of the file changes
+            otherCache = CourseCache(os.path.join(directory, "cache"))
+            self.assertTrue(otherCache.Get(otherCache.GetKey(gpxFilename, **gpxParameters)) is not None)
+            with open(gpxFilename, "a") as gpxFile:
+                gpxFile.write("\n")
+            otherCache = CourseCache(os.path.join(directory, "cache"))
+            self.assertTrue(otherCache.Get(otherCache.GetKey(gpxFilename, **gpxParameters)) is None)
+
+            # The least recently used courses are removed when the cache is too large
+            courseCache.maxBytes = 1
+            courseCache.Set(courseCache.GetKey(gpxFilename, stage="other"), profile)
+            self.assertEqual(courseCache.GetNumberOfEntries(), 1)
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_CourseCacheIsBestEffort(self):
+        directory = tempfile.mkdtemp()
+        savez = np.savez
+        try:
+            gpxFilename = os.path.join(directory, "course.gpx")
+            shutil.copy("./TestData/94.7Race.gpx", gpxFilename)
+            gpxParameters, _ = GetCourseCacheParameters(100)
+            gpxCourse = GpxCourse.FromArrays([1.0, 2.0], [4.0, 5.0], [7.0, 8.0], "Course")
+
+            # A cache directory that cannot be created (here because a file is in the way) only misses
+            courseCache = CourseCache(gpxFilename)
+            self.assertFalse(courseCache.Set(courseCache.GetKey(gpxFilename, **gpxParameters), gpxCourse))
+            for _ in range(0, 2):
+                self.assertTrue(GetCachedCourse(courseCache, gpxFilename, gpxParameters, lambda: gpxCourse) is gpxCourse)
+            self.assertEqual((courseCache.hits, courseCache.misses), (0, 2))
+
+            # A course that cannot be written (e.g. a full disk) leaves no temporary file behind
+            courseCache = CourseCache(os.path.join(directory, "cache"))
+            def FullDisk(*args, **kwargs):
+                raise IOError(28, "No space left on device")
+            np.savez = FullDisk
+            self.assertTrue(GetCachedCourse(courseCache, gpxFilename, gpxParameters, lambda: gpxCourse) is gpxCourse)
+            self.assertEqual(os.listdir(os.path.join(directory, "cache")), [])
+            np.savez = savez
+
+            # An existing course is replaced, as when two processes store the same course
+            key = courseCache.GetKey(gpxFilename, **gpxParameters)
+            self.assertTrue(courseCache.Set(key, gpxCourse))
+            self.assertTrue(courseCache.Set(key, GpxCourse.FromArrays([1.0], [4.0], [7.0], "Other")))
+            self.assertEqual(courseCache.Get(key).GetName(), "Other")
+            self.assertEqual(courseCache.GetNumberOfEntries(), 1)
+        finally:
+            np.savez = savez
+            shutil.rmtree(directory)
+
+
+    def test_ProcessGpxFile(self):
+        directory = tempfile.mkdtemp()
+        try:
+            gpxFilename = os.path.join(directory, "course.gpx")
+            shutil.copy("./TestData/94.7Race.gpx", gpxFilename)
+            courseCache = CourseCache(os.path.join(directory, "cache"))
+            gpxCourse, profile = ProcessGpxFile(gpxFilename, 100, stopDistance=50000, courseCache=courseCache)
+            self.assertEqual((courseCache.hits, courseCache.misses), (0, 2))
+            self.assertTrue(gpxCourse.GetTotalDistance() <= 50000)
+            self.assertAlmostEqual(profile.GetTotalDistance(), gpxCourse.GetTotalDistance(), delta=100)
+
+            # The second time both come from the cache, and the gpx course is not even loaded if it is not needed
+            cachedCourse, cachedProfile = ProcessGpxFile(gpxFilename, 100, stopDistance=50000, courseCache=courseCache)
+            self.assertEqual((courseCache.hits, courseCache.misses), (2, 2))
+            self.assertEqual(cachedCourse.GetNumberOfPoints(), gpxCourse.GetNumberOfPoints())
+            self.assertEqual(cachedProfile.GetElevations().tolist(), profile.GetElevations().tolist())
+            noCourse, cachedProfile = ProcessGpxFile(gpxFilename, 100, stopDistance=50000, courseCache=courseCache,
+                                                     withGpxCourse=False)
+            self.assertTrue(noCourse is None)
+            self.assertEqual((courseCache.hits, courseCache.misses), (3, 2))
+
+            # Without a cache everything is processed again, so the gpx course that was created is returned anyway
+            uncachedCourse, uncachedProfile = ProcessGpxFile(gpxFilename, 100, stopDistance=50000,
+                                                             withGpxCourse=False)
+            self.assertEqual(uncachedCourse.GetNumberOfPoints(), gpxCourse.GetNumberOfPoints())
+            self.assertEqual(uncachedProfile.GetElevations().tolist(), profile.GetElevations().tolist())
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_CourseCorrectElevationFromCache(self):
+        fileHandle, filename = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fileHandle)
+        try:
+            gpxCourse = CreateTestGpxCourse()
+            elevationCache = ElevationCache(filename)
+            elevationCache.SetElevations(gpxCourse.GetLatitudes(), gpxCourse.GetLongitudes(),
+                                         np.arange(gpxCourse.GetNumberOfPoints()))
+            # All the points are cached, so there is no request to google (which would fail without a key)
+            correctedCourse = gpxCourse.CorrectElevation(None, elevationCache)
+            elevationCache.Close()
+        finally:
+            os.remove(filename)
+        # The duplicate points share a key, so they get the last elevation that was stored for them
+        self.assertEqual(correctedCourse[0].elevation, 0)
+        self.assertEqual(correctedCourse[1].elevation, 2)
+        self.assertEqual(correctedCourse[1].latitude, gpxCourse[1].latitude)
+        self.assertEqual(correctedCourse.GetName(), gpxCourse.GetName())
+
+
+    def test_SrtmElevationProvider(self):
+        self.assertEqual(SrtmElevationProvider.GetTileName(-25.5, 28.5), "S26E028.hgt")
+        self.assertEqual(SrtmElevationProvider.GetTileName(51.5, -0.1), "N51W001.hgt")
+
+        # A tiny 3x3 tile. Rows go from north to south, so the north west corner is the first sample
+        tileDirectory = tempfile.mkdtemp()
+        try:
+            tile = np.array([[0, 10, 20], [100, 110, 120], [200, 210, SrtmElevationProvider.voidValue]], dtype=">i2")
+            tile.tofile(os.path.join(tileDirectory, "S26E028.hgt"))
+            elevationProvider = SrtmElevationProvider(tileDirectory)
+            elevations = elevationProvider.GetElevations([-25.25, -25.5, -25.25, -25.875], [28.0, 28.5, 28.25, 28.875])
+            self.assertAlmostEqual(elevations[0], 50, 6)
+            self.assertAlmostEqual(elevations[1], 110, 6)
+            # Bilinear interpolation between the 4 samples around the point
+            self.assertAlmostEqual(elevations[2], 55, 6)
+            # The void in the south east corner is left out
+            self.assertAlmostEqual(elevations[3], (110 * 0.25 * 0.25 + 120 * 0.25 * 0.75 + 210 * 0.75 * 0.25) /
+                                   (1 - 0.75 * 0.75), 6)
+
+            gpxCourse = GpxCourse([GpxPoint(-25.5, 28.5, 0), GpxPoint(-25.25, 28.25, 0)])
+            correctedCourse = gpxCourse.CorrectElevation(elevationProvider=elevationProvider)
+            self.assertAlmostEqual(correctedCourse[0].elevation, 110, 6)
+            self.assertAlmostEqual(correctedCourse[1].elevation, 55, 6)
+
+            with self.assertRaises(ElevationError):
+                elevationProvider.GetElevations([-24.5], [28.5])
+        finally:
+            shutil.rmtree(tileDirectory)
+
+
+    def test_GetCorrectElevationFromGoogle(self):
+        server = ElevationStandInServer()
+        serverThread = threading.Thread(target=server.serve_forever)
+        serverThread.daemon = True
+        serverThread.start()
+        try:
+            # Enough points for a couple of requests
+            latitudes = np.linspace(-25.0, -26.0, 2000)
+            gpxPoints = [GpxPoint(latitude, 28.0 + index * 1e-4, 0) for index, latitude in enumerate(latitudes)]
+            outputGpxPoints = GetCorrectElevationFromGoogle(gpxPoints, "testKey", baseUrl=server.url,
+                                                            requestsPerSecond=1000, numberOfThreads=4,
+                                                            retryBackoffTime=0.001)
+            self.assertEqual(len(outputGpxPoints), len(gpxPoints))
+            # The results are put back in the same order as the points
+            for gpxPoint, outputGpxPoint in zip(gpxPoints, outputGpxPoints):
+                self.assertAlmostEqual(outputGpxPoint.elevation, gpxPoint.latitude, 5)
+            # Every request failed once
+            self.assertGreater(len(server.failedQueries), 1)
+            self.assertEqual(server.numberOfRequests, 2 * len(server.failedQueries))
+
+            elevationProvider = GoogleElevationProvider("testKey", baseUrl=server.url, retries=1)
+            with self.assertRaises(ElevationError):
+                elevationProvider.GetElevations([-24.5], [28.5])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+    def test_TokenBucket(self):
+        tokenBucket = TokenBucket(100, 1)
+        startTime = time.time()
+        for _ in range(0, 11):
+            tokenBucket.Acquire()
+        # The first token is free, the other 10 come at 100 per second
+        self.assertGreaterEqual(time.time() - startTime, 0.09)
+
+
     def test_CourseRemoveAllDuplicateGpxPoints(self):
         # Simple test. We would want the total distance to be the same, and the distance between any points should
         # not be zero
@@ -128,6 +732,39 @@ class TestGpxLib(unittest.TestCase):
             distance = GetDistanceBetweenPoints(newGpxPoints[index], newGpxPoints[index - 1])
             self.assertGreater(distance, 0)
 
+        # The last point is kept as well
+        gpxCourse = CreateTestGpxCourse().RemoveAllDuplicateGpxPoints()
+        self.assertEqual(gpxCourse.GetNumberOfPoints(), 4)
+        self.assertEqual(gpxCourse[-1].latitude, -25.95613466)
+
+
+    def test_CourseSimplify(self):
+        # A straight line along the equator with a 50m detour in the middle, and a 40m high bump at the end
+        longitudes = np.linspace(0, 0.01, 101)
+        latitudes = np.zeros(101)
+        latitudes[50] = 50 / (RADIUS_OF_EARTH * math.pi / 180)
+        elevations = np.zeros(101)
+        elevations[90] = 40
+        gpxCourse = GpxCourse.FromArrays(latitudes, longitudes, elevations)
+
+        for method in SIMPLIFICATION_METHODS:
+            simplifiedCourse = gpxCourse.Simplify(10, method)
+            np.testing.assert_array_equal(simplifiedCourse.GetLongitudes(), longitudes[[0, 49, 50, 51, 100]])
+            self.assertAlmostEqual(GetReductionRatio(gpxCourse, simplifiedCourse), 5 / 101.0)
+            # The elevation is only kept with useElevation
+            simplifiedCourse = gpxCourse.Simplify(10, method, useElevation=True)
+            np.testing.assert_array_equal(simplifiedCourse.GetLongitudes(), longitudes[[0, 49, 50, 51, 89, 90, 91, 100]])
+
+        # The race keeps its shape
+        race = self.courseInfo1.gpxCourse
+        for method in SIMPLIFICATION_METHODS:
+            simplifiedRace = race.Simplify(5, method)
+            self.assertLess(GetReductionRatio(race, simplifiedRace), 0.3)
+            self.assertAlmostEqual(simplifiedRace.GetTotalDistance(), race.GetTotalDistance(), delta=20)
+
+        with self.assertRaises(ValueError):
+            gpxCourse.Simplify(10, "radial")
+
 
     def test_CoursePruneDistance(self):
         # Shorten the distance to max 5000m and assert that it is actually less than 5000
@@ -137,6 +774,26 @@ class TestGpxLib(unittest.TestCase):
         # Todo: Test start param as well
 
 
+    def test_CoursePruneDistanceWithStart(self):
+        # Keep the points between 5000m and 10000m
+        gpxCourse = self.courseInfo1.gpxCourse
+        newGpxCourse = gpxCourse.PruneDistance(10000, 5000)
+        self.assertLessEqual(newGpxCourse.GetTotalDistance(), 5000)
+        self.assertGreater(newGpxCourse.GetTotalDistance(), 4000)
+        self.assertAlmostEqual(newGpxCourse[0].elevation, gpxCourse.GetElevationAtDistance(5000), delta=10)
+
+
+    def test_CourseGetCumulativeDistances(self):
+        gpxCourse = CreateTestGpxCourse()
+        cumulativeDistances = gpxCourse.GetCumulativeDistances()
+        self.assertEqual(len(cumulativeDistances), gpxCourse.GetNumberOfPoints())
+        self.assertEqual(cumulativeDistances[0], 0)
+        self.assertAlmostEqual(cumulativeDistances[1], 178.9333, 3)
+        # The duplicate points do not add distance
+        self.assertEqual(cumulativeDistances[2], cumulativeDistances[1])
+        self.assertEqual(cumulativeDistances[-1], gpxCourse.GetTotalDistance())
+
+
     def test_CourseCreateProfile(self):
         profile = self.courseInfo1.gpxCourse.CreateProfile()
 
@@ -157,6 +814,64 @@ class TestGpxLib(unittest.TestCase):
         self.assertAlmostEqual(profile.GetElevationAtDistance(5000), 1518.2241, 3)
 
 
+    def test_ProfileGetElevationsAtDistances(self):
+        profile = ProfileCourse.FromArrays([0, 100, 100, 300], [10, 20, 30, 10])
+        elevations = profile.GetElevationsAtDistances([0, 50, 100, 200, 300, 400, -100])
+        # The duplicate distance gives the elevation of the last point at that distance, and the ends are extrapolated
+        np.testing.assert_allclose(elevations, [10, 15, 30, 20, 10, 0, 0])
+        self.assertEqual(profile.GetElevationAtDistance(50), 15)
+
+        race = self.courseInfo1.gpxCourse.CreateProfile()
+        distances = np.linspace(0, race.GetTotalDistance(), 1000)
+        np.testing.assert_allclose(race.GetElevationsAtDistances(distances),
+                                   [race.GetElevationAtDistance(distance) for distance in distances])
+        np.testing.assert_allclose(self.courseInfo1.gpxCourse.GetElevationsAtDistances(distances),
+                                   race.GetElevationsAtDistances(distances))
+
+
+    def test_SlopeGetSlopesAtDistances(self):
+        slopeCourse = SlopeCourse.FromArrays([0, 100, 100, 250, 250], [1, 1, 2, 2, 3])
+        # Slopes are constant up to the next point, and the slope of the next segment starts at its first point
+        np.testing.assert_array_equal(slopeCourse.GetSlopesAtDistances([-10, 0, 50, 99.9, 100, 200, 250, 1000]),
+                                      [1, 1, 1, 1, 2, 2, 3, 3])
+        self.assertEqual(slopeCourse.GetSlopeAtDistance(150), 2)
+
+
+    def test_ProfileSmooth(self):
+        distances = np.arange(200) * 10.0
+        climb = ProfileCourse.FromArrays(distances, 1000 + distances * 0.05)
+        noise = np.random.RandomState(0).normal(0, 2, len(distances))
+        noisyClimb = ProfileCourse.FromArrays(distances, climb.GetElevations() + noise)
+        for method in SMOOTHING_METHODS:
+            # A steady climb stays the same, right up to the ends
+            np.testing.assert_allclose(climb.Smooth(method, 7).GetElevations(), climb.GetElevations(), atol=1e-6)
+            # and the jitter on top of it is filtered out
+            smoothedClimb = noisyClimb.Smooth(method, 7)
+            np.testing.assert_array_equal(smoothedClimb.GetDistances(), distances)
+            self.assertLess(smoothedClimb.GetElevationGain(), noisyClimb.GetElevationGain() * 0.75)
+
+        # The median removes a spike completely
+        spike = ProfileCourse.FromArrays(distances[:5], [10, 10, 50, 10, 10])
+        np.testing.assert_array_equal(spike.Smooth("median", 3).GetElevations(), [10, 10, 10, 10, 10])
+
+        with self.assertRaises(ValueError):
+            climb.Smooth("movingAverage", 4)
+        with self.assertRaises(ValueError):
+            climb.Smooth("gaussian")
+
+
+    def test_SmoothElevationChunks(self):
+        elevations = 1000 + np.random.RandomState(0).normal(0, 5, 1000).cumsum()
+        profile = ProfileCourse.FromArrays(np.arange(len(elevations)) * 10.0, elevations)
+        for method in SMOOTHING_METHODS:
+            smoothed = profile.Smooth(method, 9).GetElevations()
+            # Uneven chunks, some smaller than the window
+            chunks = [elevations[:3], elevations[3:4], elevations[4:400], elevations[400:]]
+            streamed = np.concatenate(list(SmoothElevationChunks(chunks, method, 9)))
+            np.testing.assert_allclose(streamed, smoothed, atol=1e-6)
+            np.testing.assert_allclose(profile.Smooth(method, 9, chunkSize=50).GetElevations(), smoothed, atol=1e-6)
+
+
     def test_ProfileGetAverageDistanceBetweenPoints(self):
         # Test both the profile with duplicates and the equidistant profile
         profileCourse = self.courseInfo1.gpxCourse.CreateProfile()
@@ -174,9 +889,522 @@ class TestGpxLib(unittest.TestCase):
         self.assertAlmostEqual(profilePoints.GetTotalDistance(), self.courseInfo1.expectedDistance, delta=10)
 
 
+    def test_CreateEquidistantProfileFractionalGap(self):
+        gpxCourse = CreateTestGpxCourse()
+        totalDistance = gpxCourse.GetTotalDistance()
+        profile = gpxCourse.CreateEquidistantProfile(2.5)
+        distances = profile.GetDistances()
+        np.testing.assert_allclose(distances[:-1], np.arange(len(distances) - 1) * 2.5)
+        self.assertEqual(distances[-1], totalDistance)
+        self.assertGreater(distances[-1] - distances[-2], 0)
+        self.assertLessEqual(distances[-1] - distances[-2], 2.5)
+        # The elevations are interpolated from the course
+        for index in [0, 17, 100, len(distances) - 1]:
+            self.assertAlmostEqual(profile.GetElevations()[index], gpxCourse.GetElevationAtDistance(distances[index]), 6)
+
+        with self.assertRaises(ValueError):
+            gpxCourse.CreateEquidistantProfile(0)
+
+
     def test_ProfileGetSlopeCourse(self):
         slopeCourse = CreateTestGpxCourse().CreateProfile().CreateSlopeCourse()
-        # TODO: Add a test for this....
+        # The duplicate points are skipped, so we get 2 points for each of the 3 slopes, plus the last point
+        self.assertEqual(slopeCourse.GetNumberOfPoints(), 7)
+        self.assertEqual(slopeCourse[0].distance, 0)
+        self.assertAlmostEqual(slopeCourse[0].slope, 1.1898, 3)
+        self.assertAlmostEqual(slopeCourse[1].distance, 178.9333, 3)
+        self.assertAlmostEqual(slopeCourse[2].slope, 8.2921, 3)
+        self.assertAlmostEqual(slopeCourse[-1].distance, 423.5238, 3)
+        self.assertAlmostEqual(slopeCourse[-1].slope, 7.1143, 3)
+
+
+    def test_GenerateTcxSlopeWorkout(self):
+        slopeCourse = SlopeCourse.FromArrays([0, 100.126, 250], [1.234, -5.678, 0])
+        outputDirectory = tempfile.mkdtemp()
+        try:
+            outputName = os.path.join(outputDirectory, "course")
+            outputFilename = GenerateTcxSlopeWorkout(slopeCourse, outputName)
+            self.assertEqual(outputFilename, outputName + ".tcx")
+            with open(outputFilename) as tcxFile:
+                prettyTcx = tcxFile.read()
+            self.assertIn("<DistanceMeters>100.13</DistanceMeters>", prettyTcx)
+            self.assertIn("<Slope>-5.68</Slope>", prettyTcx)
+
+            compactFilename = GenerateTcxSlopeWorkout(slopeCourse, outputName, distancePrecision=1, slopePrecision=1,
+                                                      compact=True, compress=True)
+            self.assertEqual(compactFilename, outputName + ".tcx.gz")
+            with gzip.open(compactFilename) as tcxFile:
+                compactTcx = tcxFile.read()
+            self.assertNotIn("\n", compactTcx)
+            self.assertLess(len(compactTcx), len(prettyTcx))
+
+            # Both are the same course
+            for tcx, precision in [(prettyTcx, 2), (compactTcx, 1)]:
+                root = fromstring(tcx)
+                namespace = "{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}"
+                self.assertEqual(root.find(".//" + namespace + "name").text, outputName)
+                distances = [float(element.text) for element in root.iter(namespace + "DistanceMeters")]
+                slopes = [float(element.text) for element in root.iter(namespace + "Slope")]
+                np.testing.assert_allclose(distances, np.round(slopeCourse.GetDistances(), precision))
+                np.testing.assert_allclose(slopes, np.round(slopeCourse.GetSlopes(), precision))
+        finally:
+            shutil.rmtree(outputDirectory)
+
+
+    def test_GenerateFitSlopeWorkout(self):
+        self.assertEqual(GetFitCrc("123456789"), 0xBB3D)
+
+        profile = ProfileCourse.FromArrays([0, 100, 250, 400], [1500, 1510, 1505, 1506], "Race")
+        slopeCourse = profile.CreateSlopeCourse()
+        outputDirectory = tempfile.mkdtemp()
+        try:
+            outputName = os.path.join(outputDirectory, "course")
+            outputFilename = GenerateSlopeWorkout(slopeCourse, outputName, "fit", name="Race", profile=profile)
+            self.assertEqual(outputFilename, outputName + ".fit")
+            with open(outputFilename, "rb") as fitFile:
+                fitData = fitFile.read()
+            # The trailing checksum makes the checksum of the whole file 0
+            self.assertEqual(GetFitCrc(fitData), 0)
+
+            dataSize, messages = ReadFitFile(fitData)
+            self.assertEqual(len(fitData), 14 + dataSize + 2)
+            self.assertEqual([number for number, _ in messages], [0, 31, 19, 21] + [20] * slopeCourse.GetNumberOfPoints() + [21])
+            self.assertEqual(messages[0][1][0], 6)
+            self.assertEqual(messages[1][1][5], "Race")
+            self.assertEqual(messages[2][1][9], 40000)
+            self.assertEqual((messages[2][1][21], messages[2][1][22]), (10, 10))
+
+            records = [values for number, values in messages if number == 20]
+            np.testing.assert_allclose([record[5] / 100.0 for record in records], slopeCourse.GetDistances())
+            np.testing.assert_allclose([record[9] / 100.0 for record in records], slopeCourse.GetSlopes(), atol=0.005)
+            # The altitudes start at the profile and follow the slopes
+            np.testing.assert_allclose([record[2] / 5.0 - 500 for record in records],
+                                       1500 + slopeCourse.GetRelativeElevations(), atol=0.1)
+            timestamps = [record[253] for record in records]
+            self.assertEqual(timestamps, sorted(timestamps))
+
+            # Without the profile there are no altitudes, and gzipped it is the same file
+            compressedFilename = GenerateFitSlopeWorkout(slopeCourse, outputName, compress=True)
+            self.assertEqual(compressedFilename, outputName + ".fit.gz")
+            with gzip.open(compressedFilename) as fitFile:
+                records = [values for number, values in ReadFitFile(fitFile.read())[1] if number == 20]
+            self.assertNotIn(2, records[0])
+
+            tcxFilename = GenerateSlopeWorkout(slopeCourse, outputName, "tcx")
+            self.assertLess(len(fitData), os.path.getsize(tcxFilename))
+            with self.assertRaises(ValueError):
+                GenerateSlopeWorkout(slopeCourse, outputName, "gpx")
+        finally:
+            shutil.rmtree(outputDirectory)
+
+
+    def test_GetWorkoutOutputName(self):
+        # Only the trailing workout extensions are stripped, never a part of a directory or the name itself
+        self.assertEqual(GetWorkoutOutputName("/data/my.fitness/ride.tcx"), "/data/my.fitness/ride")
+        self.assertEqual(GetWorkoutOutputName("a.gzip.tcx"), "a.gzip")
+        self.assertEqual(GetWorkoutOutputName("ride.fit.gz"), "ride")
+        self.assertEqual(GetWorkoutOutputName("ride.TCX.GZ"), "ride")
+        self.assertEqual(GetWorkoutOutputName("/data/my.tcx.files/ride"), "/data/my.tcx.files/ride")
+        self.assertEqual(GetWorkoutFilename(GetWorkoutOutputName("ride.fit"), "fit", True), "ride.fit.gz")
+
+
+    def test_ConvertGpxFilesInBatch(self):
+        from ConvertGpxToTcx import ConvertGpxFilesInBatch, FindGpxFiles
+
+        directory = tempfile.mkdtemp()
+        try:
+            inputDirectory = os.path.join(directory, "input")
+            outputDirectory = os.path.join(directory, "output")
+            os.mkdir(inputDirectory)
+            os.mkdir(outputDirectory)
+            shutil.copy("./TestData/94.7Race.gpx", os.path.join(inputDirectory, "race.gpx"))
+            with open(os.path.join(inputDirectory, "broken.gpx"), "w") as gpxFile:
+                gpxFile.write("<gpx><trk><trkseg><trkpt lat=")
+            with open(os.path.join(inputDirectory, "notes.txt"), "w") as textFile:
+                textFile.write("Not a gpx file")
+
+            inputFilenames = FindGpxFiles([inputDirectory])
+            self.assertEqual(inputFilenames, [os.path.join(inputDirectory, "broken.gpx"),
+                                              os.path.join(inputDirectory, "race.gpx")])
+
+            # The broken file does not stop the other one
+            results = ConvertGpxFilesInBatch(inputFilenames, outputDirectory, numberOfProcesses=2, apiKey=None,
+                                             interpolationResolution=100, startDistance=0, stopDistance=0)
+            self.assertEqual([result.inputFilename for result in results], inputFilenames)
+            failedResult, convertedResult = results
+            self.assertTrue(failedResult.error is not None)
+            self.assertEqual(failedResult.numberOfPoints, 0)
+            self.assertTrue(convertedResult.error is None)
+            self.assertEqual(convertedResult.outputFilename, os.path.join(outputDirectory, "race.tcx"))
+            self.assertTrue(convertedResult.numberOfPoints > 0)
+            self.assertEqual(os.listdir(outputDirectory), ["race.tcx"])
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_ConvertGpxFilesInBatchWithCourseFiles(self):
+        from ConvertGpxToTcx import ConvertGpxFilesInBatch, FindGpxFiles, GetBatchOutputNames
+
+        directory = tempfile.mkdtemp()
+        try:
+            gpxFilename = os.path.join(directory, "x.gpx")
+            courseFilename = os.path.join(directory, "x.course")
+            shutil.copy("./TestData/94.7Race.gpx", gpxFilename)
+            SaveCourse(ParseGpxFile(gpxFilename), courseFilename)
+            self.assertEqual(FindGpxFiles([directory]), [courseFilename, gpxFilename])
+
+            # Both would be converted to x.tcx, so only the course file is converted, whatever the order
+            outputName = os.path.join(directory, "x")
+            self.assertEqual(GetBatchOutputNames([courseFilename, gpxFilename], None), [(courseFilename, outputName)])
+            self.assertEqual(GetBatchOutputNames([gpxFilename, courseFilename], None), [(courseFilename, outputName)])
+
+            results = ConvertGpxFilesInBatch(FindGpxFiles([directory]), None, numberOfProcesses=2, apiKey=None,
+                                             interpolationResolution=100, startDistance=0, stopDistance=0)
+            self.assertEqual([(result.inputFilename, result.outputFilename, result.error) for result in results],
+                             [(courseFilename, outputName + ".tcx", None)])
+            self.assertEqual(sorted(os.listdir(directory)), ["x.course", "x.gpx", "x.tcx"])
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_ConvertGpxFilesInBatchWithSameNames(self):
+        from ConvertGpxToTcx import ConvertGpxFilesInBatch, FindGpxFiles
+
+        directory = tempfile.mkdtemp()
+        try:
+            outputDirectory = os.path.join(directory, "output")
+            os.mkdir(outputDirectory)
+            for raceDirectory in ["a", "b"]:
+                os.mkdir(os.path.join(directory, raceDirectory))
+                shutil.copy("./TestData/94.7Race.gpx", os.path.join(directory, raceDirectory, "ride.gpx"))
+            inputFilenames = FindGpxFiles([os.path.join(directory, "*", "ride.gpx")])
+            self.assertEqual(len(inputFilenames), 2)
+
+            # Both would be written to output/ride.tcx, so nothing is converted
+            with self.assertRaises(ValueError) as context:
+                ConvertGpxFilesInBatch(inputFilenames, outputDirectory, numberOfProcesses=2, apiKey=None,
+                                       interpolationResolution=100, startDistance=0, stopDistance=0)
+            self.assertIn(os.path.join(outputDirectory, "ride"), str(context.exception))
+            self.assertEqual(os.listdir(outputDirectory), [])
+
+            # Next to the input files they do not clash
+            results = ConvertGpxFilesInBatch(inputFilenames, None, numberOfProcesses=2, apiKey=None,
+                                             interpolationResolution=100, startDistance=0, stopDistance=0)
+            self.assertEqual([result.outputFilename for result in results],
+                             [os.path.join(directory, raceDirectory, "ride.tcx") for raceDirectory in ["a", "b"]])
+            self.assertTrue(all(result.error is None for result in results))
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_ConvertGpxFileInBatchInstrumentation(self):
+        from ConvertGpxToTcx import _ConvertGpxFileInBatch
+
+        instrumentation = GetInstrumentation()
+        directory = tempfile.mkdtemp()
+        try:
+            # Like a spawned worker, which starts with the instrumentation disabled, whatever the main process has
+            for instrumentationEnabled in [False, True]:
+                instrumentation.Disable()
+                result = _ConvertGpxFileInBatch(("./TestData/94.7Race.gpx", os.path.join(directory, "race"),
+                                                 dict(apiKey=None, interpolationResolution=100, startDistance=0,
+                                                      stopDistance=0), instrumentationEnabled))
+                self.assertTrue(result.error is None)
+                if instrumentationEnabled:
+                    self.assertIn("ParseGpxFile", [stage["name"] for stage in result.instrumentation["stages"]])
+                else:
+                    self.assertTrue(result.instrumentation is None)
+        finally:
+            instrumentation.Disable()
+            instrumentation.Reset()
+            shutil.rmtree(directory)
+
+
+    def test_LoadProfileInWorkerInstrumentation(self):
+        from CompareProfiles import _LoadProfileInWorker
+
+        instrumentation = GetInstrumentation()
+        try:
+            for instrumentationEnabled in [False, True]:
+                instrumentation.Disable()
+                result = _LoadProfileInWorker(("./TestData/94.7Race.gpx", None, None,
+                                               dict(interpolationResolution=100), instrumentationEnabled))
+                self.assertTrue(result.error is None)
+                if instrumentationEnabled:
+                    self.assertIn("CreateEquidistantProfile",
+                                  [stage["name"] for stage in result.instrumentation["stages"]])
+                else:
+                    self.assertTrue(result.instrumentation is None)
+        finally:
+            instrumentation.Disable()
+            instrumentation.Reset()
+
+
+    def test_ConversionServer(self):
+        import urllib2
+        from ConversionServer import ConversionServer
+
+        server = ConversionServer(("127.0.0.1", 0), numberOfWorkers=1, maxQueueLength=0)
+        serverThread = threading.Thread(target=server.serve_forever)
+        serverThread.start()
+        try:
+            with open("./TestData/94.7Race.gpx") as gpxFile:
+                gpxData = gpxFile.read()
+
+            def Post(query, data=gpxData):
+                try:
+                    response = urllib2.urlopen(server.url + "/convert?" + query, data)
+                    return response.getcode(), response.read()
+                except urllib2.HTTPError as error:
+                    return error.code, error.read()
+
+            statusCode, tcx = Post("interpolationResolution=50&name=Race")
+            self.assertEqual(statusCode, 200)
+            namespace = "{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}"
+            self.assertEqual(fromstring(tcx).find(".//" + namespace + "name").text, "Race")
+
+            statusCode, body = Post("interpolationResolution=50&summary=1")
+            self.assertEqual(statusCode, 200)
+            result = json.loads(body)
+            self.assertIn("<Slope>", result["tcx"])
+            self.assertAlmostEqual(result["summary"]["totalDistance"], self.courseInfo1.expectedDistance, delta=100)
+
+            self.assertEqual(Post("interpolationResolution=-1")[0], 400)
+            self.assertEqual(Post("unknownOption=1")[0], 400)
+            self.assertEqual(Post("", data="not a gpx file")[0], 422)
+
+            # With the only worker slot taken the request is turned away instead of queued
+            server.slots.acquire()
+            try:
+                self.assertEqual(Post("")[0], 503)
+            finally:
+                server.slots.release()
+
+            # A missing or invalid length is a bad request, not a dropped connection
+            def PostWithLength(length):
+                connection = httplib.HTTPConnection(*server.server_address[:2])
+                try:
+                    connection.putrequest("POST", "/convert")
+                    if length is not None:
+                        connection.putheader("Content-Length", length)
+                    connection.endheaders()
+                    return connection.getresponse().status
+                finally:
+                    connection.close()
+
+            self.assertEqual(PostWithLength(None), 400)
+            self.assertEqual(PostWithLength("abc"), 400)
+
+            # Any other error is answered with 500, and still counted. It is always logged, so the log is captured
+            server.Convert = lambda *args: 1 / 0
+            stderr = sys.stderr
+            sys.stderr = StringIO.StringIO()
+            try:
+                self.assertEqual(Post("")[0], 500)
+                self.assertIn("Unexpected error: ZeroDivisionError", sys.stderr.getvalue())
+            finally:
+                sys.stderr = stderr
+                del server.Convert
+
+            # A request that times out keeps its slot until its conversion is done, so the pool is not oversubscribed
+            server.requestTimeout = 0.01
+            try:
+                self.assertEqual(Post("interpolationResolution=0.1")[0], 504)
+                self.assertEqual(Post("")[0], 503)
+                for _ in range(600):
+                    if server.slots.acquire(False):
+                        server.slots.release()
+                        break
+                    time.sleep(0.1)
+                else:
+                    self.fail("The slot of the conversion that timed out was never given back")
+            finally:
+                server.requestTimeout = 300
+
+            metrics = json.loads(urllib2.urlopen(server.url + "/metrics").read())
+            self.assertEqual(metrics["requests"], 11)
+            self.assertEqual(metrics["succeeded"], 2)
+            self.assertEqual(metrics["failed"], 9)
+            self.assertEqual(metrics["rejected"], 2)
+            self.assertEqual(metrics["timedOut"], 1)
+            self.assertEqual(metrics["inProgress"], 0)
+            self.assertGreater(metrics["pointsPerSecond"], 0)
+            self.assertLessEqual(metrics["latency"]["p50"], metrics["latency"]["max"])
+        finally:
+            server.Close()
+            serverThread.join()
+
+
+    def test_Instrumentation(self):
+        instrumentation = GetInstrumentation()
+        instrumentation.Reset()
+        gpxCourse = CreateTestGpxCourse()
+
+        # Nothing is recorded while it is disabled
+        gpxCourse.CreateProfile().CreateSlopeCourse()
+        self.assertEqual(instrumentation.ToDict(), {"stages": [], "counters": {}})
+
+        instrumentation.Enable()
+        try:
+            # A new course, because the first one already has its distances cached
+            gpxCourse = CreateTestGpxCourse()
+            gpxCourse.CreateProfile().CreateSlopeCourse()
+            gpxCourse.CreateProfile()
+        finally:
+            instrumentation.Disable()
+        instrumentationDict = instrumentation.ToDict()
+        self.assertEqual([stage["name"] for stage in instrumentationDict["stages"]],
+                         ["CreateProfile", "CreateSlopeCourse"])
+        createProfileStage = instrumentationDict["stages"][0]
+        self.assertEqual(createProfileStage["calls"], 2)
+        self.assertEqual(createProfileStage["pointsIn"], 14)
+        self.assertEqual(createProfileStage["pointsOut"], 14)
+        self.assertEqual(instrumentationDict["counters"]["haversineCalls"], 1)
+        self.assertEqual(instrumentationDict["counters"]["haversineDistances"], 6)
+
+        # Merging the results of a worker adds them up
+        instrumentation.Merge(instrumentationDict)
+        self.assertEqual(instrumentation.ToDict()["stages"][0]["calls"], 4)
+        self.assertEqual(instrumentation.ToDict()["counters"]["haversineCalls"], 2)
+        instrumentation.Reset()
+
+
+    def test_ImportDoesNotLoadMatplotlib(self):
+        output = subprocess.check_output([sys.executable, "-c",
+                                          "import sys, GpxLib, GpxPlot; print 'matplotlib' in sys.modules"],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.strip(), "False")
+
+
+    def test_Benchmark(self):
+        import BenchmarkGpxLib
+
+        directory = tempfile.mkdtemp()
+        try:
+            # The default resolution has to add points to the synthetic courses, or the interpolation is not measured
+            gpxFilename = os.path.join(directory, "Synthetic1000.gpx")
+            BenchmarkGpxLib.WriteSyntheticGpxFile(gpxFilename, 1000)
+            gpxCourse = ParseGpxFile(gpxFilename)
+            self.assertEqual(gpxCourse.GetNumberOfPoints(), 1000)
+            interpolatedCourse = gpxCourse.InterpolateToGivenResolution(BenchmarkGpxLib.DEFAULT_INTERPOLATION_RESOLUTION)
+            self.assertTrue(interpolatedCourse.GetNumberOfPoints() > 2 * gpxCourse.GetNumberOfPoints())
+
+            # One small run, compared with the committed baseline. The threshold is so large that it never fails on
+            # a slow machine
+            resultsFilename = os.path.join(directory, "results.json")
+            scriptDirectory = os.path.dirname(os.path.abspath(__file__))
+            subprocess.check_output([sys.executable, "BenchmarkGpxLib.py", "--sizes", "1000", "--repeat", "1",
+                                     "--dataDirectory", directory, "--output", resultsFilename,
+                                     "--baseline", "BenchmarkBaseline.json", "--threshold", "1000000"],
+                                    cwd=scriptDirectory)
+            with open(resultsFilename) as resultsFile:
+                results = json.load(resultsFile)
+            self.assertEqual(results["metadata"]["interpolationResolution"],
+                             BenchmarkGpxLib.DEFAULT_INTERPOLATION_RESOLUTION)
+            self.assertEqual([(result["course"], result["stage"]) for result in results["results"]],
+                             [(course, stage) for course in ["94.7Race", "Synthetic1000"]
+                              for stage in BenchmarkGpxLib.STAGES])
+            for result in results["results"]:
+                self.assertTrue(result["seconds"] >= 0)
+                self.assertEqual("regression" in result, result["course"] == "94.7Race")
+                self.assertFalse(result.get("regression"))
+
+            # The committed baseline covers every stage of the default run
+            with open(os.path.join(scriptDirectory, "BenchmarkBaseline.json")) as baselineFile:
+                baseline = json.load(baselineFile)
+            self.assertEqual(set((result["course"], result["stage"]) for result in baseline["results"]),
+                             set((course, stage) for course in ["94.7Race"] + ["Synthetic" + str(size) for size in
+                                                                              BenchmarkGpxLib.DEFAULT_SYNTHETIC_SIZES]
+                                 for stage in BenchmarkGpxLib.STAGES))
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_SavePlots(self):
+        profile = self.courseInfo1.gpxCourse.CreateEquidistantProfile(100)
+        outputDirectory = tempfile.mkdtemp()
+        try:
+            pngFilename = SaveProfilePlot(profile, os.path.join(outputDirectory, "profile.png"), title="Profile")
+            with open(pngFilename, "rb") as pngFile:
+                self.assertEqual(pngFile.read(8), "\x89PNG\r\n\x1a\n")
+            svgFilename = SaveSlopePlot(profile.CreateSlopeCourse(), os.path.join(outputDirectory, "slope.svg"))
+            with open(svgFilename) as svgFile:
+                self.assertIn("<svg", svgFile.read())
+        finally:
+            shutil.rmtree(outputDirectory)
+
+
+    def test_GetProfileDifferences(self):
+        profiles = [ProfileCourse.FromArrays([0, 2000], [100, 120]), ProfileCourse.FromArrays([0, 2500], [100, 125]),
+                    ProfileCourse.FromArrays([0, 1000, 2000], [100, 100, 140])]
+        # The grid only covers the distance of the shortest profile
+        distances, elevations = ResampleProfiles(profiles, 500)
+        np.testing.assert_allclose(distances, [0, 500, 1000, 1500, 2000])
+        self.assertEqual(elevations.shape, (3, 5))
+        np.testing.assert_allclose(elevations[2], [100, 100, 100, 120, 140])
+
+        # Use a tiny block size to also test the comparison in blocks of profiles
+        originalBlockSize = GpxLib.PROFILE_COMPARISON_BLOCK_SIZE
+        GpxLib.PROFILE_COMPARISON_BLOCK_SIZE = 5
+        try:
+            differences = GetProfileDifferences(distances, elevations)
+        finally:
+            GpxLib.PROFILE_COMPARISON_BLOCK_SIZE = originalBlockSize
+
+        np.testing.assert_allclose(differences["rmse"], [[0, 0, math.sqrt(110)], [0, 0, math.sqrt(110)],
+                                                         [math.sqrt(110), math.sqrt(110), 0]])
+        np.testing.assert_allclose(differences["maxDeviation"], [[0, 0, 20], [0, 0, 20], [20, 20, 0]])
+        np.testing.assert_allclose(differences["gains"], [20, 20, 40])
+        np.testing.assert_allclose(differences["gainDifference"][0], [0, 0, -20])
+        np.testing.assert_allclose(differences["gradients"], [[1, 1], [1, 1], [0, 4]])
+        np.testing.assert_allclose(differences["gradientDifference"][2], [2, 2, 0])
+        np.testing.assert_allclose(differences["gradientDifference"], differences["gradientDifference"].T)
+
+        with self.assertRaises(ValueError):
+            ResampleProfiles([], 500)
+
+
+    def test_SlopeCompress(self):
+        slopeCourse = SlopeCourse.FromArrays([0, 100, 100, 200, 200, 300, 300, 400],
+                                             [1.0, 1.0, 1.0, 1.0, 2.0, 2.0, 1.2, 1.2])
+        np.testing.assert_array_equal(slopeCourse.GetRelativeElevations(), [0, 1, 1, 2, 2, 4, 4, 5.2])
+        # Only the equal slopes are removed, and the end of the course is kept
+        compressedCourse = slopeCourse.Compress()
+        np.testing.assert_array_equal(compressedCourse.GetDistances(), [0, 200, 300, 400])
+        np.testing.assert_array_equal(compressedCourse.GetSlopes(), [1.0, 2.0, 1.2, 1.2])
+        self.assertEqual(GetMaxElevationError(slopeCourse, compressedCourse), 0)
+
+        # Within 0.5m a single slope fits the whole course
+        compressedCourse = slopeCourse.Compress(0.5)
+        np.testing.assert_array_equal(compressedCourse.GetDistances(), [0, 400])
+        np.testing.assert_allclose(compressedCourse.GetSlopes(), [1.25, 1.25])
+        self.assertAlmostEqual(GetMaxElevationError(slopeCourse, compressedCourse), 0.5)
+
+        # Within 0.3m the last two slopes are merged
+        compressedCourse = slopeCourse.Compress(0.3)
+        np.testing.assert_array_equal(compressedCourse.GetDistances(), [0, 200, 400])
+        np.testing.assert_allclose(compressedCourse.GetSlopes(), [1.0, 1.7, 1.7])
+        self.assertAlmostEqual(GetMaxElevationError(slopeCourse, compressedCourse), 0.3)
+
+        # The race at 10m resolution, with half a meter of error and slopes rounded to 0.5%
+        profile = self.courseInfo1.gpxCourse.CreateEquidistantProfile(10)
+        slopeCourse = profile.CreateSlopeCourse()
+        compressedCourse = slopeCourse.Compress(0.5, 0.5)
+        self.assertLess(compressedCourse.GetNumberOfPoints(), slopeCourse.Compress().GetNumberOfPoints() / 10)
+        self.assertLessEqual(GetMaxElevationError(slopeCourse, compressedCourse), 0.5 + 1e-6)
+        np.testing.assert_allclose(compressedCourse.GetSlopes() / 0.5, np.round(compressedCourse.GetSlopes() / 0.5),
+                                   atol=1e-9)
+        self.assertEqual(compressedCourse.GetDistances()[-1], profile.GetTotalDistance())
+
+        # No multiple of 0.5% keeps 0.25% over 1000m within 1m, so the rounding is up to 2.5m off, but that does not add up
+        slopeCourse = SlopeCourse.FromArrays([0, 1000, 2000, 3000], [0.25, 0.25, 0.25, 0.25])
+        compressedCourse = slopeCourse.Compress(1, 0.5)
+        maxElevationError = GetMaxElevationError(slopeCourse, compressedCourse)
+        self.assertGreater(maxElevationError, 1)
+        self.assertLessEqual(maxElevationError, 0.5 / 2 / 100 * 1000 + 1e-6)
+
+        with self.assertRaises(ValueError):
+            slopeCourse.Compress(-1)
 
 
     def test_SlopeGetAverageDistanceBetweenPoints(self):
@@ -8,11 +8,11 @@ set /p apiKey=<ApiKey.txt
 IF [%apiKey%] == [] GOTO NOKEY
 
 :HAVEKEY
-python ..\..\ConvertGpxToTcx.py %1 -a %apiKey%
+python ..\..\ConvertGpxToTcx.py %* -a %apiKey%
 GOTO END
 
 :NOKEY
-python ..\..\ConvertGpxToTcx.py %1
+python ..\..\ConvertGpxToTcx.py %*
 GOTO END
 
 :END
\ No newline at end of file